@@ -0,0 +1,245 @@
+import asyncio
+import hmac
+import math
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from starlette.responses import JSONResponse, PlainTextResponse
+
+
+class RouteBudget:
+    """
+    How much of a worker one class of routes may use at once.
+
+    Up to `concurrency` requests run; up to `queue` more wait at most
+    `queue_timeout` seconds for a slot. Anything beyond that is turned away
+    at once with 503 and Retry-After instead of piling up behind the rest.
+    """
+
+    def __init__(self, name, concurrency, queue, queue_timeout, retry_after):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._slots = asyncio.Semaphore(concurrency)
+
+    async def acquire(self):
+        """Take a slot, waiting in the bounded queue if needed; False means shed the request."""
+        if not self._slots.locked():
+            await self._slots.acquire()  # A free slot is taken without suspending
+        elif self.waiting >= self.queue:
+            self.rejected += 1
+            return False
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._slots.release()
+
+
+# Expensive routes get small budgets of their own so a spike on them cannot starve page loads
+BUDGETS = {
+    "auth": RouteBudget("auth", concurrency=4, queue=16, queue_timeout=2.0, retry_after=2),      # bcrypt
+    "report": RouteBudget("report", concurrency=2, queue=4, queue_timeout=5.0, retry_after=10),  # PDF rendering
+    "search": RouteBudget("search", concurrency=4, queue=8, queue_timeout=1.0, retry_after=2),   # user and expense search
+    "import": RouteBudget("import", concurrency=2, queue=2, queue_timeout=1.0, retry_after=30),  # large uploads
+    "default": RouteBudget("default", concurrency=64, queue=256, queue_timeout=10.0, retry_after=1),
+}
+
+# (method, path prefix, budget); the first match wins
+ROUTE_BUDGETS = [
+    ("POST", "/login", "auth"),
+    ("POST", "/register", "auth"),
+    ("GET", "/reset-password/", "auth"),
+    ("GET", "/view-report/", "report"),
+    ("POST", "/search-friend", "search"),
+    ("GET", "/search/data", "search"),
+    ("POST", "/import-expenses/", "import"),
+]
+
+UNLIMITED_PATHS = ("/static/", "/metrics")
+
+
+def budget_for(method, path):
+    if path.startswith(UNLIMITED_PATHS):
+        return None
+    for route_method, prefix, name in ROUTE_BUDGETS:
+        if method == route_method and path.startswith(prefix):
+            return BUDGETS[name]
+    return BUDGETS["default"]
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that runs every request under its route's budget."""
+
+    def __init__(self, app, enabled=True):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            return await self.app(scope, receive, send)
+
+        budget = budget_for(scope["method"], scope["path"])
+        if budget is None:
+            return await self.app(scope, receive, send)
+
+        if not await budget.acquire():
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "The server is busy, please try again shortly."},
+                headers={"Retry-After": str(budget.retry_after)},
+            )
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.release()
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that refuses oversized uploads from their Content-Length.
+
+    `limits` are (method, path prefix, max bytes). A matching request with a
+    larger body gets 413, and one without a length 411, before any of the
+    body is read, so it never reaches the disk or a route budget.
+    """
+
+    def __init__(self, app, limits=()):
+        self.app = app
+        self.limits = list(limits)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for method, prefix, max_bytes in self.limits:
+                if scope["method"] == method and scope["path"].startswith(prefix):
+                    length = dict(scope["headers"]).get(b"content-length", b"")
+                    if not length.isdigit():
+                        return await PlainTextResponse("Length Required", status_code=411)(scope, receive, send)
+                    if int(length) > max_bytes:
+                        return await PlainTextResponse("The file is too large to import.", status_code=413)(scope, receive, send)
+                    break
+        return await self.app(scope, receive, send)
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated_at = now
+
+
+class RateLimiter:
+    """
+    In-memory token buckets keyed by arbitrary strings (per worker).
+
+    Each key may burst `capacity` attempts and then gets `rate` more per
+    second. Buckets of idle keys refill to full, so only the `max_keys`
+    most recently used are kept.
+    """
+
+    def __init__(self, rate, capacity, max_keys=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+        self.limited = 0
+
+    def _refilled(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            bucket.updated_at = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def take(self, *keys):
+        """
+        Spend one token from every key's bucket, or none of them.
+
+        Returns 0 when allowed, otherwise the seconds until every bucket has
+        a token again.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = [self._refilled(key, now) for key in keys]
+            wait = max((1 - bucket.tokens) / self.rate for bucket in buckets)
+            if wait > 0:
+                self.limited += 1
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return 0
+
+
+LOGIN_RATE = float(os.environ.get("OWE_NO_LOGIN_RATE", 5 / 60))  # Tokens per second: 5 attempts a minute
+LOGIN_BURST = int(os.environ.get("OWE_NO_LOGIN_BURST", 5))
+# One address can be a whole office or mobile carrier behind NAT, so it gets far more room than one account
+LOGIN_IP_RATE = float(os.environ.get("OWE_NO_LOGIN_IP_RATE", 1))
+LOGIN_IP_BURST = int(os.environ.get("OWE_NO_LOGIN_IP_BURST", 100))
+
+login_limiter = RateLimiter(rate=LOGIN_RATE, capacity=LOGIN_BURST)
+login_ip_limiter = RateLimiter(rate=LOGIN_IP_RATE, capacity=LOGIN_IP_BURST)
+
+
+def login_retry_after(email, client_ip):
+    """Seconds the caller must wait before another login attempt for this account from this address, or 0."""
+    # The address is checked first, so attempts refused there never use up the account's few tokens
+    wait = login_ip_limiter.take(f"ip:{client_ip}") or login_limiter.take(f"account:{email.strip().lower()}")
+    return math.ceil(wait)
+
+
+# /metrics is off unless this is set, and then only answers scrapers that send it as a bearer token
+METRICS_TOKEN = os.environ.get("OWE_NO_METRICS_TOKEN", "")
+
+
+def metrics_allowed(authorization):
+    """Whether a request with this Authorization header may read /metrics."""
+    return bool(METRICS_TOKEN) and hmac.compare_digest((authorization or "").encode(), f"Bearer {METRICS_TOKEN}".encode())
+
+
+def metrics_response():
+    """Per-worker admission counters in the Prometheus text format."""
+    lines = []
+    for metric, help_text, kind, attribute in (
+        ("owe_no_route_active", "Requests running under the budget.", "gauge", "active"),
+        ("owe_no_route_queue_depth", "Requests waiting for a slot.", "gauge", "waiting"),
+        ("owe_no_route_admitted_total", "Requests admitted.", "counter", "admitted"),
+        ("owe_no_route_rejected_total", "Requests shed with 503.", "counter", "rejected"),
+        ("owe_no_route_queue_timeouts_total", "Requests shed after waiting the whole queue timeout.", "counter", "timed_out"),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for budget in BUDGETS.values():
+            lines.append(f'{metric}{{budget="{budget.name}",pid="{os.getpid()}"}} {getattr(budget, attribute)}')
+    lines.append("# HELP owe_no_login_rate_limited_total Login attempts refused by the rate limiter.")
+    lines.append("# TYPE owe_no_login_rate_limited_total counter")
+    lines.append(f'owe_no_login_rate_limited_total{{key="account",pid="{os.getpid()}"}} {login_limiter.limited}')
+    lines.append(f'owe_no_login_rate_limited_total{{key="ip",pid="{os.getpid()}"}} {login_ip_limiter.limited}')
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
@@ -1,29 +1,85 @@
-from fastapi import FastAPI, HTTPException, Request, Depends, status
+from fastapi import FastAPI, HTTPException, Request, Depends, status, UploadFile, File, Query
 from fastapi.responses import Response, JSONResponse, RedirectResponse, StreamingResponse
-from starlette.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
 from starlette.staticfiles import StaticFiles
 from sqlalchemy.orm import Session, aliased
 from sqlalchemy import or_, not_, and_, select, asc, desc, func
 from auth import authenticate_user, get_current_user, get_hashed_password, AuthenticationException, UserNotFoundException
-from services import createDatabase, get_db
-from models import User, Group, GroupMember, Expense, ExpenseSplit, Settlement, Friends, FriendRequests
+from services import ensure_database, get_db, group_session, each_shard, shard_of, register_group, insert_expenses, delete_expenses, restore_expenses, add_group_members, remove_group_members, accept_friend_requests, reject_friend_requests
+from membership import get_group_membership, invalidate_membership, load_membership
+from rollups import user_rollups, group_rollups, rollup_series
+from search import PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, expense_conditions, paginate, search_keys, search_results
+from splits import allocate_splits, normalize_split_type, plan_split
+from suggestions import friend_graph
+from templating import templates, precompile_templates
+from admission import AdmissionMiddleware, UploadLimitMiddleware, login_retry_after, metrics_allowed, metrics_response
+from database import ShardSessions
+from coordination import coordinator
+from scheduler import RecurringScheduler, occurrence_at
+from purge import PurgeWorker
+from group_commit import commit_write, stop_writers
+from importer import IMPORT_DIR, MAX_UPLOAD_BYTES, ImportResumer, start_import, submit_import_job, stop_import_jobs, import_job_summary
+from models import User, Group, GroupMember, Expense, ExpenseSplit, Settlement, Friends, FriendRequests, ExpenseArchive, ExpenseSplitArchive, RecurringExpense, ImportJob
+from money import Money
+from balances import load_group_balances, user_net_balances, user_totals
+from compaction import latest_checkpoint
 from auth import get_user
 import os
+import json
+import tempfile
 import traceback
+from contextlib import asynccontextmanager
+from typing import Optional
 from pydantic import BaseModel, EmailStr
 from collections import defaultdict
-from datetime import datetime
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.pdfgen import canvas
+from itertools import chain
+from datetime import date, datetime
 from io import BytesIO
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
-templates = Jinja2Templates(directory=f"{dir_path}/templates")
 
-app = FastAPI()
-
-createDatabase()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema checks run here, once per process tree, rather than on import
+    ensure_database()
+    precompile_templates()
+    # Cache invalidations and lease hand-offs between workers
+    coordinator.start()
+
+    # Recurring expenses are materialized in-process; set OWE_NO_SCHEDULER=0 to run without it
+    scheduler = None
+    if os.environ.get("OWE_NO_SCHEDULER", "1") != "0":
+        scheduler = RecurringScheduler(ShardSessions)
+        scheduler.start()
+
+    # Deleted expenses are removed once their undo window passes; OWE_NO_PURGE=0 keeps them
+    purge_worker = None
+    if os.environ.get("OWE_NO_PURGE", "1") != "0":
+        purge_worker = PurgeWorker(ShardSessions)
+        purge_worker.start()
+
+    # Uploads whose import was cut off (by a restart, say) resume from their checkpoint
+    import_resumer = ImportResumer()
+    import_resumer.start()
+    yield
+    if scheduler:
+        await scheduler.stop()
+    if purge_worker:
+        await purge_worker.stop()
+    await import_resumer.stop()
+    # Writes already handed to a group-commit writer still commit before the worker exits
+    await run_in_threadpool(stop_writers)
+    # Imports stop at a chunk boundary; their checkpoint lets them resume
+    await run_in_threadpool(stop_import_jobs)
+    coordinator.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# Per-route concurrency budgets; set OWE_NO_ADMISSION=0 to serve everything unthrottled
+app.add_middleware(AdmissionMiddleware, enabled=os.environ.get("OWE_NO_ADMISSION", "1") != "0")
+# Added last, so it runs first: an oversized import is refused before it queues for a budget slot
+# (the margin is the multipart framing around the file)
+app.add_middleware(UploadLimitMiddleware, limits=[("POST", "/import-expenses/", MAX_UPLOAD_BYTES + 64 * 1024)])
 
 app.mount("/static", StaticFiles(directory=f"{dir_path}/static"), name="static")
 
@@ -36,6 +92,13 @@ async def user_not_found_exception_handler(request: Request, exc: UserNotFoundEx
     return RedirectResponse(url="/register") # Redirect to the register page if the user is not found
 
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # Look like any unknown path unless metrics are enabled and the token matches
+    if not metrics_allowed(request.headers.get("authorization")):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return metrics_response()
+
 @app.get("/login")
 async def get_login(request: Request):
     return templates.TemplateResponse("login.html", context={"request": request})
@@ -45,7 +108,7 @@ class LoginRequest(BaseModel):
     password: str
 
 @app.post("/login")
-async def login(request: LoginRequest, response: Response):
+async def login(request: LoginRequest, response: Response, http_request: Request):
     try:
         email = request.email.lower()
         password = request.password
@@ -54,8 +117,18 @@ async def login(request: LoginRequest, response: Response):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Failed to login. {str(e)}"
         )
-    
-    user = authenticate_user(email, password)
+
+    # Attempts are limited per account and per address before any password is checked
+    retry_after = login_retry_after(email, http_request.client.host if http_request.client else "unknown")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts. Please try again later.",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    # bcrypt is slow on purpose; keep it off the event loop
+    user = await run_in_threadpool(authenticate_user, email, password)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -94,7 +167,7 @@ async def register(request: Request, response: Response, db:Session=Depends(get_
                 detail="User already exists."
             )
         
-        hashed_passsword = get_hashed_password(password)
+        hashed_passsword = await run_in_threadpool(get_hashed_password, password)
 
         new_user = User()
         new_user.email = email.lower()
@@ -123,7 +196,7 @@ async def reset_password_request(
     if not user:
         raise UserNotFoundException
 
-    user.password = get_hashed_password("User@123")
+    user.password = await run_in_threadpool(get_hashed_password, "User@123")
     db.commit()
 
     return {"message": "Password reset successfully."}
@@ -147,12 +220,19 @@ async def logout(request: Request, response: Response):
 @app.get("/")
 async def get_groups(request: Request, current_user= Depends(get_current_user),  db:Session = Depends(get_db)):
 
-    group_list = (
-        db.query(Group)
-        .join(GroupMember, GroupMember.group_id == Group.id)
-        .filter(GroupMember.user_id == current_user.get("user_id"))
-        .all()
-    )
+    # A group never spans shards, so per-shard lists and totals simply add up
+    group_list = []
+    total_receive, total_pay = Money(0), Money(0)
+    for shard_db in each_shard(db):
+        group_list += (
+            shard_db.query(Group)
+            .join(GroupMember, GroupMember.group_id == Group.id)
+            .filter(GroupMember.user_id == current_user.get("user_id"))
+            .all()
+        )
+        receive, pay = user_totals(shard_db, current_user.get("user_id"))
+        total_receive += receive
+        total_pay += pay
 
     friend_request_list = (
         db.query(FriendRequests.friend_request_id, User.first_name, User.last_name)
@@ -161,19 +241,34 @@ async def get_groups(request: Request, current_user= Depends(get_current_user),
         .all()
     )
     
-    return templates.TemplateResponse('groups.html', context={'request': request, 'total_owe': 0, 'group_list': group_list, 'total_friend_requests': len(friend_request_list)})
-
-@app.get("/friends")
-async def get_friends(request: Request, current_user= Depends(get_current_user),  db:Session = Depends(get_db)):
+    return templates.TemplateResponse('groups.html', context={'request': request, 'total_owe': 0, 'total_receive': total_receive, 'total_pay': total_pay, 'group_list': group_list, 'total_friend_requests': len(friend_request_list)})
 
-    # Fetch the friends
+def get_friend_balances(db: Session, user_id):
+    """Every friend with their net position towards `user_id` across all shared groups, biggest amounts first."""
     friend_list = (
-        db.query(User)
+        db.query(User.id, User.first_name, User.last_name)
         .join(Friends, Friends.friend_id == User.id)
-        .filter(Friends.user_id == current_user.get("user_id"))
+        .filter(Friends.user_id == user_id)
         .all()
     )
 
+    # A group never spans shards, so each shard's nets simply add up
+    nets = defaultdict(lambda: Money(0))
+    for shard_db in each_shard(db):
+        for other_id, net in user_net_balances(shard_db, user_id).items():
+            nets[other_id] += net
+
+    return sorted(
+        ({"user_id": friend.id, "first_name": friend.first_name, "last_name": friend.last_name, "net": nets.get(friend.id, Money(0))} for friend in friend_list),
+        key=lambda friend: (-abs(friend["net"]).paise, friend["first_name"] or "", friend["last_name"] or ""),
+    )
+
+@app.get("/friends")
+async def get_friends(request: Request, current_user= Depends(get_current_user),  db:Session = Depends(get_db)):
+
+    # Fetch the friends, with what each of them owes across the groups you share
+    friend_list = get_friend_balances(db, current_user.get("user_id"))
+
     friend_request_list = (
         db.query(FriendRequests.friend_request_id, User.first_name, User.last_name)
         .join(FriendRequests, FriendRequests.friend_request_id == User.id)
@@ -183,6 +278,16 @@ async def get_friends(request: Request, current_user= Depends(get_current_user),
 
     return templates.TemplateResponse('friends.html', context={'request': request, 'friend_list': friend_list, 'total_friend_requests': len(friend_request_list)})
 
+@app.get("/friends/balances")
+async def get_friends_balances(current_user= Depends(get_current_user), db:Session = Depends(get_db)):
+    # Positive: the friend owes you; negative: you owe them. In rupees, like /analytics/data
+    return {
+        "friends": [
+            {"user_id": friend["user_id"], "name": f"{friend['first_name']} {friend['last_name']}", "net": friend["net"].paise / 100}
+            for friend in get_friend_balances(db, current_user.get("user_id"))
+        ]
+    }
+
 @app.get("/friend-requests")
 async def get_friend_requests(request: Request, current_user= Depends(get_current_user),  db:Session = Depends(get_db)):
 
@@ -198,7 +303,25 @@ async def get_friend_requests(request: Request, current_user= Depends(get_curren
 @app.get("/search-friend")
 async def get_add_friend(request: Request, current_user= Depends(get_current_user),  db:Session = Depends(get_db)):
 
-    return templates.TemplateResponse('search-friend.html', context={'request': request, 'friend_list': []})
+    current_user_id = current_user.get("user_id")
+
+    # People with a request pending either way are already handled on the requests pages
+    pending = db.query(FriendRequests.friend_request_id, FriendRequests.user_id).filter(
+        or_(FriendRequests.friend_request_id == current_user_id, FriendRequests.user_id == current_user_id)
+    ).all()
+
+    # A rebuild reads every friendship and membership; keep it off the event loop
+    await run_in_threadpool(friend_graph.ensure_fresh, db)
+    suggestions = friend_graph.suggest(current_user_id, exclude=chain.from_iterable(pending))
+
+    users = {user.id: user for user in db.query(User.id, User.first_name, User.last_name).filter(User.id.in_([suggestion.user_id for suggestion in suggestions]))}
+    suggestion_list = [
+        {"user": users[suggestion.user_id], "mutual_friends": suggestion.mutual_friends, "shared_groups": suggestion.shared_groups}
+        for suggestion in suggestions
+        if suggestion.user_id in users
+    ]
+
+    return templates.TemplateResponse('search-friend.html', context={'request': request, 'friend_list': [], 'suggestions': suggestion_list})
 
 @app.post("/search-friend")
 async def search_friends(request: Request, current_user= Depends(get_current_user),  db:Session = Depends(get_db)):
@@ -224,90 +347,115 @@ async def search_friends(request: Request, current_user= Depends(get_current_use
 
 @app.get("/add-group")
 async def get_add_group(request: Request, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
-    return templates.TemplateResponse('add-group.html', context={'request': request})
+
+    # Friends can be added while creating the group
+    friends_list = (
+        db.query(Friends.user_id, User.first_name, User.last_name)
+        .join(Friends, Friends.user_id == User.id)
+        .filter(Friends.friend_id == current_user.get("user_id"))
+        .all()
+    )
+
+    return templates.TemplateResponse('add-group.html', context={'request': request, "friends": friends_list})
 
 @app.post("/add-group")
 async def add_group(request: Request, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
     form_data = await request.form()
 
-    group_name = form_data.get("group_name")
+    group_name = (form_data.get("group_name") or "").strip()
+    member_ids = form_data.getlist("members")
+    if not group_name:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Give the group a name.")
 
-    existing_groups = db.query(Group).filter(Group.name == group_name).all()
+    # Always a new group, even when the name is taken: joining someone else's group must go through its members.
+    # The global directory hands out the id and picks the shard.
+    group_id = register_group(db, group_name)
 
-    if not existing_groups:
-        # Add the new group
-        new_group = Group(name=group_name.strip())  # Strip whitespace
-        db.add(new_group)
-        db.commit()
-        db.refresh(new_group)
-
-        # Add the current user as a group member
-        new_group_member = GroupMember(group_id=new_group.id, user_id=current_user.get("user_id"))
-        db.add(new_group_member)
-        db.commit()
-        db.refresh(new_group_member)
-    else:
-        new_group = existing_groups[0]  # If group already exists, use it
+    # The group, its creator and the selected friends are written in one transaction on the group's shard
+    with group_session(group_id, db) as group_db:
+        new_group = Group(id=group_id, name=group_name)
+        group_db.add(new_group)
+        group_db.flush()
+        group_db.add(GroupMember(group_id=new_group.id, user_id=current_user.get("user_id")))
+        group_db.flush()
 
-        # Optionally, you can check if the user is already in the group before adding
-        existing_member = (
-            db.query(GroupMember)
-            .filter(GroupMember.group_id == new_group.id, GroupMember.user_id == current_user.get("user_id"))
-            .first()
-        )
-        if not existing_member:
-            new_group_member = GroupMember(group_id=new_group.id, user_id=current_user.get("user_id"))
-            db.add(new_group_member)
-            db.commit()
-            db.refresh(new_group_member)
+        add_group_members(group_db, new_group.id, member_ids, current_user.get("user_id"))
+        group_db.commit()
+    invalidate_membership(group_id)
+    friend_graph.group_changed(group_id)
 
     response = RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
     return response
 
-@app.get("/view-group/{group_id}")
-async def get_view_group(request: Request, group_id: str, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-
+def get_group_transactions(db: Session, group_id, expense_model=Expense, split_model=ExpenseSplit):
+    # Works on the hot tables by default and on the archive tables for compacted history
     user_alias = aliased(User, name="expense_split_user")
-
-    # Check if the current user has any entries in the ExpenseSplit table for the given group
-    user_expense_splits = db.query(ExpenseSplit).join(Expense).filter(
-        Expense.group_id == group_id,
-        ExpenseSplit.user_id == int(current_user.get("user_id"))
-    ).all()
-
-    # If no records found in ExpenseSplit for the current user, return blank data
-    if not user_expense_splits:
-        return templates.TemplateResponse('view-group.html', context={'request': request, "group_id": group_id, "data_list": {}, "total_paid_by_user": 0})
-
-
-    result = db.query(
-        Expense.expense_id.label("expense_id"), 
-        Expense.group_id.label("group_id"), 
-        Expense.description.label("description"), 
-        Expense.amount.label("amount"),
-        Expense.paid_by.label("paid_by"), 
-        Expense.split_type.label("split_type"), 
-        Expense.created_by.label("created_by"), 
+    conditions = [expense_model.group_id == group_id]
+    if expense_model is Expense:
+        # Archived expenses are never deleted ones, and the archive has no tombstone column
+        conditions.append(Expense.deleted_at.is_(None))
+
+    return db.query(
+        expense_model.expense_id.label("expense_id"), 
+        expense_model.group_id.label("group_id"), 
+        expense_model.description.label("description"), 
+        expense_model.amount.label("amount"),
+        expense_model.paid_by.label("paid_by"), 
+        expense_model.split_type.label("split_type"), 
+        expense_model.created_by.label("created_by"), 
         User.first_name.label("paid_by_first_name"),
         User.last_name.label("paid_by_last_name"),
-        ExpenseSplit.share.label("share"),
-        Expense.created_at.label("created_at"),
+        split_model.share.label("share"),
+        expense_model.created_at.label("created_at"),
         user_alias.id,
         user_alias.first_name.label("expense_split_first_name"),
         user_alias.last_name.label("expense_split_last_name")
     ).join(
-        ExpenseSplit, ExpenseSplit.expense_id == Expense.expense_id
+        split_model, split_model.expense_id == expense_model.expense_id
     ).join(
-        User, Expense.paid_by == User.id
+        User, expense_model.paid_by == User.id
     ).join(
-        user_alias, ExpenseSplit.user_id == user_alias.id
+        user_alias, split_model.user_id == user_alias.id
     ).filter(
-        Expense.group_id == group_id
+        *conditions
     ).order_by(
-        desc(Expense.created_at)
+        desc(expense_model.created_at)
+    ).all()
+
+@app.get("/view-group/{group_id}")
+async def get_view_group(request: Request, group_id: int, include_archived: bool = False, deleted: Optional[int] = None, membership=Depends(get_group_membership), current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+
+    # Archived history is only read when asked for
+    has_archive = latest_checkpoint(db, group_id) is not None
+    group_version = membership.version
+
+    # Right after a delete, offer to undo it
+    undo_expense = None
+    if deleted is not None:
+        undo_expense = db.query(Expense.expense_id, Expense.description).filter(
+            Expense.expense_id == deleted,
+            Expense.group_id == group_id,
+            Expense.deleted_at.isnot(None)
+        ).first()
+
+    # Check if the current user has any entries in the ExpenseSplit table for the given group
+    user_expense_splits = db.query(ExpenseSplit).join(Expense).filter(
+        Expense.group_id == group_id,
+        Expense.deleted_at.is_(None),
+        ExpenseSplit.user_id == int(current_user.get("user_id"))
     ).all()
 
+    # If no records found in ExpenseSplit for the current user, return blank data
+    if not user_expense_splits and not include_archived:
+        return templates.TemplateResponse('view-group.html', context={'request': request, "group_id": group_id, "data_list": {}, "total_paid_by_user": Money(0), "has_archive": has_archive, "include_archived": include_archived, "group_version": group_version, "undo_expense": undo_expense, "current_user": current_user})
+
+
+    result = get_group_transactions(db, group_id)
+    if include_archived:
+        result += get_group_transactions(db, group_id, ExpenseArchive, ExpenseSplitArchive)
+        result.sort(key=lambda row: row.created_at, reverse=True)
+
     # Fetch the total amount paid by the current user in settlements
     total_paid_by_user = db.query(
         func.sum(Settlement.amount).label("total_paid")
@@ -319,7 +467,7 @@ async def get_view_group(request: Request, group_id: str, current_user=Depends(g
     ).scalar()  # `scalar()` gives the single value
 
     # If no amount has been paid, set to 0
-    total_paid_by_user = total_paid_by_user or 0
+    total_paid_by_user = total_paid_by_user or Money(0)
 
     grouped_data = defaultdict(list)
 
@@ -384,155 +532,139 @@ async def get_view_group(request: Request, group_id: str, current_user=Depends(g
                 "created_by": created_by
             })
 
-    return templates.TemplateResponse('view-group.html', context={'request': request, "group_id": group_id, "data_list": grouped_data, "total_paid_by_user": total_paid_by_user})
+    return templates.TemplateResponse('view-group.html', context={'request': request, "group_id": group_id, "data_list": grouped_data, "total_paid_by_user": total_paid_by_user, "has_archive": has_archive, "include_archived": include_archived, "group_version": group_version, "undo_expense": undo_expense, "current_user": current_user})
 
 @app.get("/add-expense/{group_id}")
-async def get_add_expense(request: Request, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_add_expense(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user)):
 
-    group_details = (
-        db.query(Group.id, Group.name, User.first_name, User.last_name, GroupMember.user_id)
-        .join(GroupMember, GroupMember.group_id == Group.id)
-        .join(User, User.id == GroupMember.user_id)
-        .filter(Group.id == group_id)
-        .all()
-    )
-
-    return templates.TemplateResponse('add-expense.html', context={'request': request, "current_user": current_user, "group_id": group_id, "group_members": group_details})
+    return templates.TemplateResponse('add-expense.html', context={'request': request, "current_user": current_user, "group_id": group_id, "group_members": membership.members})
 
 @app.post("/add-expense/{group_id}")
-async def add_expense(request: Request, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def add_expense(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
     form_data = await request.form()
-    print(form_data)
     expense_description = form_data.get("expense_description")
-    expense_amount = float(form_data.get("expense_amount")) if form_data.get("expense_amount") else 0
     expense_paid_by = form_data.get("expense_paid_by")
     expense_split_amoung = form_data.getlist("expense_split_amoung[]")
-    expense_split_type = form_data.get("split_type")
+    expense_split_values = form_data.getlist("expense_split_values[]")
     expense_date = form_data.get("expense_date")
-    expense_ratios = form_data.getlist("expense_ratios[]")
-    expense_exact_shares = form_data.getlist("expense_exact_shares[]")
+    expense_repeat = form_data.get("expense_repeat")
     current_user_id = current_user.get("user_id")
 
-    if expense_split_type == "ratio" and not expense_ratios:
-        raise HTTPException(status_code=400, detail="Ratios must be provided when split type is 'ratio'.")
-
-    if expense_split_type == "ratio":
-        ratios = list(map(int, expense_ratios))
-        if sum(ratios) != 100:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"The sum of the ratios must equal 100. Current sum: {sum(ratios)}"
-            )
-
-    expense_ratio_per_user = {}
-    if expense_split_type == "ratio":
-        for user_id, ratio in zip(expense_split_amoung, expense_ratios):
-            expense_ratio_per_user[int(user_id)] = float(ratio)
-    elif expense_split_type == "exact" and expense_exact_shares:
-        for user_id, share in zip(expense_split_amoung, expense_exact_shares):
-            expense_ratio_per_user[int(user_id)] = float(share)
+    try:
+        expense_split_type = normalize_split_type(form_data.get("split_type"))
+        expense_amount = Money.parse(form_data.get("expense_amount"))
+        if expense_amount <= Money(0):
+            raise ValueError("Amount must be greater than zero.")
+        # Receipt lines of an itemized split; an item with nobody ticked is shared by everyone
+        expense_items = [
+            (Money.parse(item_amount), [int(user_id) for user_id in form_data.getlist(f"expense_item_members[{index}][]")])
+            for index, item_amount in enumerate(form_data.getlist("expense_item_amounts[]"))
+        ]
+
+        # Every split type works on the selected members, or on the whole group when nobody is selected
+        member_ids = [int(user_id) for user_id in expense_split_amoung] or sorted(membership.member_ids)
+        plan = plan_split(expense_amount, expense_split_type, member_ids, expense_split_values, expense_items)
+        if not all(membership.is_member(user_id) for user_id in [expense_paid_by, *plan.member_ids]):
+            raise ValueError("Expenses can only be paid by and split among members of the group.")
+        member_shares = allocate_splits([plan])[0]
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
     if expense_date:
         try:
             expense_date = datetime.strptime(expense_date, "%Y-%m-%dT%H:%M")
         except ValueError:
             return {"error": "Invalid date format. Please use the correct format."}
-    
-        new_expense = Expense(
-            group_id = group_id,
-            description = expense_description,
-            amount = expense_amount,
-            paid_by = expense_paid_by,
-            split_type = expense_split_type,
-            created_by = current_user_id,
-            created_at = expense_date
-        )
-    else:
-        new_expense = Expense(
+
+    new_expense = {
+        "group_id": group_id,
+        "description": expense_description,
+        "amount": expense_amount,
+        "paid_by": expense_paid_by,
+        "split_type": expense_split_type,
+        "created_by": current_user_id,
+        "splits": member_shares
+    }
+    if expense_date:
+        new_expense["created_at"] = expense_date
+
+    recurring_expense = None
+    # Repeating expenses: this one is occurrence 0, the scheduler creates the rest
+    if expense_repeat in ("day", "week", "month"):
+        starts_at = expense_date or datetime.now()
+        recurring_expense = RecurringExpense(
             group_id = group_id,
             description = expense_description,
             amount = expense_amount,
             paid_by = expense_paid_by,
             split_type = expense_split_type,
+            split_spec = json.dumps({
+                "members": [int(member_id) for member_id in expense_split_amoung],
+                "values": expense_split_values,
+                "items": [[str(item_amount), item_member_ids] for item_amount, item_member_ids in expense_items]
+            }),
+            interval_unit = expense_repeat,
+            interval_count = 1,
+            starts_at = starts_at,
+            occurrences = 1,
+            next_run_at = occurrence_at(starts_at, expense_repeat, 1, 1),
             created_by = current_user_id
         )
-    db.add(new_expense)
-    db.commit()
-
-    if not expense_split_amoung:
-        if expense_split_type != "equal":
-            raise HTTPException(
-        status_code=400,
-        detail="When no users are selected for splitting the expense, a valid split type (either 'ratio' or 'exact') must be used, and the corresponding data must be provided."
-    )
 
-        group_member_ids = [group_member.user_id for group_member in db.query(GroupMember.user_id).filter(GroupMember.group_id == group_id).all()]
-        print(group_member_ids)
-        for member in group_member_ids:
-            member_share = 0
-            if expense_split_type == "equal":
-                print("added expense for user id", member)
-                member_share = expense_amount / len(group_member_ids)
-                new_expense_split = ExpenseSplit(
-                    expense_id = new_expense.expense_id,
-                    user_id = int(member),
-                    share = member_share,
-                    ratio = 0
-                )
-                db.add(new_expense_split)
-                db.commit()
-        
-        response = RedirectResponse(url=f"/view-group/{group_id}", status_code=status.HTTP_303_SEE_OTHER)
-        return response
+    def write(db):
+        insert_expenses(db, [new_expense])
+        if recurring_expense is not None:
+            db.add(recurring_expense)
 
-    for member in expense_split_amoung:
-        member_share = 0
-        if expense_split_type == "equal":
-            print("adding expense for user id", member)
-            member_share = expense_amount / len(expense_split_amoung)
-            new_expense_split = ExpenseSplit(
-                expense_id = new_expense.expense_id,
-                user_id = int(member),
-                share = member_share,
-                ratio = 0
-            )
-            db.add(new_expense_split)
-            db.commit()
-        
-        elif expense_split_type == "ratio":
-            ratio = expense_ratio_per_user[int(member)]
-            member_share = (expense_amount * ratio) / 100  # Proportional to the ratio
-            new_expense_split = ExpenseSplit(
-                expense_id = new_expense.expense_id,
-                user_id = int(member),
-                share = member_share,
-                ratio = ratio  # Storing the ratio here
-            )
-            db.add(new_expense_split)
-            db.commit()
-
-        elif expense_split_type == "exact":
-            # For 'exact' split, use the exact share per user
-            member_share = expense_ratio_per_user[int(member)]
-            new_expense_split = ExpenseSplit(
-                expense_id = new_expense.expense_id,
-                user_id = int(member),
-                share = member_share,
-                ratio = 0  # Not used for 'exact' split
-            )
-            db.add(new_expense_split)
-            db.commit()
-        
+    await commit_write(db, shard_of(group_id), write)
 
     response = RedirectResponse(url=f"/view-group/{group_id}", status_code=status.HTTP_303_SEE_OTHER)
     return response
 
+@app.get("/import-expenses/{group_id}")
+async def get_import_expenses(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user)):
+    return templates.TemplateResponse('import-expenses.html', context={'request': request, "group_id": group_id})
+
+@app.post("/import-expenses/{group_id}")
+async def import_expenses(request: Request, group_id: int, file: UploadFile = File(...), membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+
+    file_format = "json" if (file.filename or "").lower().endswith((".json", ".jsonl", ".ndjson")) else "csv"
+
+    # Keep the upload on disk so the import runs after the response and can be resumed
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    fd, source_path = tempfile.mkstemp(dir=IMPORT_DIR, suffix=f".{file_format}")
+    size = 0
+    with os.fdopen(fd, "wb") as target:
+        while chunk := await file.read(1024 * 1024):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                break
+            target.write(chunk)
+    if size > MAX_UPLOAD_BYTES:
+        os.remove(source_path)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="The file is too large to import.")
+
+    job = start_import(db, group_id, current_user.get("user_id"), source_path, file_format)
+    # Not a background task: those run before the response completes, holding the route's admission slot throughout
+    submit_import_job(group_id, job.job_id)
+
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={**import_job_summary(job), "status_url": f"/import-expenses/{group_id}/status/{job.job_id}"})
+
+@app.get("/import-expenses/{group_id}/status/{job_id}")
+async def import_expenses_status(request: Request, group_id: int, job_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+
+    # Job ids are per shard, so a job is only found under its own group
+    job = db.get(ImportJob, job_id)
+    if job is None or job.group_id != group_id or job.created_by != current_user.get("user_id"):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Import not found.")
+
+    return import_job_summary(job)
+
 @app.get("/add-member/{group_id}")
-async def get_add_meber(request: Request, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_add_meber(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
-    # Get all friend user IDs as a flat list
-    group_members_ids = [group_member.user_id for group_member in db.query(GroupMember.user_id).filter(GroupMember.group_id == group_id).all()]
+    group_members_ids = list(membership.member_ids)
 
     current_user_id = current_user.get('user_id')
 
@@ -552,45 +684,48 @@ async def get_add_meber(request: Request, group_id: int, current_user= Depends(g
     return templates.TemplateResponse('add-member.html', context={'request': request, "current_user": current_user, "group_id": group_id, "friends": friends_list})
 
 @app.post("/add-member/{group_id}")
-async def add_member(request: Request, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def add_member(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
     form_data = await request.form()
 
-    for member_id in form_data.get("members"):
-        new_member = GroupMember(
-            group_id = group_id,
-            user_id = member_id
-        )
+    member_ids = form_data.getlist("members")
 
-        db.add(new_member)
-        db.commit()
-        db.refresh(new_member)
+    # Every selected friend in one statement; anyone already in the group is skipped
+    await commit_write(db, shard_of(group_id), lambda db: add_group_members(db, group_id, member_ids, current_user.get("user_id")))
+    invalidate_membership(group_id)
+    friend_graph.group_changed(group_id)
 
     response = RedirectResponse(url=f"/view-group/{group_id}", status_code=status.HTTP_303_SEE_OTHER)
     return response
 
 @app.get("/view-members/{group_id}")
-async def view_members(request: Request, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
-
-    group_members = db.query(GroupMember.user_id, User.first_name, User.last_name).join(GroupMember, GroupMember.user_id == User.id).filter(GroupMember.group_id == group_id).all()
+async def view_members(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user)):
 
-    return templates.TemplateResponse('view-members.html', context={'request': request, "current_user": current_user, "group_id": group_id, "members": group_members})
+    return templates.TemplateResponse('view-members.html', context={'request': request, "current_user": current_user, "group_id": group_id, "group_version": membership.version, "members": membership.members})
 
 @app.get("/remove-members/{group_id}/{user_id}")
-async def view_members(request: Request, user_id: int, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def remove_member(request: Request, user_id: int, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
-    db.query(GroupMember).filter(
-        and_(
-            GroupMember.group_id == group_id,
-            GroupMember.user_id == user_id
-        )
-        ).delete()
-    
+    return _remove_members(db, group_id, [user_id], current_user)
+
+@app.post("/remove-members/{group_id}")
+async def remove_members(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+
+    form_data = await request.form()
+
+    return _remove_members(db, group_id, form_data.getlist("members"), current_user)
+
+def _remove_members(db: Session, group_id, user_ids, current_user):
+    remove_group_members(db, group_id, user_ids)
     db.commit()
-    
-    group_members = db.query(GroupMember.user_id, User.first_name, User.last_name).join(GroupMember, GroupMember.user_id == User.id).filter(GroupMember.group_id == group_id).all()
+    invalidate_membership(group_id)
+    friend_graph.group_changed(group_id)
 
-    return templates.TemplateResponse('view-members.html', context={'request': request, "current_user": current_user, "group_id": group_id, "members": group_members})
+    # Removing yourself is leaving the group, so there is nothing left to show
+    if current_user.get("user_id") in {int(user_id) for user_id in user_ids}:
+        return RedirectResponse(url=f"/", status_code=status.HTTP_303_SEE_OTHER)
+
+    return RedirectResponse(url=f"/view-members/{group_id}", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @app.post("/send-friend-request/{friend_request_id}")
@@ -611,27 +746,21 @@ async def send_friend_request(request: Request, friend_request_id: int, current_
 @app.post("/accept-friend-request/{friend_request_id}")
 async def accept_friend_request(request: Request, friend_request_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
-    new_friend = Friends(
-        friend_id = friend_request_id,
-        user_id = current_user.get("user_id")
-    )
+    # Both friendship rows and the request removal commit together
+    new_friends = await commit_write(db, 0, lambda db: accept_friend_requests(db, current_user.get("user_id"), [friend_request_id]))
+    friend_graph.friendships_added(current_user.get("user_id"), new_friends)
 
-    db.add(new_friend)
-    db.commit()
-    db.refresh(new_friend)
+    response = RedirectResponse(url=f"/friends", status_code=status.HTTP_303_SEE_OTHER)
+    return response
 
-    friend = Friends(
-        friend_id = current_user.get("user_id"),
-        user_id = friend_request_id
-    )
+@app.post("/accept-friend-requests")
+async def accept_selected_friend_requests(request: Request, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
-    db.add(friend)
-    db.commit()
-    db.refresh(friend)
+    form_data = await request.form()
 
-    # Remove friend request
-    db.query(FriendRequests).filter(FriendRequests.friend_request_id == friend_request_id).delete()
+    new_friends = accept_friend_requests(db, current_user.get("user_id"), form_data.getlist("friend_request_ids"))
     db.commit()
+    friend_graph.friendships_added(current_user.get("user_id"), new_friends)
 
     response = RedirectResponse(url=f"/friends", status_code=status.HTTP_303_SEE_OTHER)
     return response
@@ -639,39 +768,60 @@ async def accept_friend_request(request: Request, friend_request_id: int, curren
 @app.post("/reject-friend-request/{friend_request_id}")
 async def reject_friend_request(request: Request, friend_request_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
-    # Remove friend request
-    db.query(FriendRequests).filter(FriendRequests.friend_request_id == friend_request_id).delete()
+    # Only the request sent to the current user, not every request from that sender
+    reject_friend_requests(db, current_user.get("user_id"), [friend_request_id])
+    db.commit()
+
+    response = RedirectResponse(url=f"/friends", status_code=status.HTTP_303_SEE_OTHER)
+    return response
+
+@app.post("/reject-friend-requests")
+async def reject_selected_friend_requests(request: Request, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+
+    form_data = await request.form()
+
+    reject_friend_requests(db, current_user.get("user_id"), form_data.getlist("friend_request_ids"))
     db.commit()
 
     response = RedirectResponse(url=f"/friends", status_code=status.HTTP_303_SEE_OTHER)
     return response
 
 @app.get("/leave-group/{group_id}")
-async def leave_group(request: Request, group_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def leave_group(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
 
-    # Remove friend request
-    db.query(GroupMember).filter(
-        and_(
-            GroupMember.group_id == group_id,
-            GroupMember.user_id == current_user.get("user_id")
-        )
-    ).delete()
+    # Remove the membership
+    remove_group_members(db, group_id, [current_user.get("user_id")])
     db.commit()
+    invalidate_membership(group_id)
+    friend_graph.group_changed(group_id)
 
     response = RedirectResponse(url=f"/", status_code=status.HTTP_303_SEE_OTHER)
     return response
 
-@app.get("/delete-expense/{group_id}/{expense_id}")
-async def delete_expense(request: Request, group_id: int, expense_id: int, current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+async def _expense_id_from_form(request: Request):
+    form_data = await request.form()
+    try:
+        return int(form_data.get("expense_id"))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid expense.")
 
-    db.query(ExpenseSplit).filter(
-        ExpenseSplit.expense_id == expense_id
-    ).delete()
-    db.commit()
+@app.post("/delete-expense/{group_id}")
+async def delete_expense(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+    expense_id = await _expense_id_from_form(request)
+
+    # Only expenses of this group, which the caller is a member of; the row stays restorable for a while
+    deleted = await commit_write(db, shard_of(group_id), lambda db: delete_expenses(db, group_id, [expense_id]))
 
-    db.query(Expense).filter(
-        Expense.expense_id == expense_id
-    ).delete()
+    url = f"/view-group/{group_id}?deleted={expense_id}" if deleted else f"/view-group/{group_id}"
+    response = RedirectResponse(url=url, status_code=status.HTTP_303_SEE_OTHER)
+    return response
+
+@app.post("/restore-expense/{group_id}")
+async def restore_expense(request: Request, group_id: int, membership=Depends(get_group_membership), current_user= Depends(get_current_user), db: Session = Depends(get_db)):
+    expense_id = await _expense_id_from_form(request)
+
+    # A no-op once the undo window has passed or the expense was purged
+    restore_expenses(db, group_id, [expense_id])
     db.commit()
 
     response = RedirectResponse(url=f"/view-group/{group_id}", status_code=status.HTTP_303_SEE_OTHER)
@@ -691,21 +841,159 @@ async def get_accounts(request: Request, current_user=Depends(get_current_user),
 
     return templates.TemplateResponse("accounts.html", {"request": request, "user": user, 'total_friend_requests': len(friend_request_list)})
 
+@app.get("/analytics")
+async def get_analytics(request: Request, group_id: Optional[int] = None, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+
+    group_list = [
+        group
+        for shard_db in each_shard(db)
+        for group in (
+            shard_db.query(Group.id, Group.name)
+            .join(GroupMember, GroupMember.group_id == Group.id)
+            .filter(GroupMember.user_id == current_user.get("user_id"))
+            .all()
+        )
+    ]
+
+    return templates.TemplateResponse("analytics.html", {"request": request, "group_list": group_list, "group_id": group_id})
+
+@app.get("/analytics/data")
+async def get_analytics_data(
+    group_id: Optional[int] = None,
+    from_month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    to_month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    current_user=Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    user_id = current_user.get("user_id")
+
+    # Answered from the monthly rollups only; the expense tables are never scanned here
+    if group_id is None:
+        # The current user's own spending, split by group
+        rows, names = [], {}
+        for shard_db in each_shard(db):
+            shard_rows = user_rollups(shard_db, user_id, from_month, to_month)
+            names.update(shard_db.query(Group.id, Group.name).filter(Group.id.in_({row.group_id for row in shard_rows})).all())
+            rows += shard_rows
+        return {"group_id": None, **rollup_series(rows, "group_id", names)}
+
+    # One group, split by member; group_id is a query parameter here, so pick its shard explicitly
+    with group_session(group_id, db) as group_db:
+        membership = load_membership(group_db, group_id)
+        if membership is None or not membership.is_member(user_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found.")
+        rows = group_rollups(group_db, group_id, from_month, to_month)
+    # Former members keep their history, so names come from the rows rather than the member list
+    names = {user.id: f"{user.first_name} {user.last_name}" for user in db.query(User.id, User.first_name, User.last_name).filter(User.id.in_({row.user_id for row in rows}))}
+    return {"group_id": group_id, **rollup_series(rows, "user_id", names)}
+
+@app.get("/search")
+async def get_search(request: Request, group_id: Optional[int] = None, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+
+    group_list = [
+        group
+        for shard_db in each_shard(db)
+        for group in (
+            shard_db.query(Group.id, Group.name)
+            .join(GroupMember, GroupMember.group_id == Group.id)
+            .filter(GroupMember.user_id == current_user.get("user_id"))
+            .all()
+        )
+    ]
+    # Payer and participant can be you or any of your friends
+    people = (
+        db.query(User.id, User.first_name, User.last_name)
+        .join(Friends, Friends.friend_id == User.id)
+        .filter(Friends.user_id == current_user.get("user_id"))
+        .all()
+    )
+
+    return templates.TemplateResponse("search-expenses.html", {"request": request, "group_list": group_list, "group_id": group_id, "people": people, "user_id": current_user.get("user_id")})
+
+@app.get("/search/data")
+async def get_search_data(
+    group_id: Optional[int] = None,
+    q: Optional[str] = Query(None, max_length=200),
+    min_amount: Optional[str] = None,
+    max_amount: Optional[str] = None,
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    paid_by: Optional[int] = None,
+    participant: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user=Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    user_id = current_user.get("user_id")
+    try:
+        search_filter = expense_conditions(
+            q,
+            Money.parse(min_amount) if min_amount else None,
+            Money.parse(max_amount) if max_amount else None,
+            from_date, to_date, paid_by, participant,
+        )
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    # Each shard returns its own newest matches (one more than a page, to know whether there is a next one)
+    results = []
+    if group_id is None:
+        # Every group of the current user
+        for shard_db in each_shard(db):
+            group_ids = [row.group_id for row in shard_db.query(GroupMember.group_id).filter(GroupMember.user_id == user_id)]
+            results += search_results(shard_db, search_keys(shard_db, group_ids, search_filter, after, limit + 1))
+    else:
+        # One group; group_id is a query parameter here, so pick its shard explicitly
+        with group_session(group_id, db) as group_db:
+            membership = load_membership(group_db, group_id)
+            if membership is None or not membership.is_member(user_id):
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found.")
+            results = search_results(group_db, search_keys(group_db, [group_id], search_filter, after, limit + 1))
+
+    page, next_cursor = paginate(results, limit)
+    return {
+        "group_id": group_id,
+        "results": [
+            {
+                "expense_id": key.expense_id,
+                "group_id": key.group_id,
+                "group_name": row.group_name,
+                "description": row.description,
+                "amount": row.amount.paise / 100 if row.amount is not None else None,
+                "paid_by": row.paid_by,
+                "paid_by_name": f"{row.first_name} {row.last_name}" if row.first_name is not None else None,
+                "created_at": row.created_at.isoformat(),
+            }
+            for key, row in page
+        ],
+        "next_cursor": next_cursor,
+    }
+
 @app.get("/view-report/{group_id}")
-async def view_report(request: Request, group_id: int, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+def view_report(request: Request, group_id: int, include_archived: bool = False, membership=Depends(get_group_membership), current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+    # Rendering runs in the threadpool (plain def) so it never blocks the event loop; its budget caps how many run at once
+    # reportlab is only needed here, so workers don't pay for importing it at startup
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
 
     # Fetch the current user
     user_id = current_user.get('user_id')
 
     # Fetch all expenses for the group where the current user is involved (either as 'paid_by' or in 'ExpenseSplit')
-    expenses = db.query(Expense).filter(Expense.group_id == group_id).all()
+    expenses = db.query(Expense).filter(Expense.group_id == group_id, Expense.deleted_at.is_(None)).all()
 
     # Fetch all expense splits for the group
     expense_splits = db.query(ExpenseSplit).filter(ExpenseSplit.expense_id.in_([expense.expense_id for expense in expenses])).all()
 
-    # Fetch all users and group members
-    users = db.query(User).all()
-    group_members = db.query(GroupMember).filter(GroupMember.group_id == group_id).all()
+    # Compacted history lives in the archive tables and is only listed on demand
+    if include_archived:
+        archived_expenses = db.query(ExpenseArchive).filter(ExpenseArchive.group_id == group_id).all()
+        expenses = archived_expenses + expenses
+        expense_splits += db.query(ExpenseSplitArchive).filter(ExpenseSplitArchive.expense_id.in_([expense.expense_id for expense in archived_expenses])).all()
+
+    group_members = membership.members
 
     # Create a PDF canvas
     buffer = BytesIO()
@@ -726,11 +1014,10 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
 
     # Group Details Section
     pdf.setFont("Helvetica", 12)
-    y_position = add_text_line(pdf, f"Group Name: Aarcity 1601", margin, y_position)
+    y_position = add_text_line(pdf, f"Group Name: {membership.name}", margin, y_position)
     y_position = add_text_line(pdf, f"Members:", margin, y_position)
     for member in group_members:
-        member_user = db.query(User).filter(User.id == member.user_id).first()
-        y_position = add_text_line(pdf, f"• {member_user.first_name} {member_user.last_name}", margin, y_position)
+        y_position = add_text_line(pdf, f"• {member.first_name} {member.last_name}", margin, y_position)
     y_position = add_text_line(pdf, f"Date: 25th Nov 2024 - 25th Dec 2024", margin, y_position)
 
     # Summary Boxes
@@ -753,33 +1040,10 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
     # pdf.drawString(395, y_position - 60, f"Gunjan: 123456")
     # pdf.drawString(395, y_position - 80, f"Sudhir: 123456")
     # pdf.drawString(395, y_position - 100, f"Yash: 123456")
-    # Draw the summary box for total spent and owed amounts
-    # Initialize data for tracking user expenses and calculations
-    total_spent_by_user = 0
-    user_expense_data = {user.id: {"pay": 0, "owed": 0, "share": 0} for user in users}
-
-    # Track payments and splits for the current user
-    for expense in expenses:
-        # Check if the current user paid this expense
-        if expense.paid_by == user_id:
-            total_spent_by_user += expense.amount
-        
-        # Loop through splits to calculate how much each user owes or needs to pay
-        for split in expense_splits:
-            if split.expense_id == expense.expense_id:
-                if split.user_id == user_id:
-                    user_expense_data[user_id]["share"] += split.share
-                    # If the user is the payer, they have already paid, so they should receive money from others
-                    if expense.paid_by != user_id:
-                        user_expense_data[expense.paid_by]["pay"] += split.share
-                else:
-                    # If the user is not the one who split the expense, check how much they owe
-                    if expense.paid_by == user_id:
-                        user_expense_data[split.user_id]["owed"] += split.share
-                    else:
-                        user_expense_data[split.user_id]["share"] += split.share
-
-    actual_spent = user_expense_data[user_id]["share"]
+    # Paid / owed / pairwise positions for the whole group from the shared balance engine
+    balances = load_group_balances(db, group_id, [member.user_id for member in group_members])
+    total_spent_by_user = balances.paid_by(user_id)
+    actual_spent = balances.owed_by(user_id)
             
     # Draw the summary box for total spent and owed amounts
     pdf.rect(50, y_position - 120, 150, 120, stroke=1, fill=0)
@@ -793,10 +1057,9 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
     height = 0
     # Show how much the current user needs to give to others
     for member in group_members:
-        member_user = db.query(User).filter(User.id == member.user_id).first()
-        if member_user.id != user_id:  # Don't include yourself in this section
-            share = user_expense_data[member_user.id]["pay"]
-            pdf.drawString(220, y_position - 40 - height, f"{member_user.first_name}: {share:.2f}")
+        if member.user_id != user_id:  # Don't include yourself in this section
+            share = balances.owes(user_id, member.user_id)
+            pdf.drawString(220, y_position - 40 - height, f"{member.first_name}: {share:.2f}")
             height += 20
 
     pdf.rect(385, y_position - 120, 165, 120, stroke=1, fill=0)
@@ -805,10 +1068,9 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
     height = 0
     # Show how much others owe to the current user
     for member in group_members:
-        member_user = db.query(User).filter(User.id == member.user_id).first()
-        if member_user.id != user_id:  # Don't include yourself in this section
-            owed = user_expense_data[member_user.id]["owed"]
-            pdf.drawString(395, y_position - 40 - height, f"{member_user.first_name}: {owed:.2f}")
+        if member.user_id != user_id:  # Don't include yourself in this section
+            owed = balances.owes(member.user_id, user_id)
+            pdf.drawString(395, y_position - 40 - height, f"{member.first_name}: {owed:.2f}")
             height += 20
 
     # Adjust the position for the Description section
@@ -828,14 +1090,10 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
 
     y_position -= 20  # Move below header row
 
-    try:
-        [share for share in db.query(ExpenseSplit.share).filter(
-            and_(
-                ExpenseSplit.expense_id == expense.expense_id,
-                ExpenseSplit.user_id == user_id
-            )
-            ).first()][0]
-    except:
+    # The current user's share of each expense they are part of
+    user_shares = {split.expense_id: split.share for split in expense_splits if split.user_id == user_id}
+
+    if not user_shares:
         print(f"No expense avalaible for the user {current_user.get('first_name')} {current_user.get('last_name')}")
         # Save the PDF to the buffer
         pdf.save()
@@ -852,6 +1110,9 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
     # Add Expenses
     pdf.setFont("Helvetica", 10)
     for expense in expenses:
+        if expense.expense_id not in user_shares:
+            continue
+
         if y_position < 100:  # Check if the page is full and needs a new one
             pdf.showPage()  # Add a new page
             y_position = height - 50  # Reset y_position for the new page
@@ -874,12 +1135,7 @@ async def view_report(request: Request, group_id: int, current_user=Depends(get_
         y_position = add_text_line(pdf, expense.split_type.capitalize(), margin + col_widths[0] + col_widths[1] + col_widths[2] + col_widths[3], y_position + 16)
         
         # Add the expense split data for this expense
-        share = [share for share in db.query(ExpenseSplit.share).filter(
-            and_(
-                ExpenseSplit.expense_id == expense.expense_id,
-                ExpenseSplit.user_id == user_id
-            )
-            ).first()][0]
+        share = user_shares[expense.expense_id]
         y_position = add_text_line(pdf, f"{share:.2f}", margin + col_widths[0] + col_widths[1] + col_widths[2] + col_widths[3] + col_widths[4], y_position + 16)
 
 
@@ -0,0 +1,266 @@
+from itertools import chain
+import numpy as np
+from sqlalchemy import text
+from money import Money
+
+GROUP_SPLITS_SQL = """
+    SELECT e.paid_by, s.user_id, s.share
+    FROM tbl_expense_split_table s
+    JOIN tbl_expenses e ON e.expense_id = s.expense_id
+    WHERE e.group_id = :group_id AND e.deleted_at IS NULL AND e.paid_by IS NOT NULL AND s.share IS NOT NULL
+"""
+
+GROUP_SETTLEMENTS_SQL = """
+    SELECT payer_id, payee_id, amount
+    FROM tbl_settlements
+    WHERE group_id = :group_id AND amount IS NOT NULL
+"""
+
+GROUP_SNAPSHOT_SQL = """
+    SELECT payer_id, user_id, amount
+    FROM tbl_balance_snapshot
+    WHERE kind = :kind AND checkpoint_id = (
+        SELECT MAX(checkpoint_id) FROM tbl_balance_checkpoint WHERE group_id = :group_id
+    )
+"""
+
+# A user's position towards everyone they share a group with, as (group_id, other user, signed paise) rows:
+# positive amounts are owed to the user, negative ones by them. Each part is summed per (group, other user)
+# in SQLite, so only a few rows per shared group reach Python however long the history is.
+# Expenses are read by participant and by payer through their own indexes; an OR across the join would scan every split.
+USER_SPLITS_SQL = """
+    SELECT e.group_id, e.paid_by, -SUM(s.share)
+    FROM tbl_expense_split_table s
+    JOIN tbl_expenses e ON e.expense_id = s.expense_id
+    WHERE s.user_id = :user_id AND e.paid_by != :user_id AND e.deleted_at IS NULL AND s.share IS NOT NULL
+    GROUP BY e.group_id, e.paid_by
+    UNION ALL
+    SELECT e.group_id, s.user_id, SUM(s.share)
+    FROM tbl_expenses e
+    JOIN tbl_expense_split_table s ON s.expense_id = e.expense_id
+    WHERE e.paid_by = :user_id AND s.user_id != :user_id AND e.deleted_at IS NULL AND s.share IS NOT NULL
+    GROUP BY e.group_id, s.user_id
+"""
+
+USER_SETTLEMENTS_SQL = """
+    SELECT group_id, payee_id, SUM(amount)
+    FROM tbl_settlements
+    WHERE payer_id = :user_id AND payee_id != :user_id AND amount IS NOT NULL
+    GROUP BY group_id, payee_id
+    UNION ALL
+    SELECT group_id, payer_id, -SUM(amount)
+    FROM tbl_settlements
+    WHERE payee_id = :user_id AND payer_id != :user_id AND amount IS NOT NULL
+    GROUP BY group_id, payer_id
+"""
+
+USER_SNAPSHOT_SQL = """
+    SELECT c.group_id, CASE WHEN s.payer_id = :user_id THEN s.user_id ELSE s.payer_id END,
+           CASE WHEN s.payer_id = :user_id THEN s.amount ELSE -s.amount END
+    FROM tbl_balance_snapshot s
+    JOIN tbl_balance_checkpoint c ON c.checkpoint_id = s.checkpoint_id
+    WHERE s.checkpoint_id IN (SELECT MAX(checkpoint_id) FROM tbl_balance_checkpoint GROUP BY group_id)
+      AND (s.payer_id = :user_id OR s.user_id = :user_id) AND s.payer_id != s.user_id
+"""
+
+
+def fetch_columns(db, sql, params, width):
+    """Run `sql` and return its integer result as a (rows, width) int64 array without building Python objects per cell."""
+    result = db.execute(text(sql), params)
+    flat = np.fromiter(chain.from_iterable(result), dtype=np.int64)
+    return flat.reshape(-1, width)
+
+
+class SplitColumns:
+    """
+    Splits as parallel int64 arrays: who paid, who owes and how many paise.
+
+    A settlement "payer pays payee" has the same effect on balances as an
+    expense paid by `payer` and split entirely to `payee`, so settlements use
+    the same layout.
+    """
+
+    def __init__(self, payer_ids, user_ids, shares):
+        self.payer_ids = np.asarray(payer_ids, dtype=np.int64)
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.shares = np.asarray(shares, dtype=np.int64)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [])
+
+    @classmethod
+    def from_array(cls, array):
+        return cls(array[:, 0], array[:, 1], array[:, 2])
+
+    def concat(self, other):
+        return SplitColumns(
+            np.concatenate([self.payer_ids, other.payer_ids]),
+            np.concatenate([self.user_ids, other.user_ids]),
+            np.concatenate([self.shares, other.shares]),
+        )
+
+    def __len__(self):
+        return len(self.shares)
+
+
+def _sum_by(index, weights, size):
+    # bincount sums in float64, which is exact for totals below 2**53 paise
+    return np.rint(np.bincount(index, weights=weights, minlength=size)).astype(np.int64)
+
+
+class GroupBalances:
+    """Per-member positions of a group, in paise, indexed by `member_ids` (sorted)."""
+
+    def __init__(self, member_ids, paid, owed, settled_out, settled_in, splits, settlements):
+        self.member_ids = member_ids
+        self.paid = paid
+        self.owed = owed
+        self.net = paid - owed + settled_out - settled_in
+        self._splits = splits
+        self._settlements = settlements
+        self._pairwise = None
+
+    def _index(self, user_id):
+        index = np.searchsorted(self.member_ids, user_id)
+        if index >= len(self.member_ids) or self.member_ids[index] != user_id:
+            return None
+        return index
+
+    def paid_by(self, user_id):
+        index = self._index(user_id)
+        return Money(0) if index is None else Money(int(self.paid[index]))
+
+    def owed_by(self, user_id):
+        index = self._index(user_id)
+        return Money(0) if index is None else Money(int(self.owed[index]))
+
+    def net_of(self, user_id):
+        index = self._index(user_id)
+        return Money(0) if index is None else Money(int(self.net[index]))
+
+    @property
+    def pairwise(self):
+        """
+        Matrix where pairwise[i, j] > 0 means member j owes member i that many paise.
+
+        Only built on first use, since it is quadratic in the number of members.
+        """
+        if self._pairwise is None:
+            size = len(self.member_ids)
+            gross = np.zeros(size * size, dtype=np.int64)
+            for columns in (self._splits, self._settlements):
+                payer_index = np.searchsorted(self.member_ids, columns.payer_ids)
+                user_index = np.searchsorted(self.member_ids, columns.user_ids)
+                gross += _sum_by(payer_index * size + user_index, columns.shares, size * size)
+            gross = gross.reshape(size, size)
+            self._pairwise = gross - gross.T
+        return self._pairwise
+
+    def owes(self, debtor_id, creditor_id):
+        """What `debtor_id` still owes `creditor_id` after netting both directions."""
+        debtor, creditor = self._index(debtor_id), self._index(creditor_id)
+        if debtor is None or creditor is None:
+            return Money(0)
+        return Money(max(int(self.pairwise[creditor, debtor]), 0))
+
+    def settle_up(self):
+        """Return (debtor_id, creditor_id, Money) transfers that bring every net position to zero."""
+        creditors = [[int(self.member_ids[i]), int(self.net[i])] for i in np.argsort(-self.net) if self.net[i] > 0]
+        debtors = [[int(self.member_ids[i]), int(-self.net[i])] for i in np.argsort(self.net) if self.net[i] < 0]
+
+        transfers = []
+        creditor_index = debtor_index = 0
+        while creditor_index < len(creditors) and debtor_index < len(debtors):
+            creditor, debtor = creditors[creditor_index], debtors[debtor_index]
+            amount = min(creditor[1], debtor[1])
+            transfers.append((debtor[0], creditor[0], Money(amount)))
+            creditor[1] -= amount
+            debtor[1] -= amount
+            if creditor[1] == 0:
+                creditor_index += 1
+            if debtor[1] == 0:
+                debtor_index += 1
+        return transfers
+
+
+def compute_balances(splits, settlements=None, member_ids=()):
+    """Compute paid, owed and net for every member with grouped reductions over the split columns."""
+    settlements = settlements if settlements is not None else SplitColumns.empty()
+    ids = np.unique(np.concatenate([
+        splits.payer_ids, splits.user_ids,
+        settlements.payer_ids, settlements.user_ids,
+        np.asarray(list(member_ids), dtype=np.int64),
+    ]))
+    size = len(ids)
+
+    def sum_for(columns, id_column):
+        return _sum_by(np.searchsorted(ids, id_column), columns.shares, size)
+
+    return GroupBalances(
+        ids,
+        paid=sum_for(splits, splits.payer_ids),
+        owed=sum_for(splits, splits.user_ids),
+        settled_out=sum_for(settlements, settlements.payer_ids),
+        settled_in=sum_for(settlements, settlements.user_ids),
+        splits=splits,
+        settlements=settlements,
+    )
+
+
+def load_group_balances(db, group_id, member_ids=()):
+    """Balances as of now: the group's latest checkpoint snapshot plus everything still in the hot tables."""
+    params = {"group_id": group_id}
+    splits = SplitColumns.from_array(np.concatenate([
+        fetch_columns(db, GROUP_SNAPSHOT_SQL, {**params, "kind": "split"}, 3),
+        fetch_columns(db, GROUP_SPLITS_SQL, params, 3),
+    ]))
+    settlements = SplitColumns.from_array(np.concatenate([
+        fetch_columns(db, GROUP_SNAPSHOT_SQL, {**params, "kind": "settlement"}, 3),
+        fetch_columns(db, GROUP_SETTLEMENTS_SQL, params, 3),
+    ]))
+    return compute_balances(splits, settlements, member_ids)
+
+
+def _user_positions(db, user_id):
+    """(group_ids, other_ids, signed paise) of `user_id` towards everyone else; positive amounts are owed to the user."""
+    params = {"user_id": user_id}
+    rows = np.concatenate([
+        fetch_columns(db, USER_SNAPSHOT_SQL, params, 3),
+        fetch_columns(db, USER_SPLITS_SQL, params, 3),
+        fetch_columns(db, USER_SETTLEMENTS_SQL, params, 3),
+    ])
+    return rows.T
+
+
+def user_totals(db, user_id):
+    """
+    Return (receive, pay) for a user across all of their groups.
+
+    Debts are netted per (group, other member) pair, matching what each group's
+    report shows, before being added up.
+    """
+    group_ids, others, signed = _user_positions(db, user_id)
+    if not len(signed):
+        return Money(0), Money(0)
+
+    _, pair_index = np.unique(np.stack([group_ids, others], axis=1), axis=0, return_inverse=True)
+    pair_index = pair_index.reshape(-1)
+    per_pair = _sum_by(pair_index, signed, int(pair_index.max()) + 1)
+    return Money(int(per_pair[per_pair > 0].sum())), Money(int(-per_pair[per_pair < 0].sum()))
+
+
+def user_net_balances(db, user_id):
+    """
+    Return {other user id: Money} with each person's net position towards `user_id`
+    across every group they share; positive means they owe the user.
+
+    The same three reads as `user_totals`, whatever the number of friends or
+    groups, reduced with one bincount. People who are all square are left out.
+    """
+    _, others, signed = _user_positions(db, user_id)
+    if not len(signed):
+        return {}
+    other_ids, other_index = np.unique(others, return_inverse=True)
+    nets = _sum_by(other_index.reshape(-1), signed, len(other_ids))
+    return {int(other_id): Money(int(net)) for other_id, net in zip(other_ids.tolist(), nets.tolist()) if net}
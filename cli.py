@@ -0,0 +1,513 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+import click
+from datetime import datetime, timedelta
+from database import SHARD_COUNT, ShardSessions
+from models import User
+from services import createDatabase, group_session, purge_deleted_expenses, shard_of, UNDO_SECONDS
+from coordination import coordinator, MemoryCoordinator
+from compaction import compact_group, compactable_group_ids
+from importer import CHUNK_SIZE, start_import, run_import_job
+from rebalance import move_group, plan_rebalance, shard_loads
+
+
+@click.group()
+def cli():
+    """Maintenance commands for owe-no."""
+
+
+@cli.command()
+@click.option("--older-than-days", default=180, show_default=True, help="Archive expenses and settlements older than this.")
+@click.option("--group-id", type=int, default=None, help="Only compact this group.")
+def compact(older_than_days, group_id):
+    """Checkpoint balances and move old history to the archive tables."""
+    createDatabase()
+    before = datetime.now() - timedelta(days=older_than_days)
+    sessions = [ShardSessions[shard_of(group_id)]] if group_id else ShardSessions
+    for Session in sessions:
+        with Session() as db:
+            group_ids = [group_id] if group_id else compactable_group_ids(db, before)
+            for compact_group_id in group_ids:
+                checkpoint = compact_group(db, compact_group_id, before)
+                if checkpoint:
+                    click.echo(f"Group {compact_group_id}: checkpoint {checkpoint.checkpoint_id}, archived history before {before:%Y-%m-%d}")
+                else:
+                    click.echo(f"Group {compact_group_id}: nothing to archive")
+
+
+@cli.command("purge-deleted")
+@click.option("--older-than-seconds", default=UNDO_SECONDS, show_default=True, help="Only expenses deleted at least this long ago (the undo window).")
+def purge_deleted(older_than_seconds):
+    """Remove deleted expenses now instead of waiting for the purge worker."""
+    createDatabase()
+    purged = 0
+    for Session in ShardSessions:
+        with Session() as db:
+            purged += purge_deleted_expenses(db, datetime.now() - timedelta(seconds=older_than_seconds))
+    click.echo(f"Purged {purged} deleted expenses")
+
+
+CACHE_NAMESPACES = ("membership", "fragments", "friend-graph", "group-shards")
+
+
+@cli.command("invalidate-caches")
+@click.option("--namespace", "namespaces", multiple=True, type=click.Choice(CACHE_NAMESPACES), help="Only these caches (default: all).")
+@click.option("--key", "keys", multiple=True, type=int, help="Only these keys, e.g. group ids for the membership cache.")
+def invalidate_caches(namespaces, keys):
+    """Tell every running worker to drop its caches, e.g. after editing the database by hand."""
+    if isinstance(coordinator, MemoryCoordinator):
+        raise click.ClickException("OWE_NO_COORDINATION=memory cannot reach other processes; use sqlite or a redis:// URL.")
+    createDatabase()  # The sqlite backend keeps its events in the main database
+    for namespace in namespaces or CACHE_NAMESPACES:
+        coordinator.invalidate(namespace, *keys)
+        click.echo(f"Invalidated {namespace}" + (f" keys {', '.join(map(str, keys))}" if keys else ""))
+
+
+@cli.command("rebalance-shards")
+@click.option("--group-id", type=int, default=None, help="Move just this group (needs --to-shard).")
+@click.option("--to-shard", type=int, default=None, help="Shard to move --group-id to.")
+@click.option("--window-days", default=30, show_default=True, help="Measure each group's write load over this many days.")
+@click.option("--max-moves", default=10, show_default=True, help="Most groups moved in one run.")
+@click.option("--dry-run", is_flag=True, help="Only show the moves.")
+def rebalance_shards(group_id, to_shard, window_days, max_moves, dry_run):
+    """Move groups between shard databases, by hand or to even out recent write load."""
+    if (group_id is None) != (to_shard is None):
+        raise click.UsageError("--group-id and --to-shard go together.")
+    createDatabase()
+    if group_id is not None:
+        moves = [(group_id, shard_of(group_id), to_shard)]
+    else:
+        loads = shard_loads(datetime.now() - timedelta(days=window_days))
+        for shard, groups in loads.items():
+            click.echo(f"Shard {shard}: {len(groups)} active groups, {sum(groups.values())} writes in the last {window_days} days")
+        moves = plan_rebalance(loads, max_moves)
+        if SHARD_COUNT == 1:
+            click.echo("Only one shard (OWE_NO_SHARDS); nothing to balance.")
+
+    for move_group_id, source, target in moves:
+        click.echo(f"Group {move_group_id}: shard {source} -> {target}")
+        if not dry_run:
+            try:
+                move_group(move_group_id, target)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+
+
+@cli.command("import-expenses")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False), required=False)
+@click.option("--group-id", type=int, help="Group to import into.")
+@click.option("--created-by", help="Email of the user recorded as the creator of the imported expenses.")
+@click.option("--format", "file_format", type=click.Choice(["csv", "json"]), help="Defaults to the file extension.")
+@click.option("--resume", "job_id", type=int, help="Resume an earlier import job of --group-id from its checkpoint.")
+@click.option("--chunk-size", default=CHUNK_SIZE, show_default=True, help="Rows per transaction.")
+def import_expenses(path, group_id, created_by, file_format, job_id, chunk_size):
+    """Stream a CSV or JSON file of historical expenses into a group."""
+    if not group_id:
+        raise click.UsageError("--group-id is required.")
+    createDatabase()
+    if job_id is None:
+        if not path or not created_by:
+            raise click.UsageError("PATH and --created-by are required unless --resume is given.")
+        with group_session(group_id) as db:
+            user = db.query(User).filter(User.email == created_by.lower()).first()
+            if user is None:
+                raise click.BadParameter(f"No user with email {created_by}", param_hint="--created-by")
+            file_format = file_format or ("json" if path.lower().endswith((".json", ".jsonl", ".ndjson")) else "csv")
+            job_id = start_import(db, group_id, user.id, os.path.abspath(path), file_format).job_id
+        click.echo(f"Started import job {job_id}")
+
+    def progress(job):
+        click.echo(f"\r{job.rows_done} rows read, {job.rows_imported} imported, {job.rows_failed} failed", nl=False)
+
+    summary = run_import_job(group_id, job_id, chunk_size=chunk_size, progress=progress)
+    if summary is None:
+        raise click.ClickException(f"Import job {job_id} not found")
+    click.echo(f"\nImport job {job_id}: {summary['status']}, {summary['rows_imported']} imported, {summary['rows_failed']} failed")
+
+
+def _summary(samples):
+    return f"median {statistics.median(samples) * 1000:.0f} ms, min {min(samples) * 1000:.0f} ms, max {max(samples) * 1000:.0f} ms"
+
+
+@cli.command("bench-startup")
+@click.option("--runs", default=5, show_default=True)
+@click.option("--port", default=8765, show_default=True, help="Free port for the throwaway server.")
+@click.option("--top", default=10, show_default=True, help="How many of the slowest imports to list.")
+def bench_startup(runs, port, top):
+    """Measure app import time and a fresh worker's time to first request."""
+    env = {**os.environ, "OWE_NO_SCHEDULER": "0"}
+
+    def timed(command):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, env=env)
+        return time.perf_counter() - start
+
+    interpreter = [timed([sys.executable, "-c", "pass"]) for _ in range(runs)]
+    imports = [timed([sys.executable, "-c", "import app"]) for _ in range(runs)]
+    click.echo(f"python startup:  {_summary(interpreter)}")
+    click.echo(f"import app:      {_summary(imports)}")
+
+    # -X importtime lines: "import time: self [us] | cumulative | package", nested two spaces per level
+    report = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], capture_output=True, text=True, env=env).stderr
+    direct_imports = []
+    for line in report.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            package = parts[2][1:]
+            if len(package) - len(package.lstrip()) == 2:
+                direct_imports.append((int(parts[1]), package.strip()))
+    click.echo("slowest second-level imports:")
+    for cumulative, module in sorted(direct_imports, reverse=True)[:top]:
+        click.echo(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+    first_requests = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"], env=env
+        )
+        try:
+            while True:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/login", timeout=1) as response:
+                        if response.status == 200:
+                            break
+                except OSError:
+                    if server.poll() is not None:
+                        raise click.ClickException("The server exited before answering")
+                    time.sleep(0.01)
+            first_requests.append(time.perf_counter() - start)
+        finally:
+            server.terminate()
+            server.wait()
+    click.echo(f"first request:   {_summary(first_requests)}")
+
+
+def _template_bench_contexts(rows):
+    from types import SimpleNamespace
+    from money import Money
+
+    people = [SimpleNamespace(id=i, user_id=i, friend_request_id=i, first_name=f"First{i}", last_name=f"Last{i}") for i in range(rows)]
+    months = {}
+    for i in range(rows):
+        months.setdefault(f"Month {i // 30}", []).append({
+            "group_id": 1, "expense_id": i, "transaction_date": "Jan 01", "description": f"Expense {i}",
+            "users": ["First1 Last1"], "amount_paid_by": "You paid ₹100.00", "transaction_type": "Receive",
+            "share": "₹ 50.00", "split_type": "equal", "created_by": 1,
+        })
+    common = {"request": None, "total_friend_requests": 3, "current_user": {"user_id": 1}, "group_id": 1, "group_version": 1}
+    return {
+        "groups.html": {**common, "group_list": [SimpleNamespace(id=i, name=f"Group {i}") for i in range(rows)], "total_receive": Money(0), "total_pay": Money(0)},
+        "view-group.html": {**common, "data_list": months, "has_archive": False, "include_archived": False},
+        "view-members.html": {**common, "members": people},
+        "friends.html": {**common, "friend_list": people},
+        "friend-requests.html": {**common, "friend_list": people},
+        "add-expense.html": {**common, "group_members": people},
+    }
+
+
+@cli.command("bench-templates")
+@click.option("--rows", default=500, show_default=True, help="Rows (groups, transactions, members...) per page.")
+@click.option("--runs", default=50, show_default=True)
+def bench_templates(rows, runs):
+    """Measure template compile time and render time per page, with and without cached fragments."""
+    from templating import templates, fragment_cache, precompile_templates
+
+    precompile_templates()  # Makes sure the bytecode cache is populated
+    names = templates.env.list_templates(extensions=["html"])
+    for label, bytecode_cache in (("compile all (no bytecode cache)", None), ("compile all (bytecode cache)", templates.env.bytecode_cache)):
+        environment = templates.env.overlay(cache_size=0, bytecode_cache=bytecode_cache)
+        start = time.perf_counter()
+        for name in names:
+            environment.get_template(name)
+        click.echo(f"{label}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    click.echo(f"render times at {rows} rows (cold fragments / warm fragments):")
+    for name, context in _template_bench_contexts(rows).items():
+        template = templates.get_template(name)
+        cold = []
+        for _ in range(runs):
+            fragment_cache.clear()
+            start = time.perf_counter()
+            template.render(context)
+            cold.append(time.perf_counter() - start)
+        warm = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            template.render(context)
+            warm.append(time.perf_counter() - start)
+        click.echo(f"  {name:22} {statistics.median(cold) * 1000:7.2f} ms / {statistics.median(warm) * 1000:7.2f} ms")
+
+
+
+def _random_split_spec(rng):
+    from money import Money
+
+    amount = Money(rng.randint(1, 10_000_000))
+    member_ids = rng.sample(range(1, 51), rng.randint(1, 8))
+    split_type = rng.choice(["equal", "percentage", "shares", "exact", "adjustment", "itemized"])
+    values, items = [], []
+    if split_type == "percentage":
+        cuts = sorted(rng.randint(0, 10_000) for _ in member_ids[1:])
+        values = [f"{(end - start) / 100:.2f}" for start, end in zip([0, *cuts], [*cuts, 10_000])]
+    elif split_type == "shares":
+        values = [str(rng.choice([0, 1, 1, 2, 3, 1.5])) for _ in member_ids]
+        values[0] = "1"
+    elif split_type == "exact":
+        values = amount.allocate([rng.randint(0, 9) for _ in member_ids[1:]] + [1])
+    elif split_type == "adjustment":
+        values = [Money(rng.randint(-amount.paise, amount.paise) // (4 * len(member_ids))) for _ in member_ids]
+    elif split_type == "itemized":
+        for part in amount.allocate([rng.randint(1, 9) for _ in range(rng.randint(1, 4))] + [rng.randint(0, 3)])[:-1]:
+            if part > Money(0):
+                items.append((part, rng.sample(member_ids, rng.randint(0, len(member_ids)))))
+    return amount, split_type, member_ids, values, items
+
+
+@cli.command("bench-splits")
+@click.option("--expenses", default=100_000, show_default=True, help="Random expenses to split.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--chunk-size", default=CHUNK_SIZE, show_default=True, help="Expenses per batch, as an import chunk.")
+def bench_splits(expenses, seed, chunk_size):
+    """Check the split engine's invariants on random expenses and measure batch vs one-at-a-time throughput."""
+    import gc
+    import random
+    from money import Money
+    from splits import allocate_splits, plan_split, split_expense
+
+    rng = random.Random(seed)
+    specs, plans = [], []
+    start = time.perf_counter()
+    for _ in range(expenses):
+        spec = _random_split_spec(rng)
+        try:
+            plans.append(plan_split(*spec))
+        except ValueError:
+            continue  # Random adjustments can push a share below zero; those are rejected up front
+        specs.append(spec)
+    plan_seconds = time.perf_counter() - start
+
+    gc.collect()  # Both runs start from the same heap; collections triggered by earlier garbage would skew them
+    start = time.perf_counter()
+    batched = []
+    for offset in range(0, len(plans), chunk_size):
+        batched += allocate_splits(plans[offset:offset + chunk_size])
+    batch_seconds = time.perf_counter() - start
+
+    gc.collect()
+    start = time.perf_counter()
+    one_at_a_time = [allocate_splits([plan])[0] for plan in plans]
+    single_seconds = time.perf_counter() - start
+
+    # The reference path: plan and split each expense on its own
+    reference = [split_expense(*spec) for spec in specs]
+
+    failures = 0
+    for spec, splits, single, expected in zip(specs, batched, one_at_a_time, reference):
+        amount, shares = spec[0], [share for _, share, _ in splits]
+        problems = []
+        if sum(shares) != amount:
+            problems.append(f"shares sum to {sum(shares)}")
+        if any(share < Money(0) for share in shares):
+            problems.append("negative share")
+        if len({user_id for user_id, _, _ in splits}) != len(splits):
+            problems.append("member listed twice")
+        if splits != single or splits != expected:
+            problems.append("batch and single results differ")
+        if problems:
+            failures += 1
+            if failures <= 10:
+                click.echo(f"FAIL {spec[1]} {amount!r}: {', '.join(problems)}")
+
+    click.echo(f"{len(specs)} valid of {expenses} random expenses, {failures} invariant failures")
+    click.echo(f"validate (generate + plan): {len(specs) / plan_seconds:12,.0f} expenses/s")
+    click.echo(f"allocate, {chunk_size} at a time: {len(specs) / batch_seconds:12,.0f} expenses/s")
+    click.echo(f"allocate, one at a time:    {len(specs) / single_seconds:12,.0f} expenses/s")
+    if failures:
+        raise SystemExit(1)
+
+
+SEARCH_BENCH_WORDS = [
+    "dinner", "lunch", "breakfast", "coffee", "groceries", "taxi", "uber", "fuel", "rent", "electricity",
+    "internet", "movie", "tickets", "hotel", "flight", "train", "snacks", "drinks", "pizza", "biryani",
+    "market", "pharmacy", "gift", "party", "trip", "goa", "manali", "office", "team", "weekend",
+]
+
+
+def _build_search_bench_db(engine, expenses, groups, users, seed):
+    import random
+    from models import Base
+    from migrations import run_migrations
+
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    rng = random.Random(seed)
+    start_time = datetime(2024, 1, 1)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO tbl_user (id, first_name, last_name, password) VALUES (?, ?, ?, '')",
+                           [(user_id, f"First{user_id}", f"Last{user_id}") for user_id in range(1, users + 1)])
+        cursor.executemany("INSERT INTO tbl_group (id, name, version) VALUES (?, ?, 0)",
+                           [(group_id, f"Group {group_id}") for group_id in range(1, groups + 1)])
+        # User 1 is in the first 20 groups, for the cross-group searches
+        members = {group_id: ([1] if group_id <= 20 else []) + rng.sample(range(2, users + 1), rng.randint(2, 7)) for group_id in range(1, groups + 1)}
+        cursor.executemany("INSERT INTO tbl_group_member (group_id, user_id) VALUES (?, ?)",
+                           [(group_id, user_id) for group_id, user_ids in members.items() for user_id in user_ids])
+        for offset in range(0, expenses, 50_000):
+            rows, splits = [], []
+            for expense_id in range(offset + 1, min(offset + 50_000, expenses) + 1):
+                group_id = rng.randint(1, groups)
+                paid_by = rng.choice(members[group_id])
+                created_at = start_time + timedelta(seconds=rng.randint(0, 2 * 365 * 86400))
+                description = " ".join(rng.sample(SEARCH_BENCH_WORDS, rng.randint(1, 3)))
+                rows.append((expense_id, group_id, description, rng.randint(100, 2_000_000), paid_by, paid_by, "equal", created_at.isoformat(" ", "microseconds")))
+                for user_id in rng.sample(members[group_id], rng.randint(2, len(members[group_id]))):
+                    splits.append((expense_id, user_id, 0, 0, 0))
+            cursor.executemany("INSERT INTO tbl_expenses (expense_id, group_id, description, amount, paid_by, created_by, split_type, created_at) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            cursor.executemany("INSERT INTO tbl_expense_split_table (expense_id, user_id, share, paid, ratio) VALUES (?, ?, ?, ?, ?)", splits)
+            conn.commit()
+            click.echo(f"\r{offset + len(rows)} expenses written", nl=False)
+        click.echo()
+    finally:
+        conn.close()
+    return members
+
+
+@cli.command("bench-search")
+@click.option("--path", default="bench-search.db", show_default=True, help="Throwaway database; reused when it already exists.")
+@click.option("--expenses", default=1_000_000, show_default=True)
+@click.option("--groups", default=2_000, show_default=True)
+@click.option("--users", default=5_000, show_default=True)
+@click.option("--runs", default=5, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+def bench_search(path, expenses, groups, users, runs, seed):
+    """Measure one page of expense search for each filter, in one group and across a user's groups."""
+    from datetime import date
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import Session
+    from money import Money
+    from models import Expense, GroupMember
+    from search import PAGE_SIZE, expense_conditions, paginate, search_keys, search_results
+
+    engine = create_engine(f"sqlite:///{path}")
+    if not os.path.exists(path):
+        _build_search_bench_db(engine, expenses, groups, users, seed)
+
+    with Session(engine) as db:
+        total = db.query(Expense).count()
+        busiest, group_size = (
+            db.query(Expense.group_id, func.count()).group_by(Expense.group_id).order_by(func.count().desc()).first()
+        )
+        user_groups = [row.group_id for row in db.query(GroupMember.group_id).filter(GroupMember.user_id == 1)]
+        payer = db.query(GroupMember.user_id).filter(GroupMember.group_id == busiest, GroupMember.user_id != 1).limit(1).scalar()
+        first_page = search_keys(db, [busiest], expense_conditions(), None, PAGE_SIZE + 1)
+        click.echo(f"{total} expenses; busiest group {busiest} has {group_size}, user 1 is in {len(user_groups)} groups")
+
+        cases = [
+            ("group, newest first", [busiest], {}, None),
+            ("group, next page", [busiest], {}, first_page[PAGE_SIZE - 1] if len(first_page) > PAGE_SIZE else None),
+            ("group, text", [busiest], {"text": "dinner"}, None),
+            ("group, text prefix", [busiest], {"text": "bir"}, None),
+            ("group, rare text", [busiest], {"text": "goa manali"}, None),
+            ("group, amount range", [busiest], {"min_amount": Money.parse("100"), "max_amount": Money.parse("500")}, None),
+            ("group, date range", [busiest], {"from_date": date(2024, 6, 1), "to_date": date(2024, 6, 30)}, None),
+            ("group, payer", [busiest], {"paid_by": payer}, None),
+            ("group, participant", [busiest], {"participant": payer}, None),
+            ("group, everything", [busiest], {"text": "dinner", "min_amount": Money.parse("100"), "from_date": date(2024, 1, 1), "paid_by": payer}, None),
+            ("user's groups, newest first", user_groups, {}, None),
+            ("user's groups, text", user_groups, {"text": "coffee"}, None),
+            ("user's groups, participant", user_groups, {"participant": 1}, None),
+            ("user's groups, date range", user_groups, {"from_date": date(2025, 3, 1), "to_date": date(2025, 3, 7)}, None),
+        ]
+        for label, group_ids, filters, cursor in cases:
+            search_filter = expense_conditions(**filters)
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                page, _ = paginate(search_results(db, search_keys(db, group_ids, search_filter, cursor, PAGE_SIZE + 1)), PAGE_SIZE)
+                samples.append(time.perf_counter() - start)
+            click.echo(f"  {label:30} {len(page):3} results  median {statistics.median(samples) * 1000:7.2f} ms")
+
+
+@cli.command("bench-writes")
+@click.option("--path", default="bench-writes.db", show_default=True, help="Throwaway database, recreated on every run.")
+@click.option("--writes", default=2_000, show_default=True, help="Expenses added per mode and concurrency level.")
+@click.option("--concurrency", default="1,4,16,64", show_default=True, help="Comma-separated numbers of concurrent writers.")
+@click.option("--window-ms", default=2.0, show_default=True, help="Group-commit gathering window.")
+def bench_writes(path, writes, concurrency, window_ms):
+    """Compare a commit per request against group commit for small expense writes at several concurrency levels."""
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import sessionmaker
+    from group_commit import GroupCommitWriter
+    from migrations import run_migrations
+    from models import Base, Expense, Group
+    from money import Money
+    from services import insert_expenses
+
+    levels = [int(level) for level in concurrency.split(",")]
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_engine(f"sqlite:///{path}", pool_size=max(levels), max_overflow=0, connect_args={"timeout": 60})
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    Session = sessionmaker(autoflush=False, bind=engine)
+    with Session() as db:
+        db.add_all([User(id=user_id, first_name=f"First{user_id}", last_name=f"Last{user_id}", password="") for user_id in (1, 2)])
+        db.add_all([Group(id=group_id, name=f"Group {group_id}") for group_id in range(1, max(levels) + 1)])
+        db.commit()
+
+    def expense_write(group_id):
+        # What add_expense stages: one expense split between two members
+        def write(db):
+            return insert_expenses(db, [{
+                "group_id": group_id, "description": "Bench", "amount": Money(10_000), "paid_by": 1, "split_type": "equal",
+                "created_by": 1, "splits": [(1, Money(5_000), 0), (2, Money(5_000), 0)],
+            }])
+        return write
+
+    def per_request(index):
+        start = time.perf_counter()
+        with Session() as db:
+            expense_write(index % max(levels) + 1)(db)
+            db.commit()
+        return time.perf_counter() - start
+
+    click.echo(f"{writes} one-expense writes per run; latency is per write, from start to durable commit")
+    for level in levels:
+        writer = GroupCommitWriter(Session, window=window_ms / 1000)
+
+        def group_commit(index):
+            start = time.perf_counter()
+            writer.submit(expense_write(index % max(levels) + 1)).result()
+            return time.perf_counter() - start
+
+        for label, run in (("commit per request", per_request), ("group commit", group_commit)):
+            with Session() as db:
+                before = db.query(func.count(Expense.expense_id)).scalar()
+            with ThreadPoolExecutor(max_workers=level) as pool:
+                start = time.perf_counter()
+                latencies = sorted(pool.map(run, range(writes)))
+                seconds = time.perf_counter() - start
+            with Session() as db:
+                written = db.query(func.count(Expense.expense_id)).scalar() - before
+            if written != writes:
+                raise click.ClickException(f"{label} at concurrency {level}: {written} of {writes} writes are in the database")
+            batches = f", {writer.writes / writer.batches:5.1f} writes per commit" if run is group_commit else ""
+            click.echo(
+                f"  concurrency {level:3}, {label:18} {writes / seconds:8,.0f} writes/s, "
+                f"p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms{batches}"
+            )
+        writer.stop()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,100 @@
+from collections import defaultdict
+from sqlalchemy import desc, func, insert, select
+from models import (
+    Expense, ExpenseSplit, Settlement,
+    ExpenseArchive, ExpenseSplitArchive, SettlementArchive,
+    BalanceCheckpoint, BalanceSnapshot,
+)
+from money import Money
+from services import bump_group_versions
+
+
+def latest_checkpoint(db, group_id):
+    return (
+        db.query(BalanceCheckpoint)
+        .filter(BalanceCheckpoint.group_id == group_id)
+        .order_by(desc(BalanceCheckpoint.checkpoint_id))
+        .first()
+    )
+
+
+def compactable_group_ids(db, before):
+    return [
+        row.group_id
+        for row in db.query(Expense.group_id).filter(Expense.deleted_at.is_(None), Expense.created_at < before).distinct().all()
+    ]
+
+
+def _move_rows(db, source, target, condition):
+    # Hot-only columns such as Expense.deleted_at have no archive counterpart
+    columns = [column.name for column in source.__table__.columns if column.name in target.__table__.c]
+    db.execute(
+        insert(target.__table__).from_select(
+            columns, select(*[source.__table__.c[name] for name in columns]).where(condition)
+        )
+    )
+    db.query(source).filter(condition).delete(synchronize_session=False)
+
+
+def compact_group(db, group_id, before):
+    """
+    Fold a group's expenses and settlements older than `before` into a new checkpoint and move them to the archive tables.
+
+    The new snapshot is the previous one plus the archived rows, and it is
+    written in the same transaction that removes those rows from the hot
+    tables, so snapshot + hot rows always add up to the full history.
+    Returns the new checkpoint, or None when there was nothing to archive.
+    """
+    # Deleted expenses stay behind: they can still be restored, and the purge worker removes them otherwise
+    old_expense_ids = select(Expense.expense_id).where(
+        Expense.group_id == group_id, Expense.deleted_at.is_(None), Expense.created_at < before
+    )
+    old_settlements = (Settlement.group_id == group_id) & (Settlement.settled_at < before)
+
+    split_totals = (
+        db.query(Expense.paid_by, ExpenseSplit.user_id, func.sum(ExpenseSplit.share))
+        .join(Expense, Expense.expense_id == ExpenseSplit.expense_id)
+        .filter(ExpenseSplit.expense_id.in_(old_expense_ids), ExpenseSplit.share.isnot(None))
+        .group_by(Expense.paid_by, ExpenseSplit.user_id)
+        .all()
+    )
+    settlement_totals = (
+        db.query(Settlement.payer_id, Settlement.payee_id, func.sum(Settlement.amount))
+        .filter(old_settlements, Settlement.amount.isnot(None))
+        .group_by(Settlement.payer_id, Settlement.payee_id)
+        .all()
+    )
+    has_old_expenses = db.query(old_expense_ids.exists()).scalar()
+    if not has_old_expenses and not settlement_totals:
+        return None
+
+    totals = defaultdict(lambda: Money(0))
+    previous = latest_checkpoint(db, group_id)
+    if previous:
+        for snapshot in db.query(BalanceSnapshot).filter(BalanceSnapshot.checkpoint_id == previous.checkpoint_id):
+            totals[(snapshot.kind, snapshot.payer_id, snapshot.user_id)] += snapshot.amount
+    for payer_id, user_id, amount in split_totals:
+        totals[("split", payer_id, user_id)] += amount
+    for payer_id, payee_id, amount in settlement_totals:
+        totals[("settlement", payer_id, payee_id)] += amount
+
+    checkpoint = BalanceCheckpoint(
+        group_id=group_id,
+        archived_before=max(before, previous.archived_before) if previous else before,
+    )
+    db.add(checkpoint)
+    db.flush()
+    db.add_all([
+        BalanceSnapshot(checkpoint_id=checkpoint.checkpoint_id, kind=kind, payer_id=payer_id, user_id=user_id, amount=amount)
+        for (kind, payer_id, user_id), amount in totals.items()
+        if amount
+    ])
+
+    # Splits first, while their expenses can still be selected from the hot table
+    _move_rows(db, ExpenseSplit, ExpenseSplitArchive, ExpenseSplit.expense_id.in_(old_expense_ids))
+    _move_rows(db, Expense, ExpenseArchive, Expense.expense_id.in_(old_expense_ids))
+    _move_rows(db, Settlement, SettlementArchive, old_settlements)
+    bump_group_versions(db, [group_id])
+
+    db.commit()
+    return checkpoint
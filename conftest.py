@@ -0,0 +1,5 @@
+# Lets tests under tests/ import the top-level modules
+import os
+
+# Keep tests off the real database: coordination would otherwise go through ./owe_no.db
+os.environ.setdefault("OWE_NO_COORDINATION", "memory")
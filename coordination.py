@@ -0,0 +1,307 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import CoordinationEvent, Lease
+
+# Which backend coordinates the workers:
+#   memory        one process only (tests, `python main.py` in development)
+#   sqlite        every worker on this machine, through the app database (the default)
+#   redis://...   workers on any machine, through Redis (needs the `redis` package)
+COORDINATION_URL = os.environ.get("OWE_NO_COORDINATION", "sqlite")
+POLL_SECONDS = float(os.environ.get("OWE_NO_COORDINATION_POLL", 0.5))
+EVENT_RETENTION = 10000  # SQLite events kept; listeners poll far more often than this many are published
+
+_worker = (None, None)
+
+
+def current_worker_id():
+    """
+    This process's id as a coordination origin and lease owner.
+
+    Derived per process rather than at import, so gunicorn workers forked
+    from a preloaded master each get their own instead of sharing the
+    master's (and dropping each other's messages as their own).
+    """
+    global _worker
+    pid = os.getpid()
+    if _worker[0] != pid:
+        _worker = (pid, f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}")
+    return _worker[1]
+
+
+class Coordinator(ABC):
+    """
+    Pub/sub, cache invalidation broadcast and leases shared by all workers.
+
+    `publish` delivers to this process's subscribers straight away and to
+    every other worker through the backend. Subscribers run on the
+    backend's listener thread when a message comes from elsewhere, so they
+    must be quick and thread-safe. Messages are JSON-serializable dicts.
+    """
+
+    def __init__(self, worker_id=None):
+        self._worker_id = worker_id  # Fixed ids are for tests that run several "workers" in one process
+        self._subscribers = defaultdict(list)
+
+    @property
+    def worker_id(self):
+        return self._worker_id or current_worker_id()
+
+    def subscribe(self, channel, callback):
+        self._subscribers[channel].append(callback)
+
+    def _deliver(self, channel, message):
+        for callback in list(self._subscribers.get(channel, ())):
+            try:
+                callback(message)
+            except Exception:
+                traceback.print_exc()
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+        self._broadcast(channel, message)
+
+    def _broadcast(self, channel, message):
+        pass  # A single process has no one else to tell
+
+    def invalidate(self, namespace, *keys):
+        """Tell every worker to drop `keys` from its `namespace` cache; no keys means drop everything."""
+        self.publish(f"invalidate:{namespace}", {"keys": list(keys)})
+
+    def on_invalidate(self, namespace, callback):
+        """Run `callback(keys)` whenever `namespace` is invalidated (keys == [] means everything)."""
+        self.subscribe(f"invalidate:{namespace}", lambda message: callback(message["keys"]))
+
+    @abstractmethod
+    def acquire_lease(self, name, owner, ttl_seconds):
+        """Take or renew the lease `name` for `owner`; returns False while someone else holds it."""
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def after_fork(self):
+        """Drop listener state inherited from the parent process; call in a forked worker before `start`."""
+
+
+class MemoryCoordinator(Coordinator):
+    """Everything stays inside this process."""
+
+    def __init__(self, worker_id=None):
+        super().__init__(worker_id)
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire_lease(self, name, owner, ttl_seconds):
+        now = time.monotonic()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder and holder[0] != owner and holder[1] > now:
+                return False
+            self._leases[name] = (owner, now + ttl_seconds)
+            return True
+
+
+class _ListenerThread:
+    """Runs `poll()` on a daemon thread until stopped."""
+
+    def __init__(self, poll):
+        self._poll = poll
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="coordination-listener", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._poll()
+            except Exception:
+                traceback.print_exc()
+                self._stopped.wait(POLL_SECONDS)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def wait(self, seconds):
+        self._stopped.wait(seconds)
+
+
+class SqliteCoordinator(Coordinator):
+    """
+    Coordinates the workers of one machine through the app database.
+
+    Messages are rows in tbl_coordination_events that every worker's
+    listener polls for; leases are rows in tbl_lease.
+    """
+
+    def __init__(self, engine, worker_id=None):
+        super().__init__(worker_id)
+        self.engine = engine
+        self._last_event_id = None
+        self._published = 0
+        self._listener = _ListenerThread(self._poll)
+
+    def _broadcast(self, channel, message):
+        with self.engine.begin() as conn:
+            event_id = conn.execute(
+                insert(CoordinationEvent).values(channel=channel, payload=json.dumps(message), origin=self.worker_id)
+            ).inserted_primary_key[0]
+            self._published += 1
+            if self._published % 100 == 0:
+                conn.execute(delete(CoordinationEvent).where(CoordinationEvent.event_id <= event_id - EVENT_RETENTION))
+
+    def _poll(self):
+        with self.engine.connect() as conn:
+            if self._last_event_id is None:
+                # Only what is published from now on matters
+                self._last_event_id = conn.execute(select(func.coalesce(func.max(CoordinationEvent.event_id), 0))).scalar()
+            events = conn.execute(
+                select(CoordinationEvent.event_id, CoordinationEvent.channel, CoordinationEvent.payload, CoordinationEvent.origin)
+                .where(CoordinationEvent.event_id > self._last_event_id)
+                .order_by(CoordinationEvent.event_id)
+            ).all()
+        for event_id, channel, payload, origin in events:
+            self._last_event_id = event_id
+            if origin != self.worker_id:
+                self._deliver(channel, json.loads(payload))
+        self._listener.wait(POLL_SECONDS)
+
+    def acquire_lease(self, name, owner, ttl_seconds):
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=ttl_seconds)
+        with self.engine.begin() as conn:
+            renewed = conn.execute(
+                update(Lease)
+                .where(Lease.name == name, or_(Lease.owner == owner, Lease.expires_at < now))
+                .values(owner=owner, expires_at=expires_at)
+            ).rowcount
+            if renewed:
+                return True
+            # Nobody holds it yet; if another worker creates it first this insert is a no-op
+            created = conn.execute(
+                sqlite_insert(Lease).values(name=name, owner=owner, expires_at=expires_at).on_conflict_do_nothing()
+            ).rowcount
+            return bool(created)
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
+
+    def after_fork(self):
+        # The parent's listener thread did not survive the fork; its handle would keep `start` from making a new one
+        self._listener = _ListenerThread(self._poll)
+        self._last_event_id = None
+
+
+class RedisCoordinator(Coordinator):
+    """
+    Coordinates workers on any number of machines through Redis.
+
+    Takes a redis-py compatible client, so a fakeredis client can stand in
+    for a real server.
+    """
+
+    CHANNEL = "owe-no:events"
+    LEASE_PREFIX = "owe-no:lease:"
+
+    def __init__(self, client, worker_id=None):
+        super().__init__(worker_id)
+        self.client = client
+        self._pubsub = None
+        self._listener = _ListenerThread(self._poll)
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("OWE_NO_COORDINATION is a Redis URL but the `redis` package is not installed.")
+        return cls(redis.Redis.from_url(url))
+
+    def _broadcast(self, channel, message):
+        self.client.publish(self.CHANNEL, json.dumps({"channel": channel, "message": message, "origin": self.worker_id}))
+
+    def _poll(self):
+        event = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=POLL_SECONDS)
+        if event is None or event["type"] != "message":
+            return
+        envelope = json.loads(event["data"])
+        if envelope["origin"] != self.worker_id:
+            self._deliver(envelope["channel"], envelope["message"])
+
+    def acquire_lease(self, name, owner, ttl_seconds):
+        import redis
+
+        key = self.LEASE_PREFIX + name
+        ttl_ms = int(ttl_seconds * 1000)
+        if self.client.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        # Renew only if it is still ours; WATCH makes the check and the renewal one atomic step
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                holder = pipe.get(key)
+                if isinstance(holder, bytes):
+                    holder = holder.decode()
+                if holder is not None and holder != owner:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.set(key, owner, px=ttl_ms)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def start(self):
+        if self._pubsub is None:
+            self._pubsub = self.client.pubsub()
+            self._pubsub.subscribe(self.CHANNEL)
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def after_fork(self):
+        # The parent's subscription socket is not ours to use or close; redis-py reconnects its pool per process
+        self._pubsub = None
+        self._listener = _ListenerThread(self._poll)
+
+
+def create_coordinator(url=COORDINATION_URL):
+    if url == "memory":
+        return MemoryCoordinator()
+    if url == "sqlite":
+        from database import engine
+
+        return SqliteCoordinator(engine)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCoordinator.from_url(url)
+    raise ValueError(f"Unknown OWE_NO_COORDINATION backend {url!r}; use memory, sqlite or a redis:// URL.")
+
+
+coordinator = create_coordinator()
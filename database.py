@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = "sqlite:///./owe_no.db"
@@ -6,4 +7,31 @@ engine = create_engine(
     DATABASE_URL,
     pool_size=10, max_overflow=20, pool_timeout=30
     )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Partitioned mode: everything that belongs to a group lives in one of OWE_NO_SHARDS databases, so writes to
+# different groups stop queueing on one SQLite write lock. Shard 0 is the database above, which also keeps
+# users, friendships and the group directory (services.shard_of); one shard is the unpartitioned layout.
+SHARD_COUNT = max(1, int(os.environ.get("OWE_NO_SHARDS", 1)))
+SHARD_URL = os.environ.get("OWE_NO_SHARD_URL", "sqlite:///./owe_no.shard{shard}.db")
+GLOBAL_SCHEMA = "global"
+
+
+def _create_shard_engine(shard):
+    shard_engine = create_engine(
+        SHARD_URL.format(shard=shard),
+        pool_size=10, max_overflow=20, pool_timeout=30
+        )
+
+    @event.listens_for(shard_engine, "connect")
+    def attach_global(dbapi_connection, connection_record):
+        # Tables a shard doesn't have (tbl_user, tbl_friends...) resolve to the global database, so joins still work
+        dbapi_connection.execute(f"ATTACH DATABASE ? AS {GLOBAL_SCHEMA}", (engine.url.database,))
+
+    return shard_engine
+
+
+shard_engines = [engine] + [_create_shard_engine(shard) for shard in range(1, SHARD_COUNT)]
+ShardSessions = [SessionLocal] + [
+    sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in shard_engines[1:]
+]
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from database import ShardSessions
+
+# Off by default: every write commits on its own, in the request. With OWE_NO_GROUP_COMMIT=1 writes are handed to
+# one writer thread per shard, which commits everything that arrives within the window in one transaction.
+GROUP_COMMIT = os.environ.get("OWE_NO_GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get("OWE_NO_GROUP_COMMIT_MS", 2))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("OWE_NO_GROUP_COMMIT_BATCH", 256))
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """
+    Coalesces small writes from concurrent callers into shared transactions.
+
+    A write is a function that stages changes on the session it is given
+    and returns a result; it must not commit. The writer thread takes the
+    first waiting write, gathers whatever else arrives within `window`
+    seconds (up to `max_batch`), runs each in its own SAVEPOINT and commits
+    the lot once. While writes come one at a time the window is skipped, so
+    a lone write is not held back waiting for company. Each caller's future
+    resolves only after that COMMIT has returned, so an acknowledged write
+    is as durable as one committed alone; a write that raises is rolled back
+    to its savepoint and gets the exception, without failing the rest of
+    the batch. One fsync then covers the whole batch instead of one per
+    write.
+    """
+
+    def __init__(self, session_factory, window=GROUP_COMMIT_WINDOW_MS / 1000, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._last_batch_size = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, write):
+        """Queue `write(db)`; returns a Future for its result, set once the batch holding it has committed."""
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+        self._queue.put((write, future))
+        return future
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        # Writes that queued up during the last commit are always taken; waiting for more only pays off under load
+        deadline = time.monotonic() + (self.window if self._last_batch_size > 1 or not self._queue.empty() else 0)
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)  # Commit what was gathered, then stop
+                break
+            batch.append(item)
+        self._last_batch_size = len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._commit(batch)
+            except Exception:
+                traceback.print_exc()
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            with self.session_factory() as db:
+                # Take the write lock up front; the savepoints below would otherwise each start a transaction of their own
+                db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+                for write, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with db.begin_nested():
+                            outcomes.append((future, write(db), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+                db.commit()
+        except Exception as e:
+            # Nothing in the batch was committed, so every caller still waiting gets the error
+            for _, future in batch:
+                if future.running():
+                    future.set_exception(e)
+            raise
+
+        self.batches += 1
+        self.writes += len(outcomes)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stop(self):
+        """Commit everything already queued, then stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def shard_writer(shard):
+    """This worker's writer for `shard`, created on first use."""
+    with _writers_lock:
+        if shard not in _writers:
+            _writers[shard] = GroupCommitWriter(ShardSessions[shard])
+        return _writers[shard]
+
+
+def stop_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.stop()
+
+
+async def commit_write(db, shard, write):
+    """
+    Run `write(session)` and commit it, returning its result.
+
+    Without group commit that happens right here on the request's session
+    `db`. With it, the write goes to the shard's writer and the request
+    waits, without blocking the event loop, until the batch is committed.
+    """
+    if not GROUP_COMMIT:
+        result = write(db)
+        db.commit()
+        return result
+    # Give the request's pooled connection back while waiting; otherwise enough waiting requests leave the writer none
+    db.close()
+    return await asyncio.wrap_future(shard_writer(shard).submit(write))
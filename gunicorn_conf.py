@@ -0,0 +1,43 @@
+# Production settings for `gunicorn -c gunicorn_conf.py app:app` (what `python main.py --prod` runs)
+import multiprocessing
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app once in the master so new workers fork ready to serve
+preload_app = os.environ.get("PRELOAD_APP", "1") == "1"
+
+# Graceful restarts: HUP/rolling restarts give in-flight requests this long to finish
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+keepalive = 5
+
+# Recycle workers now and then so slow leaks can't build up
+max_requests = int(os.environ.get("MAX_REQUESTS", 5000))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", 500))
+
+accesslog = "-"
+
+
+def on_starting(server):
+    # Schema checks run once here instead of in every worker's lifespan
+    from services import ensure_database
+    from database import shard_engines
+
+    ensure_database()
+    for engine in shard_engines:
+        engine.dispose()
+
+
+def post_fork(server, worker):
+    # Never share the master's pooled connections with a forked worker
+    from database import shard_engines
+    from coordination import coordinator, current_worker_id
+
+    for engine in shard_engines:
+        engine.dispose(close=False)
+    # A worker of its own for invalidations and leases, with no listener state left over from the master
+    coordinator.after_fork()
+    server.log.info("Worker %s coordinates as %s", worker.pid, current_worker_id())
@@ -0,0 +1,506 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from coordination import coordinator
+from database import ShardSessions
+from models import GroupMember, ImportJob, User
+from money import Money
+from services import group_session, insert_expenses
+from splits import allocate_splits, normalize_split_type, plan_split
+
+IMPORT_DIR = os.environ.get("OWE_NO_IMPORT_DIR", "./imports")  # Uploads are kept here until their import finishes
+MAX_UPLOAD_BYTES = int(os.environ.get("OWE_NO_IMPORT_MAX_BYTES", 100 * 1024 * 1024))
+CHUNK_SIZE = 1000  # Rows per transaction
+READ_SIZE = 64 * 1024  # Bytes read at a time from JSON sources
+MAX_RECORD_CHARS = 1024 * 1024  # A longer JSON record fails as a row instead of being buffered whole
+MAX_STORED_ERRORS = 100
+# Imports run on this many threads per worker, outside the request that uploaded them
+IMPORT_WORKERS = int(os.environ.get("OWE_NO_IMPORT_WORKERS", 2))
+# A running import renews its lease after every chunk; one whose lease lapses is resumed by another worker
+IMPORT_LEASE_SECONDS = int(os.environ.get("OWE_NO_IMPORT_LEASE", 120))
+
+# Expected columns / keys of an imported row:
+#   date, description, amount, paid_by, split_type, split_among, split_values, items
+# split_among and split_values are ";"-separated in CSV or lists in JSON.
+# An empty split_among means the whole group.
+# items are the receipt lines of an itemized split: a JSON list of
+# {"amount": ..., "members": [...]} objects, or "120=Asha;Ravi|80=Ravi" in CSV.
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+def iter_csv_records(stream):
+    yield from csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+
+
+class _RecordSkipper:
+    """Finds where a JSON value ends without decoding it, so a record that does not parse can be stepped over."""
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def end(self, text):
+        """Index just past the value in `text`, continuing from earlier calls; None if it runs on past `text`."""
+        for index, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                if self.depth == 0:
+                    return index  # The enclosing array closes; the value ended just before it
+                self.depth -= 1
+                if self.depth == 0:
+                    return index + 1
+            elif char in ",\n" and self.depth == 0:
+                return index + 1
+        return None
+
+
+def iter_json_records(stream):
+    """
+    Yield objects from a JSON array or from JSON Lines without loading the whole file.
+
+    Records are decoded one at a time from a rolling text buffer, so memory
+    stays proportional to the largest single record, and never above
+    MAX_RECORD_CHARS. A record that does not parse, or is longer than that,
+    is yielded as an ImportRowError in its place and skipped up to where it
+    ends, so the rows after it still import with the same row numbers.
+    """
+    reader = io.TextIOWrapper(stream, encoding="utf-8-sig")
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    in_array = None  # Unknown until the first non-blank character
+    skipper = None  # Set while stepping over a bad record
+
+    while True:
+        if skipper is not None:
+            end = skipper.end(buffer)
+            if end is None:
+                buffer = ""
+            else:
+                buffer = buffer[end:]
+                skipper = None
+
+        if skipper is None:
+            buffer = buffer.lstrip()
+            if in_array is None and buffer:
+                in_array = buffer.startswith("[")
+                if in_array:
+                    buffer = buffer[1:].lstrip()
+            if in_array and buffer.startswith(","):
+                buffer = buffer[1:].lstrip()
+            if in_array and buffer.startswith("]"):
+                return
+
+        if skipper is None and buffer:
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError as e:
+                skipper = _RecordSkipper()
+                end = skipper.end(buffer)
+                if end is not None or eof or len(buffer) > MAX_RECORD_CHARS:
+                    # Complete (or never going to be) and still not JSON: more data cannot fix it
+                    yield ImportRowError(f"Malformed JSON record: {e.msg}.")
+                    if end is not None:
+                        buffer = buffer[end:]
+                        skipper = None
+                        continue
+                    buffer = ""
+                else:
+                    skipper = None  # Most likely cut off by the last read; try again with more
+            else:
+                # A record ending exactly at the buffer end may still continue in the next read
+                if end < len(buffer) or eof:
+                    yield record
+                    buffer = buffer[end:]
+                    continue
+                if len(buffer) > MAX_RECORD_CHARS:
+                    yield ImportRowError(f"Record longer than {MAX_RECORD_CHARS} characters.")
+                    skipper = _RecordSkipper()
+                    continue
+
+        if eof:
+            if in_array and skipper is None:
+                raise ImportRowError("The JSON array is not closed.")
+            return
+        data = reader.read(READ_SIZE)
+        eof = not data
+        buffer += data
+
+
+def iter_records(stream, file_format):
+    return iter_json_records(stream) if file_format == "json" else iter_csv_records(stream)
+
+
+def _split_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in str(value).split(";") if item.strip()]
+
+
+def _parse_items(value, directory):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = [dict(zip(("amount", "members"), line.split("=", 1))) for line in value.split("|") if line.strip()]
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise ImportRowError("items must list receipt lines with an amount and the members who had them.")
+    items = []
+    for item in value:
+        try:
+            amount = Money.parse(item.get("amount"))
+        except ValueError as e:
+            raise ImportRowError(str(e))
+        items.append((amount, [directory.resolve(name) for name in _split_list(item.get("members"))]))
+    return items
+
+
+def _parse_date(value):
+    value = str(value or "").strip()
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for date_format in ("%d/%m/%Y", "%d/%m/%Y %H:%M"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ImportRowError(f"Unrecognised date {value!r}; use YYYY-MM-DD or DD/MM/YYYY.")
+
+
+class MemberDirectory:
+    """Resolves the names used in an import file (full name, unique first name, email or id) to group members."""
+
+    def __init__(self, db, group_id):
+        members = (
+            db.query(User.id, User.first_name, User.last_name, User.email)
+            .join(GroupMember, GroupMember.user_id == User.id)
+            .filter(GroupMember.group_id == group_id)
+            .all()
+        )
+        self.member_ids = [member.id for member in members]
+        self._lookup = {}
+        first_names = {}
+        for member in members:
+            self._lookup[str(member.id)] = member.id
+            if member.email:
+                self._lookup[member.email.lower()] = member.id
+            full_name = f"{member.first_name or ''} {member.last_name or ''}".strip().lower()
+            self._lookup[full_name] = member.id
+            first_names.setdefault((member.first_name or "").lower(), []).append(member.id)
+        for first_name, ids in first_names.items():
+            if len(ids) == 1:
+                self._lookup.setdefault(first_name, ids[0])
+
+    def resolve(self, name):
+        member_id = self._lookup.get(" ".join(str(name).split()).lower())
+        if member_id is None:
+            raise ImportRowError(f"{name!r} is not a member of this group.")
+        return member_id
+
+
+def parse_row(record, directory, group_id, created_by):
+    """
+    Validate one imported record against the split rules.
+
+    Returns an insert_expenses() item without its "splits" and the split's
+    plan; `run_import` allocates a whole chunk's plans in one call. Any bad
+    field, of whatever type, raises ImportRowError so only this row fails.
+    """
+    if isinstance(record, ImportRowError):
+        raise record  # The reader could not even decode it
+    try:
+        return _parse_row(record, directory, group_id, created_by)
+    except ImportRowError:
+        raise
+    except (ValueError, TypeError, AttributeError, ArithmeticError) as e:
+        raise ImportRowError(f"Invalid value: {e}")
+
+
+def _parse_row(record, directory, group_id, created_by):
+    if not isinstance(record, dict):
+        raise ImportRowError("Each row must be an object with named fields.")
+    try:
+        amount = Money.parse(record.get("amount"))
+    except ValueError as e:
+        raise ImportRowError(str(e))
+    if amount <= Money(0):
+        raise ImportRowError("Amount must be greater than zero.")
+
+    try:
+        split_type = normalize_split_type(record.get("split_type"))
+    except ValueError as e:
+        raise ImportRowError(str(e))
+
+    paid_by = directory.resolve(record.get("paid_by") or "")
+    split_among = [directory.resolve(name) for name in _split_list(record.get("split_among"))] or directory.member_ids
+    values = _split_list(record.get("split_values"))
+    items = _parse_items(record.get("items"), directory)
+
+    try:
+        plan = plan_split(amount, split_type, split_among, values, items)
+    except ValueError as e:
+        raise ImportRowError(str(e))
+
+    expense = {
+        "group_id": group_id,
+        "description": str(record.get("description") or "").strip()[:255],
+        "amount": amount,
+        "paid_by": paid_by,
+        "split_type": split_type,
+        "created_by": created_by,
+    }
+    created_at = _parse_date(record.get("date"))
+    if created_at:
+        expense["created_at"] = created_at
+    return expense, plan
+
+
+def run_import(db, job, stream, chunk_size=CHUNK_SIZE, progress=None, should_stop=None):
+    """
+    Import (or resume importing) `stream` into the job's group.
+
+    Rows are validated and inserted in chunks, one transaction per chunk, and
+    the job's `rows_done` checkpoint commits with each chunk. Resuming skips
+    the rows already counted there. Bad rows are counted and the first
+    MAX_STORED_ERRORS are kept on the job; they never abort the import.
+    When `should_stop()` turns true the import stops after the current
+    chunk and stays "running", to be resumed later.
+    """
+    directory = MemberDirectory(db, job.group_id)
+    errors = json.loads(job.errors or "[]")
+    records = islice(iter_records(stream, job.file_format), job.rows_done, None)
+    row_number = job.rows_done
+
+    job.status = "running"
+    db.commit()
+
+    try:
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+
+            expenses = []
+            plans = []
+            for record in chunk:
+                row_number += 1
+                try:
+                    expense, plan = parse_row(record, directory, job.group_id, job.created_by)
+                except ImportRowError as e:
+                    job.rows_failed += 1
+                    if len(errors) < MAX_STORED_ERRORS:
+                        errors.append({"row": row_number, "error": str(e)})
+                    continue
+                expenses.append(expense)
+                plans.append(plan)
+
+            # The chunk's valid rows are split together
+            for expense, splits in zip(expenses, allocate_splits(plans)):
+                expense["splits"] = splits
+
+            if expenses:
+                insert_expenses(db, expenses)
+            job.rows_done = row_number
+            job.rows_imported += len(expenses)
+            job.errors = json.dumps(errors)
+            db.commit()
+
+            if progress:
+                progress(job)
+            if should_stop and should_stop():
+                return job
+    except Exception:
+        db.rollback()
+        job.status = "failed"
+        db.commit()
+        raise
+
+    job.status = "done"
+    db.commit()
+    return job
+
+
+def import_job_summary(job):
+    return {
+        "job_id": job.job_id,
+        "group_id": job.group_id,
+        "status": job.status,
+        "rows_done": job.rows_done,
+        "rows_imported": job.rows_imported,
+        "rows_failed": job.rows_failed,
+        "errors": json.loads(job.errors or "[]"),
+    }
+
+
+def start_import(db, group_id, created_by, source_path, file_format):
+    job = ImportJob(group_id=group_id, created_by=created_by, source_path=source_path, file_format=file_format)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def is_upload(source_path):
+    """Whether the app stored this file itself; a CLI import reads the user's own file in place and never deletes it."""
+    return bool(source_path) and os.path.dirname(os.path.realpath(source_path)) == os.path.realpath(IMPORT_DIR)
+
+
+def _discard_upload(source_path):
+    if is_upload(source_path):
+        try:
+            os.remove(source_path)
+        except FileNotFoundError:
+            pass
+
+
+def run_import_job(group_id, job_id, chunk_size=CHUNK_SIZE, progress=None, should_stop=None):
+    """
+    Run or resume a stored import job from its saved source file, in its own session on the group's shard; returns its summary.
+
+    The job runs under the lease "import-job:<group>:<job>", so it runs in
+    one process at a time; while another holds it, the job is left alone
+    and its summary returned as is. An uploaded file is deleted once its
+    job is done or has failed.
+    """
+    lease = f"import-job:{group_id}:{job_id}"
+
+    def lease_lost():
+        return not coordinator.acquire_lease(lease, coordinator.worker_id, IMPORT_LEASE_SECONDS)
+
+    def stop():
+        return bool(should_stop and should_stop()) or lease_lost()
+
+    with group_session(group_id) as db:
+        job = db.get(ImportJob, job_id)
+        if job is None or job.group_id != group_id:
+            return None
+        if job.status != "done" and not lease_lost():
+            try:
+                with open(job.source_path, "rb") as stream:
+                    run_import(db, job, stream, chunk_size=chunk_size, progress=progress, should_stop=stop)
+            finally:
+                if job.status in ("done", "failed"):
+                    _discard_upload(job.source_path)
+        return import_job_summary(job)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_stopping = threading.Event()
+_queued = set()  # (group_id, job_id) submitted here and not finished yet
+
+
+def submit_import_job(group_id, job_id):
+    """
+    Queue a stored job on this worker's import threads and return at once.
+
+    The upload request finishes as soon as the job is queued, so its
+    admission slot is not held for the length of the import. A job already
+    queued here is not queued twice.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Created on first use, so a pool never crosses a fork
+            _stopping.clear()
+            _executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="import")
+        if (group_id, job_id) in _queued:
+            return None
+        _queued.add((group_id, job_id))
+        return _executor.submit(_run_queued_job, group_id, job_id)
+
+
+def _run_queued_job(group_id, job_id):
+    try:
+        return run_import_job(group_id, job_id, should_stop=_stopping.is_set)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        with _executor_lock:
+            _queued.discard((group_id, job_id))
+
+
+def stop_import_jobs():
+    """Drop queued jobs and stop running ones after their current chunk; both stay resumable from their checkpoint."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        _stopping.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        with _executor_lock:
+            _queued.clear()
+
+
+def resume_import_jobs():
+    """Queue every unfinished upload on this worker; a job running elsewhere holds its lease and is skipped when its turn comes."""
+    unfinished = []
+    for Session in ShardSessions:
+        with Session() as db:
+            unfinished += db.query(ImportJob.group_id, ImportJob.job_id, ImportJob.source_path).filter(
+                ImportJob.status.in_(("pending", "running"))
+            ).all()
+    queued = 0
+    for group_id, job_id, source_path in unfinished:
+        if is_upload(source_path) and submit_import_job(group_id, job_id) is not None:
+            queued += 1
+    return queued
+
+
+class ImportResumer:
+    """
+    Picks up uploaded imports left unfinished by a worker that stopped.
+
+    Runs on a timer inside the web process like the purge worker, once at
+    startup and then every lease period, so an import cut off by a restart
+    carries on from its checkpoint without anyone resuming it by hand.
+    """
+
+    def __init__(self, interval=IMPORT_LEASE_SECONDS):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(resume_import_jobs)
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -1,7 +1,37 @@
+import os
+import click
 import uvicorn
 
+
+@click.command()
+@click.option("--prod", is_flag=True, help="Serve with gunicorn and uvicorn workers instead of the auto-reloading dev server.")
+@click.option("--host", default=None, help="Defaults to 127.0.0.1, or 0.0.0.0 with --prod.")
+@click.option("--port", default=lambda: int(os.environ.get("PORT", 8000)), type=int, show_default="8000")
+@click.option("--workers", type=int, default=None, help="Worker processes for --prod (default: WEB_CONCURRENCY or 2 x CPUs + 1).")
+@click.option("--no-preload", is_flag=True, help="Import the app in each worker instead of once in the master.")
+def main(prod, host, port, workers, no_preload):
+    if not prod:
+        # Pick up template edits while developing
+        os.environ.setdefault("OWE_NO_TEMPLATE_RELOAD", "1")
+        uvicorn.run(
+            "app:app",
+            host=host or "127.0.0.1",
+            port=port,
+            reload=True
+        )
+        return
+
+    # gunicorn_conf.py reads its settings from the environment
+    os.environ["HOST"] = host or "0.0.0.0"
+    os.environ["PORT"] = str(port)
+    if workers:
+        os.environ["WEB_CONCURRENCY"] = str(workers)
+    if no_preload:
+        os.environ["PRELOAD_APP"] = "0"
+
+    config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "gunicorn_conf.py")
+    os.execvp("gunicorn", ["gunicorn", "-c", config_path, "app:app"])
+
+
 if __name__ == "__main__":
-    uvicorn.run(
-        "app:app",
-        reload=True
-    )
\ No newline at end of file
+    main()
@@ -0,0 +1,105 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from fastapi import Depends, HTTPException, Path, status
+from sqlalchemy.orm import Session
+from auth import get_current_user
+from coordination import coordinator
+from models import Group, GroupMember, User
+from services import get_db
+
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("OWE_NO_MEMBERSHIP_CACHE_SIZE", 10000))
+
+
+class GroupMembership:
+    """Who is in a group, as of one version of that group."""
+
+    __slots__ = ("group_id", "name", "version", "members", "member_ids")
+
+    def __init__(self, group_id, name, version, members):
+        self.group_id = group_id
+        self.name = name
+        self.version = version
+        self.members = members  # (user_id, first_name, last_name) rows, ordered by user_id
+        self.member_ids = frozenset(member.user_id for member in members)
+
+    def is_member(self, user_id):
+        return int(user_id) in self.member_ids
+
+
+class MembershipCache:
+    """
+    A per-worker LRU of group memberships.
+
+    Entries are stored with the group version they were loaded at and only
+    served while the group is still at that version. Membership writes bump
+    the version and broadcast an invalidation through the coordinator, which
+    drops the entry in every worker (see `invalidate_membership`).
+    """
+
+    def __init__(self, max_size=MEMBERSHIP_CACHE_SIZE):
+        self.max_size = max_size
+        self._memberships = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, group_id, version):
+        with self._lock:
+            membership = self._memberships.get(group_id)
+            if membership is None or membership.version != version:
+                return None
+            self._memberships.move_to_end(group_id)
+            return membership
+
+    def set(self, membership):
+        with self._lock:
+            self._memberships[membership.group_id] = membership
+            self._memberships.move_to_end(membership.group_id)
+            while len(self._memberships) > self.max_size:
+                self._memberships.popitem(last=False)
+
+    def invalidate(self, *group_ids):
+        with self._lock:
+            for group_id in group_ids:
+                self._memberships.pop(int(group_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._memberships.clear()
+
+
+membership_cache = MembershipCache()
+coordinator.on_invalidate("membership", lambda group_ids: membership_cache.invalidate(*group_ids) if group_ids else membership_cache.clear())
+
+
+def invalidate_membership(group_id):
+    """Drop the group's cached membership in every worker; call after committing a membership change."""
+    coordinator.invalidate("membership", int(group_id))
+
+
+def load_membership(db, group_id):
+    """Return the group's membership, from the cache when its version still matches; None if the group does not exist."""
+    group = db.query(Group.name, Group.version).filter(Group.id == group_id).first()
+    if group is None:
+        return None
+
+    membership = membership_cache.get(group_id, group.version)
+    if membership is None:
+        members = (
+            db.query(GroupMember.user_id, User.first_name, User.last_name)
+            .join(User, User.id == GroupMember.user_id)
+            .filter(GroupMember.group_id == group_id)
+            .order_by(GroupMember.user_id)
+            .all()
+        )
+        membership = GroupMembership(group_id, group.name, group.version, tuple(members))
+        membership_cache.set(membership)
+    return membership
+
+
+def get_group_membership(group_id: int = Path(...), current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+    """Dependency for every /{group_id} route: the group's membership, or 404 unless the current user is in it."""
+    membership = load_membership(db, group_id)
+    if membership is None or not membership.is_member(current_user.get("user_id")):
+        # Same answer for a missing group and someone else's group, so ids can't be probed
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found.")
+    return membership
@@ -0,0 +1,167 @@
+from collections import defaultdict
+from sqlalchemy import inspect, text
+from rollups import rebuild_rollups
+
+
+def _add_column(conn, table, column, ddl):
+    # Tables created by create_all() on a fresh database already have the column
+    if column not in {existing["name"] for existing in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _to_minor_units(conn):
+    """Store every money column as an integer number of paise."""
+    money_columns = [
+        ("tbl_expenses", "amount"),
+        ("tbl_expense_split_table", "share"),
+        ("tbl_expense_split_table", "paid"),
+        ("tbl_settlements", "amount"),
+    ]
+    for table, column in money_columns:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE INTEGER "
+                f"USING ROUND({column} * 100)::INTEGER"
+            ))
+        else:
+            conn.execute(text(
+                f"UPDATE {table} SET {column} = CAST(ROUND({column} * 100) AS INTEGER) "
+                f"WHERE {column} IS NOT NULL"
+            ))
+
+    # Float shares (e.g. 3 x 8139.333) no longer add up to the expense once rounded,
+    # so hand the missing paise back to the splits of each expense.
+    amounts = dict(conn.execute(text("SELECT expense_id, amount FROM tbl_expenses")).all())
+    splits = defaultdict(list)
+    for split_id, expense_id, share in conn.execute(text(
+        "SELECT split_id, expense_id, share FROM tbl_expense_split_table ORDER BY split_id"
+    )):
+        splits[expense_id].append([split_id, share or 0])
+
+    for expense_id, expense_splits in splits.items():
+        if expense_id not in amounts or amounts[expense_id] is None:
+            continue
+        difference = amounts[expense_id] - sum(share for _, share in expense_splits)
+        if difference == 0 or abs(difference) > len(expense_splits):
+            continue  # Exact splits that never added up are left as entered.
+        step = 1 if difference > 0 else -1
+        for index in range(abs(difference)):
+            expense_splits[index][1] += step
+        for split_id, share in expense_splits:
+            conn.execute(
+                text("UPDATE tbl_expense_split_table SET share = :share WHERE split_id = :split_id"),
+                {"share": share, "split_id": split_id},
+            )
+
+
+def _add_group_version(conn):
+    _add_column(conn, "tbl_group", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _backfill_monthly_rollups(conn):
+    # The table itself comes from create_all(); fill it from the existing history.
+    # The rebuild skips deleted expenses, so the tombstone column (version 4) must exist already.
+    _add_column(conn, "tbl_expenses", "deleted_at", "DATETIME")
+    rebuild_rollups(conn)
+
+
+def _add_expense_tombstones(conn):
+    _add_column(conn, "tbl_expenses", "deleted_at", "DATETIME")
+    # create_all() skips tables that already exist, indexes included
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_live_group ON tbl_expenses (group_id, created_at) WHERE deleted_at IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_deleted_at ON tbl_expenses (deleted_at) WHERE deleted_at IS NOT NULL"))
+
+
+def _add_group_directory(conn):
+    # Only the global database keeps the directory; shard databases have nothing to register
+    if "tbl_group_shard" not in inspect(conn).get_table_names():
+        return
+    conn.execute(text("INSERT OR IGNORE INTO tbl_group_shard (group_id, name, shard) SELECT id, name, 0 FROM tbl_group"))
+
+
+def _add_user_balance_indexes(conn):
+    # A user's positions are read by payer and by participant rather than by group
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_live_payer ON tbl_expenses (paid_by) WHERE deleted_at IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expense_split_expense ON tbl_expense_split_table (expense_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expense_split_user ON tbl_expense_split_table (user_id, expense_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_settlements_payer ON tbl_settlements (payer_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_settlements_payee ON tbl_settlements (payee_id)"))
+
+
+def _add_expense_search(conn):
+    # A group's expenses by payer, newest first, for search
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_live_group_payer ON tbl_expenses (group_id, paid_by, created_at) WHERE deleted_at IS NULL"))
+    # Full-text index over descriptions. It reads them from tbl_expenses and the triggers keep it in step with
+    # every write, bulk inserts, compaction and purges included; prefix indexes make "words typed so far" cheap.
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS tbl_expenses_fts USING fts5("
+        "description, content='tbl_expenses', content_rowid='expense_id', prefix='2 3')"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS tbl_expenses_fts_insert AFTER INSERT ON tbl_expenses BEGIN "
+        "INSERT INTO tbl_expenses_fts (rowid, description) VALUES (new.expense_id, new.description); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS tbl_expenses_fts_delete AFTER DELETE ON tbl_expenses BEGIN "
+        "INSERT INTO tbl_expenses_fts (tbl_expenses_fts, rowid, description) VALUES ('delete', old.expense_id, old.description); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS tbl_expenses_fts_update AFTER UPDATE OF description ON tbl_expenses BEGIN "
+        "INSERT INTO tbl_expenses_fts (tbl_expenses_fts, rowid, description) VALUES ('delete', old.expense_id, old.description); "
+        "INSERT INTO tbl_expenses_fts (rowid, description) VALUES (new.expense_id, new.description); END"
+    ))
+    conn.execute(text("INSERT INTO tbl_expenses_fts (tbl_expenses_fts) VALUES ('rebuild')"))
+
+
+def _scope_expense_search_by_group(conn):
+    # Index group_id next to the description so a search reads only the matches in the user's groups, and
+    # index longer prefixes so a whole typed word is one prefix lookup instead of a merge of every word it starts
+    for trigger in ("insert", "delete", "update"):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS tbl_expenses_fts_{trigger}"))
+    conn.execute(text("DROP TABLE IF EXISTS tbl_expenses_fts"))
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE tbl_expenses_fts USING fts5("
+        "description, group_id, content='tbl_expenses', content_rowid='expense_id', prefix='2 3 4 5 6 7 8')"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER tbl_expenses_fts_insert AFTER INSERT ON tbl_expenses BEGIN "
+        "INSERT INTO tbl_expenses_fts (rowid, description, group_id) VALUES (new.expense_id, new.description, new.group_id); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER tbl_expenses_fts_delete AFTER DELETE ON tbl_expenses BEGIN "
+        "INSERT INTO tbl_expenses_fts (tbl_expenses_fts, rowid, description, group_id) "
+        "VALUES ('delete', old.expense_id, old.description, old.group_id); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER tbl_expenses_fts_update AFTER UPDATE OF description, group_id ON tbl_expenses BEGIN "
+        "INSERT INTO tbl_expenses_fts (tbl_expenses_fts, rowid, description, group_id) "
+        "VALUES ('delete', old.expense_id, old.description, old.group_id); "
+        "INSERT INTO tbl_expenses_fts (rowid, description, group_id) VALUES (new.expense_id, new.description, new.group_id); END"
+    ))
+    conn.execute(text("INSERT INTO tbl_expenses_fts (tbl_expenses_fts) VALUES ('rebuild')"))
+
+
+# Ordered (version, migration) pairs. Append new steps, never reorder them.
+MIGRATIONS = [
+    (1, _to_minor_units),
+    (2, _add_group_version),
+    (3, _backfill_monthly_rollups),
+    (4, _add_expense_tombstones),
+    (5, _add_group_directory),
+    (6, _add_user_balance_indexes),
+    (7, _add_expense_search),
+    (8, _scope_expense_search_by_group),
+]
+
+
+def get_schema_version(conn):
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM tbl_schema_version")).scalar()
+
+
+def run_migrations(engine):
+    for version, migration in MIGRATIONS:
+        with engine.begin() as conn:
+            if get_schema_version(conn) >= version:
+                continue
+            migration(conn)
+            conn.execute(text("INSERT INTO tbl_schema_version (version, applied_at) VALUES (:version, CURRENT_TIMESTAMP)"), {"version": version})
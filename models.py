@@ -5,11 +5,15 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     Enum,
-    DECIMAL,
     Table,
+    Text,
+    Boolean,
+    Index,
     func,
+    text,
 )
 from sqlalchemy.orm import declarative_base, relationship
+from money import MoneyType
 
 Base = declarative_base()
 
@@ -49,6 +53,7 @@ class Group(Base):
     __tablename__ = "tbl_group"
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(55))
+    version = Column(Integer, default=0, nullable=False)  # Bumped by every write to the group; keys cached fragments
     creation_date = Column(DateTime, default=func.now())
     modification_date = Column(
         DateTime, default=func.now(), onupdate=func.now()
@@ -68,26 +73,185 @@ class Expense(Base):
     expense_id = Column(Integer, primary_key=True, autoincrement=True)
     group_id = Column(Integer, ForeignKey("tbl_group.id"))
     description = Column(String(255))
-    amount = Column(DECIMAL(10, 2))
+    amount = Column(MoneyType)
     paid_by = Column(Integer, ForeignKey("tbl_user.id"))
     created_by = Column(Integer, ForeignKey("tbl_user.id"))
-    split_type = Column(Enum("equal", "ratio", "exact"), default="equal")
+    split_type = Column(Enum("equal", "ratio", "percentage", "shares", "exact", "itemized", "adjustment"), default="equal")  # "ratio": percentage splits saved before they took decimals
     created_at = Column(DateTime, default=func.now())
+    deleted_at = Column(DateTime)  # Set while the expense sits in the undo window; purged after it
+
+    __table_args__ = (
+        # Partial indexes: reads only ever touch live rows, the purge worker only tombstones
+        Index("ix_expenses_live_group", "group_id", "created_at", sqlite_where=text("deleted_at IS NULL")),
+        Index("ix_expenses_deleted_at", "deleted_at", sqlite_where=text("deleted_at IS NOT NULL")),
+        Index("ix_expenses_live_payer", "paid_by", sqlite_where=text("deleted_at IS NULL")),
+        Index("ix_expenses_live_group_payer", "group_id", "paid_by", "created_at", sqlite_where=text("deleted_at IS NULL")),
+        # Descriptions are also indexed, with group_id, in the tbl_expenses_fts full-text table (migrations 7 and 8)
+    )
 
 class ExpenseSplit(Base):
     __tablename__ = "tbl_expense_split_table"
     split_id = Column(Integer, primary_key=True, autoincrement=True)
     expense_id = Column(Integer, ForeignKey("tbl_expenses.expense_id"))
     user_id = Column(Integer, ForeignKey("tbl_user.id"))
-    share = Column(DECIMAL(10, 2))
-    paid = Column(DECIMAL(10, 2), default=0)
+    share = Column(MoneyType)
+    paid = Column(MoneyType, default=0)
     ratio = Column(Integer)
 
+    __table_args__ = (
+        Index("ix_expense_split_expense", "expense_id"),
+        Index("ix_expense_split_user", "user_id", "expense_id"),
+    )
+
 class Settlement(Base):
     __tablename__ = "tbl_settlements"
     settlement_id = Column(Integer, primary_key=True, autoincrement=True)
     payer_id = Column(Integer, ForeignKey("tbl_user.id"))
     payee_id = Column(Integer, ForeignKey("tbl_user.id"))
     group_id = Column(Integer, ForeignKey("tbl_group.id"))
-    amount = Column(DECIMAL(10, 2))
+    amount = Column(MoneyType)
     settled_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index("ix_settlements_payer", "payer_id"),
+        Index("ix_settlements_payee", "payee_id"),
+    )
+
+class SchemaVersion(Base):
+    __tablename__ = "tbl_schema_version"
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(DateTime, default=func.now())
+
+class ExpenseArchive(Base):
+    __tablename__ = "tbl_expenses_archive"
+    expense_id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey("tbl_group.id"), index=True)
+    description = Column(String(255))
+    amount = Column(MoneyType)
+    paid_by = Column(Integer, ForeignKey("tbl_user.id"))
+    created_by = Column(Integer, ForeignKey("tbl_user.id"))
+    split_type = Column(Enum("equal", "ratio", "percentage", "shares", "exact", "itemized", "adjustment"), default="equal")
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, default=func.now())
+
+class ExpenseSplitArchive(Base):
+    __tablename__ = "tbl_expense_split_archive"
+    split_id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, ForeignKey("tbl_expenses_archive.expense_id"), index=True)
+    user_id = Column(Integer, ForeignKey("tbl_user.id"))
+    share = Column(MoneyType)
+    paid = Column(MoneyType, default=0)
+    ratio = Column(Integer)
+
+class SettlementArchive(Base):
+    __tablename__ = "tbl_settlements_archive"
+    settlement_id = Column(Integer, primary_key=True)
+    payer_id = Column(Integer, ForeignKey("tbl_user.id"))
+    payee_id = Column(Integer, ForeignKey("tbl_user.id"))
+    group_id = Column(Integer, ForeignKey("tbl_group.id"), index=True)
+    amount = Column(MoneyType)
+    settled_at = Column(DateTime)
+    archived_at = Column(DateTime, default=func.now())
+
+class GroupShard(Base):
+    # The global directory of groups: hands out group ids and says which shard database holds each group
+    __tablename__ = "tbl_group_shard"
+    group_id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(55), index=True)
+    shard = Column(Integer, default=0, nullable=False)
+
+class BalanceCheckpoint(Base):
+    __tablename__ = "tbl_balance_checkpoint"
+    checkpoint_id = Column(Integer, primary_key=True, autoincrement=True)
+    group_id = Column(Integer, ForeignKey("tbl_group.id"), index=True)
+    archived_before = Column(DateTime)
+    created_at = Column(DateTime, default=func.now())
+
+class BalanceSnapshot(Base):
+    # Aggregated (payer, user) amounts of everything archived up to a checkpoint,
+    # in the same shape the balance engine reads splits and settlements
+    __tablename__ = "tbl_balance_snapshot"
+    checkpoint_id = Column(Integer, ForeignKey("tbl_balance_checkpoint.checkpoint_id"), primary_key=True)
+    kind = Column(Enum("split", "settlement"), primary_key=True)
+    payer_id = Column(Integer, ForeignKey("tbl_user.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("tbl_user.id"), primary_key=True)
+    amount = Column(MoneyType)
+
+class RecurringExpense(Base):
+    __tablename__ = "tbl_recurring_expenses"
+    recurring_id = Column(Integer, primary_key=True, autoincrement=True)
+    group_id = Column(Integer, ForeignKey("tbl_group.id"))
+    description = Column(String(255))
+    amount = Column(MoneyType)
+    paid_by = Column(Integer, ForeignKey("tbl_user.id"))
+    created_by = Column(Integer, ForeignKey("tbl_user.id"))
+    split_type = Column(Enum("equal", "ratio", "percentage", "shares", "exact", "itemized", "adjustment"), default="equal")
+    split_spec = Column(Text)  # JSON: {"members": [...], "values": [...], "items": [[amount, [member ids]], ...]}
+    interval_unit = Column(Enum("day", "week", "month"), default="month")
+    interval_count = Column(Integer, default=1)
+    starts_at = Column(DateTime)
+    occurrences = Column(Integer, default=0)  # Occurrences materialized so far, counted from starts_at
+    next_run_at = Column(DateTime)
+    active = Column(Boolean, default=True)
+    last_error = Column(String(255))
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index("ix_recurring_expenses_due", "active", "next_run_at"),
+    )
+
+class Lease(Base):
+    # Lets one worker out of many own a background job for a while
+    __tablename__ = "tbl_lease"
+    name = Column(String(55), primary_key=True)
+    owner = Column(String(255))
+    expires_at = Column(DateTime)
+
+class ImportJob(Base):
+    # Progress of a bulk expense import; rows_done is committed with each chunk so an import can resume
+    __tablename__ = "tbl_import_jobs"
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    group_id = Column(Integer, ForeignKey("tbl_group.id"))
+    created_by = Column(Integer, ForeignKey("tbl_user.id"))
+    source_path = Column(String(255))
+    file_format = Column(Enum("csv", "json"), default="csv")
+    status = Column(Enum("pending", "running", "done", "failed"), default="pending")
+    rows_done = Column(Integer, default=0)
+    rows_imported = Column(Integer, default=0)
+    rows_failed = Column(Integer, default=0)
+    errors = Column(Text)  # JSON list of the first failing rows
+    created_at = Column(DateTime, default=func.now())
+    modification_date = Column(
+        DateTime, default=func.now(), onupdate=func.now()
+    )
+
+class MonthlyRollup(Base):
+    __tablename__ = "tbl_monthly_rollup"
+    group_id = Column(Integer, ForeignKey("tbl_group.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("tbl_user.id"), primary_key=True)
+    month = Column(String(7), primary_key=True)  # "YYYY-MM"
+    paid = Column(MoneyType, default=0, nullable=False)         # Expenses this user paid for
+    share = Column(MoneyType, default=0, nullable=False)        # This user's share of the group's expenses
+    settled_out = Column(MoneyType, default=0, nullable=False)  # Settlements this user paid
+    settled_in = Column(MoneyType, default=0, nullable=False)   # Settlements this user received
+
+    __table_args__ = (
+        Index("ix_monthly_rollup_user_month", "user_id", "month"),
+    )
+
+class CoordinationEvent(Base):
+    __tablename__ = "tbl_coordination_events"
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    channel = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False)  # JSON message
+    origin = Column(String(100))  # Worker that published it; it already delivered the message to itself
+    created_at = Column(DateTime, default=func.now())
+
+# Everything that belongs to one group; in partitioned mode each shard database has only these
+GROUP_SCOPED_TABLES = [
+    model.__table__ for model in (
+        Group, GroupMember, Expense, ExpenseSplit, Settlement,
+        ExpenseArchive, ExpenseSplitArchive, SettlementArchive,
+        BalanceCheckpoint, BalanceSnapshot, RecurringExpense, ImportJob, MonthlyRollup,
+    )
+]
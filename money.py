@@ -0,0 +1,191 @@
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from sqlalchemy import Integer
+from sqlalchemy.types import TypeDecorator
+
+MINOR_UNITS = 100
+# Largest amount `parse` accepts (₹10 trillion). Balances are summed as int64 paise, so single amounts
+# stay far enough below 2**63 that thousands of them still add up without overflowing.
+MAX_PAISE = 10 ** 15
+CURRENCY_SYMBOL = "₹"
+
+
+class Money:
+    """An exact amount of money held as an integer number of paise."""
+
+    __slots__ = ("paise",)
+
+    def __init__(self, paise=0):
+        if isinstance(paise, Money):
+            paise = paise.paise
+        if not isinstance(paise, int) or isinstance(paise, bool):
+            raise TypeError(f"Money expects an integer number of paise, got {paise!r}")
+        self.paise = paise
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Build Money from user input in rupees such as "120", "99.5" or 12.25.
+
+        Raises ValueError for anything that is not a finite amount within
+        MAX_PAISE either way.
+        """
+        if isinstance(value, Money):
+            return value
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return cls(0)
+        try:
+            rupees = Decimal(str(value).strip())
+        except InvalidOperation:
+            raise ValueError(f"Invalid amount: {value!r}")
+        if not rupees.is_finite():
+            raise ValueError(f"Invalid amount: {value!r}")
+        try:
+            paise = int((rupees * MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        except InvalidOperation:
+            # More digits than the decimal context holds, e.g. "1e30"
+            raise ValueError(f"Amount out of range: {value!r}")
+        if abs(paise) > MAX_PAISE:
+            raise ValueError(f"Amount out of range: {value!r}")
+        return cls(paise)
+
+    def to_decimal(self):
+        return Decimal(self.paise) / MINOR_UNITS
+
+    def allocate(self, weights):
+        """
+        Split the amount proportionally to `weights` without losing a paisa.
+
+        Every part is floored and the leftover paise go to the parts with the
+        largest remainders, so the parts always sum back to the amount.
+        """
+        return [Money(part) for part in allocate_paise(self.paise, weights)]
+
+    def split_evenly(self, count):
+        return self.allocate([1] * count)
+
+    def __add__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return Money(self.paise + paise)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return Money(self.paise - paise)
+
+    def __rsub__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return Money(paise - self.paise)
+
+    def __neg__(self):
+        return Money(-self.paise)
+
+    def __abs__(self):
+        return Money(abs(self.paise))
+
+    def __bool__(self):
+        return self.paise != 0
+
+    def __eq__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return self.paise == paise
+
+    def __lt__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return self.paise < paise
+
+    def __le__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return self.paise <= paise
+
+    def __gt__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return self.paise > paise
+
+    def __ge__(self, other):
+        paise = _paise_of(other)
+        if paise is None:
+            return NotImplemented
+        return self.paise >= paise
+
+    def __hash__(self):
+        return hash(self.paise)
+
+    def __format__(self, format_spec):
+        return format(self.to_decimal(), format_spec or ".2f")
+
+    def __str__(self):
+        return f"{self.to_decimal():.2f}"
+
+    def __repr__(self):
+        return f"Money({self.paise})"
+
+    def display(self):
+        return f"{CURRENCY_SYMBOL} {self}"
+
+
+def allocate_paise(paise, weights):
+    """Money.allocate on plain integers: the parts of `paise`, in paise."""
+    weights = [int(weight) for weight in weights]
+    total_weight = sum(weights)
+    if not weights or total_weight <= 0 or any(weight < 0 for weight in weights):
+        raise ValueError("Weights must be non-negative and sum to more than zero.")
+
+    sign = -1 if paise < 0 else 1
+    amount = abs(paise)
+    parts = []
+    remainders = []
+    for index, weight in enumerate(weights):
+        part, remainder = divmod(amount * weight, total_weight)
+        parts.append(part)
+        remainders.append((remainder, -index))
+
+    leftover = amount - sum(parts)
+    for _, negative_index in sorted(remainders, reverse=True)[:leftover]:
+        parts[-negative_index] += 1
+
+    return [sign * part for part in parts]
+
+
+def _paise_of(other):
+    # Only Money and a literal zero (so `sum()` works) mix with Money.
+    if isinstance(other, Money):
+        return other.paise
+    if isinstance(other, int) and not isinstance(other, bool) and other == 0:
+        return 0
+    return None
+
+
+class MoneyType(TypeDecorator):
+    """Stores Money as an INTEGER column of paise so SQL SUM stays exact."""
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, Money):
+            return value.paise
+        if isinstance(value, int):
+            return value
+        raise TypeError(f"Expected Money or paise, got {value!r}")
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Money(int(value))
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import traceback
+from datetime import datetime, timedelta
+from admission import BUDGETS
+from coordination import coordinator
+from services import UNDO_SECONDS, purge_deleted_expenses
+
+PURGE_TICK_SECONDS = int(os.environ.get("OWE_NO_PURGE_TICK", 300))
+# This worker counts as quiet while no more than this many requests are running or queued in it
+QUIET_REQUESTS = int(os.environ.get("OWE_NO_PURGE_QUIET_REQUESTS", 2))
+LEASE_NAME = "purge-deleted-expenses"
+
+
+def is_quiet():
+    return sum(budget.active + budget.waiting for budget in BUDGETS.values()) <= QUIET_REQUESTS
+
+
+class PurgeWorker:
+    """
+    Removes deleted expenses once their undo window has passed.
+
+    Runs on a timer inside the web process like the recurring scheduler, one
+    worker at a time under a coordinator lease. It only starts, and only
+    moves on to the next batch, while this worker is quiet, so user-facing
+    requests never wait behind it. Takes one session factory per shard.
+    """
+
+    def __init__(self, session_factories, interval=PURGE_TICK_SECONDS):
+        self.session_factories = session_factories
+        self.interval = interval
+        self._task = None
+
+    def run_once(self):
+        if not is_quiet() or not coordinator.acquire_lease(LEASE_NAME, coordinator.worker_id, self.interval * 3):
+            return 0
+        before = datetime.now() - timedelta(seconds=UNDO_SECONDS)
+        purged = 0
+        for session_factory in self.session_factories:
+            with session_factory() as db:
+                purged += purge_deleted_expenses(db, before, keep_going=is_quiet)
+        return purged
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,170 @@
+import os
+import sqlite3
+from collections import defaultdict
+from sqlalchemy import func
+from coordination import coordinator
+from database import SHARD_COUNT, ShardSessions, SessionLocal, engine, shard_engines
+from models import Expense, GroupShard, Settlement
+
+LOCK_TIMEOUT_SECONDS = 30  # How long a move waits for in-flight writes on the shards it touches
+
+# Id columns that draw from one sequence per shard; ids are shifted past the target's on a move so they stay unique
+ID_SEQUENCES = {
+    "expense": [("tbl_expenses", "expense_id"), ("tbl_expenses_archive", "expense_id")],
+    "split": [("tbl_expense_split_table", "split_id"), ("tbl_expense_split_archive", "split_id")],
+    "settlement": [("tbl_settlements", "settlement_id"), ("tbl_settlements_archive", "settlement_id")],
+    "checkpoint": [("tbl_balance_checkpoint", "checkpoint_id")],
+    "recurring": [("tbl_recurring_expenses", "recurring_id")],
+    "import": [("tbl_import_jobs", "job_id")],
+}
+
+GROUP_ROWS = "group_id = :group_id"
+
+# Every group-scoped table as (table, which rows belong to the group, {column: what to add to it}), parents first.
+# {source} is the schema the group is moving from.
+MOVED_TABLES = [
+    # The version bump keeps fragments cached with the old ids from being served
+    ("tbl_group", "id = :group_id", {"version": "1"}),
+    ("tbl_group_member", GROUP_ROWS, {}),
+    ("tbl_expenses", GROUP_ROWS, {"expense_id": ":expense"}),
+    ("tbl_expense_split_table", "expense_id IN (SELECT expense_id FROM {source}.tbl_expenses WHERE group_id = :group_id)",
+     {"split_id": ":split", "expense_id": ":expense"}),
+    ("tbl_settlements", GROUP_ROWS, {"settlement_id": ":settlement"}),
+    ("tbl_expenses_archive", GROUP_ROWS, {"expense_id": ":expense"}),
+    ("tbl_expense_split_archive", "expense_id IN (SELECT expense_id FROM {source}.tbl_expenses_archive WHERE group_id = :group_id)",
+     {"split_id": ":split", "expense_id": ":expense"}),
+    ("tbl_settlements_archive", GROUP_ROWS, {"settlement_id": ":settlement"}),
+    ("tbl_balance_checkpoint", GROUP_ROWS, {"checkpoint_id": ":checkpoint"}),
+    ("tbl_balance_snapshot", "checkpoint_id IN (SELECT checkpoint_id FROM {source}.tbl_balance_checkpoint WHERE group_id = :group_id)",
+     {"checkpoint_id": ":checkpoint"}),
+    ("tbl_recurring_expenses", GROUP_ROWS, {"recurring_id": ":recurring"}),
+    ("tbl_import_jobs", GROUP_ROWS, {"job_id": ":import"}),
+    ("tbl_monthly_rollup", GROUP_ROWS, {}),
+]
+
+
+def _path(shard_engine):
+    return os.path.realpath(shard_engine.url.database)
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _shifts(conn, source, group_id):
+    """How far to move each id sequence so the group's ids land past everything already in the target."""
+    shifts = {}
+    for sequence, columns in ID_SEQUENCES.items():
+        target_max = max(conn.execute(f"SELECT COALESCE(MAX({column}), 0) FROM main.{table}").fetchone()[0] for table, column in columns)
+        source_mins = []
+        for table, column in columns:
+            condition = next(condition for moved, condition, _ in MOVED_TABLES if moved == table)
+            source_mins.append(conn.execute(
+                f"SELECT MIN({column}) FROM {source}.{table} WHERE {condition.format(source=source)}", {"group_id": group_id}
+            ).fetchone()[0])
+        source_mins = [value for value in source_mins if value is not None]
+        shifts[sequence] = max(0, target_max + 1 - min(source_mins)) if source_mins else 0
+    return shifts
+
+
+def move_group(group_id, target):
+    """
+    Move one group and all of its rows to shard `target`; returns the shard it came from.
+
+    Runs as one SQLite transaction on the target database with the source
+    shard and the global directory attached. BEGIN IMMEDIATE takes the
+    write lock on all of them, so writes to the group wait for the move
+    (or finish before it) and the copy, the delete and the directory update
+    commit together. Row ids are shifted past the target's own. Workers
+    learn about the move through the "group-shards" invalidation; one that
+    still writes to the old shard fails in bump_group_versions instead of
+    leaving rows behind, and its reads 404 until the message arrives.
+    """
+    with SessionLocal() as db:
+        source = db.query(GroupShard.shard).filter(GroupShard.group_id == group_id).scalar()
+    if source is None:
+        raise ValueError(f"Group {group_id} is not in the directory.")
+    if not 0 <= target < SHARD_COUNT:
+        raise ValueError(f"Shard {target} does not exist; OWE_NO_SHARDS is {SHARD_COUNT}.")
+    if source == target:
+        return source
+
+    conn = sqlite3.connect(_path(shard_engines[target]), timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+    try:
+        # The global database is also shard 0, so it may already be the source or the target
+        schemas = {_path(shard_engines[target]): "main"}
+        for alias, path in (("source", _path(shard_engines[source])), ("global", _path(engine))):
+            if path not in schemas:
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+                schemas[path] = alias
+        source_schema = schemas[_path(shard_engines[source])]
+        global_schema = schemas[_path(engine)]
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute(f"SELECT shard FROM {global_schema}.tbl_group_shard WHERE group_id = ?", (group_id,)).fetchone()
+            if current is None or current[0] != source:
+                raise RuntimeError(f"Group {group_id} moved while this move was starting; run it again.")
+
+            params = {"group_id": group_id, **_shifts(conn, source_schema, group_id)}
+            for table, condition, added in MOVED_TABLES:
+                source_columns = set(_columns(conn, source_schema, table))
+                columns = [column for column in _columns(conn, "main", table) if column in source_columns]
+                values = [f"{column} + {added[column]}" if column in added else column for column in columns]
+                conn.execute(
+                    f"INSERT INTO main.{table} ({', '.join(columns)}) SELECT {', '.join(values)} "
+                    f"FROM {source_schema}.{table} WHERE {condition.format(source=source_schema)}",
+                    params,
+                )
+            # Children first, while the rows their conditions select by are still there
+            for table, condition, _ in reversed(MOVED_TABLES):
+                conn.execute(f"DELETE FROM {source_schema}.{table} WHERE {condition.format(source=source_schema)}", params)
+            conn.execute(f"UPDATE {global_schema}.tbl_group_shard SET shard = ? WHERE group_id = ?", (target, group_id))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+    coordinator.invalidate("group-shards", group_id)
+    return source
+
+
+def shard_loads(since):
+    """{shard: {group_id: expenses and settlements written since `since`}}, the write load each group puts on its shard."""
+    loads = {}
+    for shard, Session in enumerate(ShardSessions):
+        counts = defaultdict(int)
+        with Session() as db:
+            for model, column in ((Expense, Expense.created_at), (Settlement, Settlement.settled_at)):
+                for group_id, count in db.query(model.group_id, func.count()).filter(column >= since).group_by(model.group_id):
+                    counts[group_id] += count
+        loads[shard] = dict(counts)
+    return loads
+
+
+def plan_rebalance(loads, max_moves):
+    """
+    Greedily pick (group_id, source, target) moves that even out the shard loads.
+
+    Each step moves the busiest group that still fits from the busiest
+    shard to the quietest one; a move only counts if it narrows the gap
+    between the two, so the plan always converges.
+    """
+    loads = {shard: dict(groups) for shard, groups in loads.items()}
+    totals = {shard: sum(groups.values()) for shard, groups in loads.items()}
+    moves = []
+    while len(moves) < max_moves:
+        busiest = max(totals, key=totals.get)
+        quietest = min(totals, key=totals.get)
+        gap = totals[busiest] - totals[quietest]
+        candidates = [(load, group_id) for group_id, load in loads[busiest].items() if 0 < load < gap]
+        if not candidates:
+            break
+        load, group_id = max(candidates)
+        moves.append((group_id, busiest, quietest))
+        loads[quietest][group_id] = loads[busiest].pop(group_id)
+        totals[busiest] -= load
+        totals[quietest] += load
+    return moves
@@ -0,0 +1,138 @@
+from collections import defaultdict
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import MonthlyRollup
+
+ROLLUP_COLUMNS = ("paid", "share", "settled_out", "settled_in")
+
+# Full history, including what compaction moved to the archive tables
+REBUILD_ROLLUPS_SQL = """
+    INSERT INTO tbl_monthly_rollup (group_id, user_id, month, paid, share, settled_out, settled_in)
+    SELECT group_id, user_id, month, SUM(paid), SUM(share), SUM(settled_out), SUM(settled_in)
+    FROM (
+        SELECT e.group_id, e.paid_by AS user_id, strftime('%Y-%m', e.created_at) AS month,
+               e.amount AS paid, 0 AS share, 0 AS settled_out, 0 AS settled_in
+        FROM {expenses} e WHERE e.paid_by IS NOT NULL AND e.amount IS NOT NULL {live}
+        UNION ALL
+        SELECT e.group_id, s.user_id, strftime('%Y-%m', e.created_at), 0, s.share, 0, 0
+        FROM {splits} s JOIN {expenses} e ON e.expense_id = s.expense_id
+        WHERE s.user_id IS NOT NULL AND s.share IS NOT NULL {live}
+        UNION ALL
+        SELECT group_id, payer_id, strftime('%Y-%m', settled_at), 0, 0, amount, 0
+        FROM {settlements} WHERE payer_id IS NOT NULL AND amount IS NOT NULL
+        UNION ALL
+        SELECT group_id, payee_id, strftime('%Y-%m', settled_at), 0, 0, 0, amount
+        FROM {settlements} WHERE payee_id IS NOT NULL AND amount IS NOT NULL
+    )
+    WHERE group_id IS NOT NULL AND month IS NOT NULL
+    GROUP BY group_id, user_id, month
+"""
+
+# Deleted expenses wait in the hot table until purged; compaction never archives them
+ROLLUP_SOURCES = [
+    {"expenses": "tbl_expenses", "splits": "tbl_expense_split_table", "settlements": "tbl_settlements", "live": "AND e.deleted_at IS NULL"},
+    {"expenses": "tbl_expenses_archive", "splits": "tbl_expense_split_archive", "settlements": "tbl_settlements_archive", "live": ""},
+]
+
+
+def month_of(when):
+    return when.strftime("%Y-%m")
+
+
+class RollupDeltas:
+    """
+    Changes to the monthly rollups collected while staging a write.
+
+    Every (group, user, month) is added up in memory first, so `apply` costs
+    one upsert per touched row no matter how many expenses were written.
+    """
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: dict.fromkeys(ROLLUP_COLUMNS, 0))
+
+    def _add(self, group_id, user_id, when, column, paise):
+        self._deltas[(int(group_id), int(user_id), month_of(when))][column] += paise
+
+    def add_expense(self, group_id, paid_by, amount, created_at, splits, sign=1):
+        """Count an expense; `splits` are (user_id, share) pairs. Use sign=-1 to take one back out."""
+        self._add(group_id, paid_by, created_at, "paid", sign * amount.paise)
+        for user_id, share in splits:
+            self._add(group_id, user_id, created_at, "share", sign * share.paise)
+
+    def apply(self, db):
+        """Stage the collected changes as one batched upsert; the caller commits."""
+        if not self._deltas:
+            return
+        statement = sqlite_insert(MonthlyRollup)
+        statement = statement.on_conflict_do_update(
+            index_elements=["group_id", "user_id", "month"],
+            set_={column: getattr(MonthlyRollup, column) + getattr(statement.excluded, column) for column in ROLLUP_COLUMNS},
+        )
+        db.execute(statement, [
+            {"group_id": group_id, "user_id": user_id, "month": month, **totals}
+            for (group_id, user_id, month), totals in self._deltas.items()
+        ])
+        self._deltas.clear()
+
+
+def rebuild_rollups(conn):
+    """Recompute every rollup row from the expense and settlement tables (hot and archived)."""
+    conn.execute(text("DELETE FROM tbl_monthly_rollup"))
+    for source in ROLLUP_SOURCES:
+        # Hot and archived rows of the same month land on the same key, so merge rather than insert
+        conn.execute(text(
+            REBUILD_ROLLUPS_SQL.format(**source) +
+            " ON CONFLICT (group_id, user_id, month) DO UPDATE SET "
+            + ", ".join(f"{column} = {column} + excluded.{column}" for column in ROLLUP_COLUMNS)
+        ))
+
+
+def _in_range(query, from_month, to_month):
+    if from_month:
+        query = query.filter(MonthlyRollup.month >= from_month)
+    if to_month:
+        query = query.filter(MonthlyRollup.month <= to_month)
+    return query
+
+
+def user_rollups(db, user_id, from_month=None, to_month=None):
+    """A user's rollup rows across all groups; one range read on (user_id, month)."""
+    query = db.query(MonthlyRollup).filter(MonthlyRollup.user_id == user_id)
+    return _in_range(query, from_month, to_month).order_by(MonthlyRollup.month).all()
+
+
+def group_rollups(db, group_id, from_month=None, to_month=None):
+    """Every member's rollup rows for one group; one range read on the primary key."""
+    query = db.query(MonthlyRollup).filter(MonthlyRollup.group_id == group_id)
+    return _in_range(query, from_month, to_month).order_by(MonthlyRollup.month).all()
+
+
+def rollup_series(rows, key, names):
+    """
+    Shape rollup rows for charting: one value per month for every column, in total and per `key`
+    ("group_id" or "user_id"), in rupees.
+    """
+    months = sorted({row.month for row in rows})
+    position = {month: index for index, month in enumerate(months)}
+    totals = {column: [0] * len(months) for column in ROLLUP_COLUMNS}
+    series = {}
+
+    for row in rows:
+        index = position[row.month]
+        series_id = getattr(row, key)
+        entry = series.get(series_id)
+        if entry is None:
+            entry = series[series_id] = {"id": series_id, "name": names.get(series_id, "Unknown"), **{column: [0] * len(months) for column in ROLLUP_COLUMNS}}
+        for column in ROLLUP_COLUMNS:
+            paise = getattr(row, column).paise
+            entry[column][index] += paise
+            totals[column][index] += paise
+
+    def in_rupees(values):
+        return {column: [paise / 100 for paise in values[column]] for column in ROLLUP_COLUMNS}
+
+    return {
+        "months": months,
+        "totals": in_rupees(totals),
+        "series": [{"id": entry["id"], "name": entry["name"], **in_rupees(entry)} for entry in series.values()],
+    }
@@ -0,0 +1,196 @@
+import asyncio
+import calendar
+import json
+import os
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from coordination import coordinator
+from models import RecurringExpense
+from money import Money
+from services import get_group_member_ids, insert_expenses
+from splits import allocate_splits, plan_split
+
+TICK_SECONDS = int(os.environ.get("OWE_NO_SCHEDULER_TICK", 60))
+BATCH_SIZE = 500  # Schedules materialized per transaction
+# Occurrences one schedule may catch up on per run; a schedule further behind finishes on later ticks
+MAX_CATCH_UP = int(os.environ.get("OWE_NO_SCHEDULER_MAX_CATCH_UP", 100))
+LEASE_NAME = "recurring-expenses"
+
+
+def add_months(when, months):
+    month_index = when.month - 1 + months
+    year, month = when.year + month_index // 12, month_index % 12 + 1
+    return when.replace(year=year, month=month, day=min(when.day, calendar.monthrange(year, month)[1]))
+
+
+def occurrence_at(starts_at, interval_unit, interval_count, occurrence):
+    """
+    Time of the n-th occurrence of a schedule.
+
+    Always counted from `starts_at` so month-end schedules do not drift
+    (Jan 31 -> Feb 28 -> Mar 31 rather than Mar 28).
+    """
+    steps = interval_count * occurrence
+    if interval_unit == "day":
+        return starts_at + timedelta(days=steps)
+    if interval_unit == "week":
+        return starts_at + timedelta(weeks=steps)
+    return add_months(starts_at, steps)
+
+
+def _schedule_plan(schedule, spec, group_member_ids):
+    """
+    Plan one occurrence's split among the people still in the group.
+
+    Members who left since the schedule was saved drop out of the split
+    (with their values and receipt lines); a split that no longer adds up
+    raises ValueError like any other invalid split.
+    """
+    if schedule.paid_by not in group_member_ids:
+        raise ValueError("The payer is no longer a member of the group.")
+    values = spec.get("values")
+    if values is None:
+        # Schedules saved before the split engine kept ratios and exact amounts (in paise) apart
+        values = spec.get("ratios") or [Money(share) for share in spec.get("exact_shares", [])]
+    member_ids = spec.get("members") or group_member_ids
+    current = set(group_member_ids)
+    if len(values) == len(member_ids):
+        values = [value for member_id, value in zip(member_ids, values) if member_id in current]
+    member_ids = [member_id for member_id in member_ids if member_id in current]
+    items = [(amount, [member_id for member_id in item_member_ids if member_id in current]) for amount, item_member_ids in spec.get("items", [])]
+    return plan_split(schedule.amount, schedule.split_type, member_ids, values, items)
+
+
+def _occurrence_expense(schedule, created_at):
+    return {
+        "group_id": schedule.group_id,
+        "description": schedule.description,
+        "amount": schedule.amount,
+        "paid_by": schedule.paid_by,
+        "split_type": schedule.split_type,
+        "created_by": schedule.created_by,
+        "created_at": created_at,
+    }
+
+
+def materialize_due(db, now=None, batch_size=BATCH_SIZE, max_catch_up=MAX_CATCH_UP):
+    """
+    Create the expenses of every schedule that is due, catching up on missed occurrences.
+
+    Each batch of schedules is one transaction: the new expenses and the
+    advanced `next_run_at` values commit together, so a crash never
+    materializes an occurrence twice. Every schedule is claimed by moving
+    its `occurrences` on from the count this run read; one another worker
+    claimed first is skipped, so overlapping runs never duplicate an
+    expense either. A schedule catches up on at most `max_catch_up`
+    occurrences per run. Returns the number of expenses created.
+    """
+    now = now or datetime.now()
+    created = 0
+    capped = set()  # Schedules still behind after this run's catch-up; left for the next run
+
+    while True:
+        schedules = (
+            db.query(RecurringExpense)
+            .filter(RecurringExpense.active.is_(True), RecurringExpense.next_run_at <= now, RecurringExpense.recurring_id.notin_(capped))
+            .order_by(RecurringExpense.next_run_at)
+            .limit(batch_size)
+            .all()
+        )
+        if not schedules:
+            return created
+
+        expenses = []
+        plans = []
+        schedule_updates = []
+        expenses_of = {}  # recurring_id -> indexes into `expenses`
+        group_members = {}
+        for schedule in schedules:
+            spec = json.loads(schedule.split_spec or "{}")
+            if schedule.group_id not in group_members:
+                group_members[schedule.group_id] = get_group_member_ids(db, schedule.group_id)
+
+            try:
+                plan = _schedule_plan(schedule, spec, group_members[schedule.group_id])
+            except ValueError as e:
+                # The split no longer works (e.g. the payer or everyone in it left the group); stop the schedule
+                schedule_updates.append((schedule.recurring_id, schedule.occurrences, {"active": False, "last_error": str(e)[:255]}))
+                continue
+
+            occurrences = schedule.occurrences
+            next_run_at = schedule.next_run_at
+            first = len(expenses)
+            while next_run_at <= now and occurrences - schedule.occurrences < max_catch_up:
+                expenses.append(_occurrence_expense(schedule, next_run_at))
+                plans.append(plan)
+                occurrences += 1
+                next_run_at = occurrence_at(schedule.starts_at, schedule.interval_unit, schedule.interval_count, occurrences)
+
+            if next_run_at <= now:
+                capped.add(schedule.recurring_id)
+            expenses_of[schedule.recurring_id] = range(first, len(expenses))
+            schedule_updates.append((schedule.recurring_id, schedule.occurrences, {"occurrences": occurrences, "next_run_at": next_run_at}))
+
+        # Every occurrence in the batch is split in one call
+        for expense, splits in zip(expenses, allocate_splits(plans)):
+            expense["splits"] = splits
+
+        # Drop the loaded objects so the UPDATEs below are not clobbered by stale state
+        db.expunge_all()
+        skipped = set()
+        for recurring_id, seen, values in schedule_updates:
+            claimed = db.execute(
+                update(RecurringExpense)
+                .where(RecurringExpense.recurring_id == recurring_id, RecurringExpense.occurrences == seen)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not claimed:
+                skipped.update(expenses_of.get(recurring_id, ()))
+        expenses = [expense for index, expense in enumerate(expenses) if index not in skipped]
+        if expenses:
+            insert_expenses(db, expenses)
+        db.commit()
+        created += len(expenses)
+
+
+class RecurringScheduler:
+    """
+    Materializes recurring expenses on a timer inside the web process; a coordinator lease keeps it to one worker.
+
+    Takes one session factory per shard and works through each in turn.
+    """
+
+    def __init__(self, session_factories, interval=TICK_SECONDS):
+        self.session_factories = session_factories
+        self.interval = interval
+        self._task = None
+
+    def run_once(self):
+        if not coordinator.acquire_lease(LEASE_NAME, coordinator.worker_id, self.interval * 3):
+            return 0
+        created = 0
+        for session_factory in self.session_factories:
+            with session_factory() as db:
+                created += materialize_due(db)
+        return created
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,165 @@
+import re
+from collections import namedtuple
+from datetime import timedelta
+from sqlalchemy import String, and_, column, desc, exists, literal_column, or_, select, table, type_coerce
+from sqlalchemy.orm import aliased
+from models import Expense, ExpenseSplit, Group, User
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# A text search names at most this many groups inside the full-text query; past that, OR-ing their terms costs
+# more than matching the whole index and dropping other groups' rows afterwards
+MAX_SCOPED_TEXT_GROUPS = 64
+
+# Full-text index over tbl_expenses.description and group_id, kept in step by triggers (migrations 7 and 8)
+FTS_TABLE = "tbl_expenses_fts"
+expenses_fts = table(FTS_TABLE, column("rowid"))
+
+# Compared as stored rather than as parsed datetimes, so a cursor matches its row exactly
+# whichever format SQLite or SQLAlchemy wrote the timestamp in
+created_at_text = type_coerce(Expense.created_at, String)
+
+SearchKey = namedtuple("SearchKey", ["created_at", "group_id", "expense_id"])
+# WHERE clauses for a search, and the full-text query ("" for none), which needs the groups to be built
+SearchFilter = namedtuple("SearchFilter", ["conditions", "text_query"])
+
+
+def fts_query(text):
+    """What the user typed as an FTS5 query: every word must appear, as a word or the start of one."""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text.lower()))
+
+
+def encode_cursor(key):
+    return f"{key.created_at}~{key.group_id}~{key.expense_id}"
+
+
+def decode_cursor(cursor):
+    """Raises ValueError for anything `encode_cursor` did not produce."""
+    created_at, group_id, expense_id = cursor.rsplit("~", 2)
+    return SearchKey(created_at, int(group_id), int(expense_id))
+
+
+def expense_conditions(text=None, min_amount=None, max_amount=None, from_date=None, to_date=None, paid_by=None, participant=None):
+    """
+    The SearchFilter for a search; every filter is optional.
+
+    The text goes through the full-text index, dates are whole days
+    (to_date included) and `participant` matches anyone with a share.
+    """
+    conditions = [Expense.deleted_at.is_(None), Expense.created_at.isnot(None)]
+    if min_amount is not None:
+        conditions.append(Expense.amount >= min_amount)
+    if max_amount is not None:
+        conditions.append(Expense.amount <= max_amount)
+    if from_date:
+        conditions.append(created_at_text >= from_date.isoformat())
+    if to_date:
+        conditions.append(created_at_text < (to_date + timedelta(days=1)).isoformat())
+    if paid_by is not None:
+        conditions.append(Expense.paid_by == paid_by)
+    if participant is not None:
+        # Probed per candidate through ix_expense_split_user, so an ordered scan can stop at the page size
+        conditions.append(exists().where(ExpenseSplit.expense_id == Expense.expense_id, ExpenseSplit.user_id == participant))
+    return SearchFilter(conditions, fts_query(text or ""))
+
+
+def _text_match(query, group_ids):
+    """Expenses of `group_ids` whose description matches the FTS5 `query`."""
+    query = f"description:({query})"
+    if len(group_ids) <= MAX_SCOPED_TEXT_GROUPS:
+        # The groups are terms of the index too, so only their rows are ever read
+        query = f"group_id:({' OR '.join(map(str, group_ids))}) AND {query}"
+    return Expense.expense_id.in_(select(expenses_fts.c.rowid).where(literal_column(FTS_TABLE).op("MATCH")(query)))
+
+
+def _after(cursor):
+    """Rows that sort after `cursor` in (created_at, group_id, expense_id) descending order."""
+    if cursor is None:
+        return []
+    # The first bound is the one an index range on (group_id, created_at) can use; the second settles ties at it
+    return [
+        created_at_text <= cursor.created_at,
+        or_(
+            created_at_text < cursor.created_at,
+            Expense.group_id < cursor.group_id,
+            and_(Expense.group_id == cursor.group_id, Expense.expense_id < cursor.expense_id),
+        ),
+    ]
+
+
+def _group_page(group_id, conditions, cursor, limit):
+    # Newest first straight off ix_expenses_live_group (or ix_expenses_live_group_payer), stopping after `limit` rows
+    return (
+        select(created_at_text.label("created_at"), Expense.group_id, Expense.expense_id)
+        .where(Expense.group_id == group_id, *conditions, *_after(cursor))
+        .order_by(desc(created_at_text), desc(Expense.expense_id))
+        .limit(limit)
+    )
+
+
+def search_keys(db, group_ids, search_filter, cursor=None, limit=PAGE_SIZE):
+    """
+    The first `limit` matching expenses of `group_ids` after `cursor`, as SearchKeys, newest first.
+
+    Each group's newest matches come from its own index range and only
+    those few rows are sorted together, so searching dozens of groups never
+    sorts their whole history. The statement is the same size however many
+    groups there are: the per-group page is a subquery correlated with each
+    tbl_group row. A text search instead starts from the full-text matches,
+    already narrowed to the groups inside the index.
+    """
+    conditions = search_filter.conditions
+    group_ids = sorted({int(group_id) for group_id in group_ids})
+    if not group_ids:
+        return []
+    if search_filter.text_query:
+        conditions = [*conditions, _text_match(search_filter.text_query, group_ids)]
+
+    if len(group_ids) == 1:
+        statement = _group_page(group_ids[0], conditions, cursor, limit)
+    elif not search_filter.text_query:
+        page = _group_page(Group.id, conditions, cursor, limit).with_only_columns(Expense.expense_id).correlate(Group)
+        newest = aliased(Expense)
+        newest_created_at = type_coerce(newest.created_at, String)
+        statement = (
+            select(newest_created_at.label("created_at"), newest.group_id, newest.expense_id)
+            .select_from(Group)
+            .join(newest, newest.expense_id.in_(page))
+            .where(Group.id.in_(group_ids))
+            .order_by(desc(newest_created_at), desc(newest.group_id), desc(newest.expense_id))
+            .limit(limit)
+        )
+    else:
+        statement = (
+            select(created_at_text.label("created_at"), Expense.group_id, Expense.expense_id)
+            .where(Expense.group_id.in_(group_ids), *conditions, *_after(cursor))
+            .order_by(desc(created_at_text), desc(Expense.group_id), desc(Expense.expense_id))
+            .limit(limit)
+        )
+    return [SearchKey(*row) for row in db.execute(statement)]
+
+
+def search_results(db, keys):
+    """The expenses behind `keys`, in the same order, with their group and payer."""
+    if not keys:
+        return []
+    rows = {
+        row.expense_id: row
+        for row in (
+            db.query(
+                Expense.expense_id, Expense.description, Expense.amount, Expense.paid_by, Expense.created_at,
+                Group.name.label("group_name"), User.first_name, User.last_name,
+            )
+            .join(Group, Group.id == Expense.group_id)
+            .outerjoin(User, User.id == Expense.paid_by)
+            .filter(Expense.expense_id.in_([key.expense_id for key in keys]))
+        )
+    }
+    return [(key, rows[key.expense_id]) for key in keys if key.expense_id in rows]
+
+
+def paginate(results, limit):
+    """Newest `limit` of (key, row) pairs gathered from any number of shards, and the cursor for the next page."""
+    results = sorted(results, key=lambda result: result[0], reverse=True)
+    next_cursor = encode_cursor(results[limit - 1][0]) if len(results) > limit else None
+    return results[:limit], next_cursor
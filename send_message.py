@@ -1,14 +1,29 @@
 # Download the helper library from https://www.twilio.com/docs/python/install
 import os
-from twilio.rest import Client
 
-account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-client = Client(account_sid, auth_token)
+_client = None
 
-message = client.messages.create( 
-                              from_='+12313665808', 
-                              body ='''
+
+def get_client():
+    # twilio is imported on first use so nothing pays for it unless a message is sent
+    global _client
+    if _client is None:
+        from twilio.rest import Client
+
+        account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
+        auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+        _client = Client(account_sid, auth_token)
+    return _client
+
+
+def send_message(to, body, from_='+12313665808'):
+    return get_client().messages.create(from_=from_, body=body, to=to)
+
+
+if __name__ == "__main__":
+    message = send_message(
+        to='+918295939353',
+        body='''
 
                               Hey Yash, Sudhir just added a new expense to the group:
 
@@ -18,8 +33,7 @@ Paid by: Sudhir
 
 Your share: 0
 
-Feel free to check it out on https://splitease.in''', 
-                              to ='+918295939353'
-                          ) 
-  
-print(message) 
+Feel free to check it out on https://splitease.in'''
+    )
+
+    print(message)
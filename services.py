@@ -1,12 +1,348 @@
-from database import SessionLocal, engine
+import os
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from threading import Lock
+from fastapi import Request
+from coordination import coordinator
+from database import SessionLocal, ShardSessions, SHARD_COUNT, engine, shard_engines
+from migrations import run_migrations
+from rollups import RollupDeltas
+from sqlalchemy import delete, insert, literal, select, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import models
 
+# How long a deleted expense can be restored before the purge worker removes it
+UNDO_SECONDS = int(os.environ.get("OWE_NO_UNDO_SECONDS", 3600))
+PURGE_BATCH_SIZE = 500  # Deleted expenses removed per transaction
+GROUP_SHARD_CACHE_SIZE = int(os.environ.get("OWE_NO_GROUP_SHARD_CACHE_SIZE", 100000))
+
+class GroupMovedError(RuntimeError):
+    """A write reached a shard the group has just been moved away from; nothing was committed."""
+
 def createDatabase():
     models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    for shard_engine in shard_engines[1:]:
+        # Each shard keeps its own schema version next to its copy of the group-scoped tables
+        models.Base.metadata.create_all(bind=shard_engine, tables=[*models.GROUP_SCOPED_TABLES, models.SchemaVersion.__table__])
+        run_migrations(shard_engine)
+
+def ensure_database():
+    """
+    Create and migrate the schema unless this process tree has already done it.
+
+    The production launcher runs this once in the master before forking
+    workers; the flag is inherited through the environment.
+    """
+    if os.environ.get("OWE_NO_SCHEMA_READY") == "1":
+        return
+    createDatabase()
+    os.environ["OWE_NO_SCHEMA_READY"] = "1"
+
+class _GroupShardCache:
+    """Per-worker LRU of group -> shard; moves are broadcast on the "group-shards" namespace."""
+
+    def __init__(self, max_size=GROUP_SHARD_CACHE_SIZE):
+        self.max_size = max_size
+        self.generation = 0  # Bumped by every invalidation, so a lookup that raced one isn't cached
+        self._shards = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, group_id):
+        with self._lock:
+            shard = self._shards.get(group_id)
+            if shard is not None:
+                self._shards.move_to_end(group_id)
+            return shard
+
+    def set(self, group_id, shard, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._shards[group_id] = shard
+            while len(self._shards) > self.max_size:
+                self._shards.popitem(last=False)
+
+    def invalidate(self, group_ids):
+        with self._lock:
+            self.generation += 1
+            if not group_ids:
+                self._shards.clear()
+            for group_id in group_ids:
+                self._shards.pop(int(group_id), None)
+
+
+group_shard_cache = _GroupShardCache()
+coordinator.on_invalidate("group-shards", group_shard_cache.invalidate)
 
-def get_db():
+def shard_of(group_id):
+    """The shard whose database holds the group; groups missing from the directory map to shard 0, where they are just as missing."""
+    if SHARD_COUNT == 1:
+        return 0
+    group_id = int(group_id)
+    shard = group_shard_cache.get(group_id)
+    if shard is None:
+        generation = group_shard_cache.generation
+        with SessionLocal() as db:
+            shard = db.query(models.GroupShard.shard).filter(models.GroupShard.group_id == group_id).scalar()
+        if shard is None:
+            return 0
+        if shard >= SHARD_COUNT:
+            raise RuntimeError(f"Group {group_id} is on shard {shard} but OWE_NO_SHARDS is {SHARD_COUNT}; move its groups off before removing a shard.")
+        group_shard_cache.set(group_id, shard, generation)
+    return shard
+
+def register_group(db, name):
+    """Add a group to the directory and commit; returns its id. New groups are spread over the shards by id."""
+    entry = models.GroupShard(name=name)
+    db.add(entry)
+    db.flush()
+    entry.shard = entry.group_id % SHARD_COUNT
+    db.commit()
+    return entry.group_id
+
+@contextmanager
+def group_session(group_id, db=None):
+    """A session on the group's shard: `db` (a global session) when that is shard 0, otherwise a new one closed on exit."""
+    shard = shard_of(group_id)
+    if shard == 0 and db is not None:
+        yield db
+        return
+    with ShardSessions[shard]() as shard_db:
+        yield shard_db
+
+def each_shard(db):
+    """A session per shard for queries that span groups: `db` (a global session, which is also shard 0) first."""
+    yield db
+    for Session in ShardSessions[1:]:
+        with Session() as shard_db:
+            yield shard_db
+
+def get_db(request: Request = None):
+    # Routes under a /{group_id} path get a session on that group's shard; the rest get the global database
+    group_id = request.path_params.get("group_id") if request is not None else None
+    db = ShardSessions[shard_of(group_id)]() if group_id is not None and str(group_id).isdigit() else SessionLocal()
     try:
-        db = SessionLocal()
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def get_group_version(db, group_id):
+    return db.query(models.Group.version).filter(models.Group.id == group_id).scalar() or 0
+
+def bump_group_versions(db, group_ids):
+    """Stage a version bump for every group a write touched, so fragments cached under the old version are never served again."""
+    group_ids = {int(group_id) for group_id in group_ids}
+    if group_ids:
+        bumped = db.execute(
+            update(models.Group)
+            .where(models.Group.id.in_(group_ids))
+            .values(version=models.Group.version + 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        # A group that vanished under the write was moved to another shard; fail rather than commit orphaned rows there
+        if bumped != len(group_ids):
+            raise GroupMovedError(f"Group moved to another shard while writing to {sorted(group_ids)}; try again.")
+
+def get_group_member_ids(db, group_id):
+    return [group_member.user_id for group_member in db.query(models.GroupMember.user_id).filter(models.GroupMember.group_id == group_id).all()]
+
+def insert_expenses(db, expenses):
+    """
+    Stage expenses and their splits on `db` with one bulk INSERT each; the caller commits.
+
+    Every item is a dict of Expense columns plus "splits", a list of
+    (user_id, share, ratio) tuples. The monthly rollups are updated along
+    with them. Returns the new expense ids in order.
+    """
+    expense_rows = [{key: value for key, value in expense.items() if key != "splits"} for expense in expenses]
+    inserted = db.execute(
+        insert(models.Expense).returning(models.Expense.expense_id, models.Expense.created_at, sort_by_parameter_order=True),
+        expense_rows
+    ).all()
+    expense_ids = [row.expense_id for row in inserted]
+
+    split_rows = [
+        {"expense_id": expense_id, "user_id": user_id, "share": share, "ratio": ratio}
+        for expense_id, expense in zip(expense_ids, expenses)
+        for user_id, share, ratio in expense["splits"]
+    ]
+    if split_rows:
+        db.execute(insert(models.ExpenseSplit), split_rows)
+
+    # Monthly rollups move in the same transaction, by the created_at the database stored
+    rollup_deltas = RollupDeltas()
+    for row, expense in zip(inserted, expenses):
+        rollup_deltas.add_expense(
+            expense["group_id"], expense["paid_by"], expense["amount"], row.created_at,
+            [(user_id, share) for user_id, share, _ in expense["splits"]]
+        )
+    rollup_deltas.apply(db)
+    bump_group_versions(db, {expense["group_id"] for expense in expenses})
+
+    return expense_ids
+
+def _insert_or_ignore(model):
+    # Rows that already exist (same primary key) are skipped instead of failing the whole statement
+    return sqlite_insert(model).on_conflict_do_nothing()
+
+def _ids(values):
+    return sorted({int(value) for value in values})
+
+def add_group_members(db, group_id, user_ids, added_by):
+    """
+    Stage adding every user in `user_ids` who is a friend of `added_by` to the group; the caller commits.
+
+    One INSERT ... SELECT does the whole batch, and members who are already
+    in the group are skipped. Returns the number of members added.
+    """
+    user_ids = _ids(user_ids)
+    if not user_ids:
+        return 0
+    friends = select(literal(int(group_id)), models.Friends.user_id).where(
+        models.Friends.friend_id == added_by,
+        models.Friends.user_id.in_(user_ids)
+    )
+    added = db.execute(
+        _insert_or_ignore(models.GroupMember).from_select(["group_id", "user_id"], friends)
+    ).rowcount
+    if added:
+        bump_group_versions(db, [group_id])
+    return added
+
+def remove_group_members(db, group_id, user_ids):
+    """Stage removing `user_ids` from the group with one DELETE; the caller commits. Returns the number removed."""
+    user_ids = _ids(user_ids)
+    if not user_ids:
+        return 0
+    removed = db.execute(
+        delete(models.GroupMember).where(
+            models.GroupMember.group_id == group_id,
+            models.GroupMember.user_id.in_(user_ids)
+        )
+    ).rowcount
+    if removed:
+        bump_group_versions(db, [group_id])
+    return removed
+
+def _pending_request_senders(db, user_id, sender_ids):
+    return db.scalars(
+        select(models.FriendRequests.friend_request_id).where(
+            models.FriendRequests.user_id == user_id,
+            models.FriendRequests.friend_request_id.in_(_ids(sender_ids))
+        )
+    ).all()
+
+def _delete_friend_requests_between(db, user_id, other_ids):
+    # Requests in either direction, so a crossed request does not linger after accepting
+    pairs = [(other_id, user_id) for other_id in other_ids] + [(user_id, other_id) for other_id in other_ids]
+    db.execute(
+        delete(models.FriendRequests).where(
+            tuple_(models.FriendRequests.friend_request_id, models.FriendRequests.user_id).in_(pairs)
+        )
+    )
+
+def accept_friend_requests(db, user_id, sender_ids):
+    """
+    Stage accepting the requests `user_id` received from `sender_ids`; the caller commits.
+
+    Both Friends rows of every pair are written with one INSERT and the
+    requests removed with one DELETE, so the caller's single commit makes
+    the whole batch atomic. Ids without a pending request are ignored.
+    Returns the ids of the new friends.
+    """
+    senders = _pending_request_senders(db, user_id, sender_ids)
+    if not senders:
+        return []
+    db.execute(
+        _insert_or_ignore(models.Friends),
+        [{"friend_id": sender, "user_id": user_id} for sender in senders] +
+        [{"friend_id": user_id, "user_id": sender} for sender in senders]
+    )
+    _delete_friend_requests_between(db, user_id, senders)
+    return senders
+
+def reject_friend_requests(db, user_id, sender_ids):
+    """Stage rejecting the requests `user_id` received from `sender_ids` with one DELETE; the caller commits."""
+    senders = _pending_request_senders(db, user_id, sender_ids)
+    if senders:
+        db.execute(
+            delete(models.FriendRequests).where(
+                models.FriendRequests.user_id == user_id,
+                models.FriendRequests.friend_request_id.in_(senders)
+            )
+        )
+    return senders
+
+def _apply_expense_rollups(db, group_id, expenses, sign):
+    splits = defaultdict(list)
+    expense_ids = [expense.expense_id for expense in expenses]
+    for split in db.query(models.ExpenseSplit).filter(models.ExpenseSplit.expense_id.in_(expense_ids), models.ExpenseSplit.share.isnot(None)):
+        splits[split.expense_id].append((split.user_id, split.share))
+
+    rollup_deltas = RollupDeltas()
+    for expense in expenses:
+        if expense.paid_by is not None and expense.amount is not None:
+            rollup_deltas.add_expense(group_id, expense.paid_by, expense.amount, expense.created_at, splits[expense.expense_id], sign=sign)
+    rollup_deltas.apply(db)
+
+def delete_expenses(db, group_id, expense_ids):
+    """
+    Stage deleting the group's expenses in `expense_ids`; the caller commits.
+
+    Deleting only sets the tombstone: every read skips the expense from then
+    on, `restore_expenses` can bring it back for UNDO_SECONDS, and the purge
+    worker removes the rows afterwards. The monthly rollups drop it right away.
+    """
+    expenses = db.query(models.Expense).filter(
+        models.Expense.group_id == group_id,
+        models.Expense.expense_id.in_(_ids(expense_ids)),
+        models.Expense.deleted_at.is_(None)
+    ).all()
+    if not expenses:
+        return 0
+    expense_ids = [expense.expense_id for expense in expenses]
+
+    _apply_expense_rollups(db, group_id, expenses, sign=-1)
+    db.execute(update(models.Expense).where(models.Expense.expense_id.in_(expense_ids)).values(deleted_at=datetime.now()))
+    bump_group_versions(db, [group_id])
+    return len(expense_ids)
+
+def restore_expenses(db, group_id, expense_ids):
+    """Stage undoing the deletion of the group's expenses in `expense_ids` still inside the undo window; the caller commits."""
+    expenses = db.query(models.Expense).filter(
+        models.Expense.group_id == group_id,
+        models.Expense.expense_id.in_(_ids(expense_ids)),
+        models.Expense.deleted_at >= datetime.now() - timedelta(seconds=UNDO_SECONDS)
+    ).all()
+    if not expenses:
+        return 0
+    expense_ids = [expense.expense_id for expense in expenses]
+
+    _apply_expense_rollups(db, group_id, expenses, sign=1)
+    db.execute(update(models.Expense).where(models.Expense.expense_id.in_(expense_ids)).values(deleted_at=None))
+    bump_group_versions(db, [group_id])
+    return len(expense_ids)
+
+def purge_deleted_expenses(db, before, batch_size=PURGE_BATCH_SIZE, keep_going=lambda: True):
+    """
+    Remove expenses deleted before `before` and their splits, committing one batch at a time.
+
+    Their rollups were already taken out when they were deleted and no read
+    sees them, so nothing else changes. Stops early once `keep_going()` is
+    False. Returns how many expenses were removed.
+    """
+    purged = 0
+    while keep_going():
+        expense_ids = [
+            row.expense_id
+            for row in db.query(models.Expense.expense_id).filter(models.Expense.deleted_at < before).limit(batch_size)
+        ]
+        if not expense_ids:
+            break
+        db.execute(delete(models.ExpenseSplit).where(models.ExpenseSplit.expense_id.in_(expense_ids)))
+        db.execute(delete(models.Expense).where(models.Expense.expense_id.in_(expense_ids)))
+        db.commit()
+        purged += len(expense_ids)
+    return purged
@@ -0,0 +1,235 @@
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
+import numpy as np
+from money import Money, allocate_paise
+
+# Percentages and share weights may have up to two decimal places; they are allocated as integers of this scale
+WEIGHT_SCALE = 100
+# Above this amount * weight the int64 batch path could overflow, so such plans take the exact Python path
+MAX_BATCH_PRODUCT = 2 ** 62
+
+SPLIT_TYPE_ALIASES = {"ratio": "percentage"}  # Expenses and schedules stored before percentages took decimals
+
+class SplitPlan(namedtuple("SplitPlan", ["member_ids", "weights", "allocated", "offsets", "ratios"])):
+    """
+    A validated split, ready to allocate.
+
+    Member i's share is their part of `allocated` paise in proportion to
+    `weights` (largest remainder, like Money.allocate), plus `offsets[i]`
+    paise. `ratios` is what tbl_expense_split_table.ratio records.
+    """
+
+
+def _member_ids(member_ids):
+    member_ids = [int(member_id) for member_id in member_ids]
+    if not member_ids:
+        raise ValueError("At least one member is needed to split an expense.")
+    if len(set(member_ids)) != len(member_ids):
+        raise ValueError("Each member can only be listed once.")
+    return member_ids
+
+
+def _one_per_member(values, member_ids, what):
+    if len(values) != len(member_ids):
+        raise ValueError(f"Provide one {what} per selected member.")
+
+
+def _scaled(value, what):
+    """Parse a percentage or weight with at most two decimals into an integer of WEIGHT_SCALE."""
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid {what}: {value!r}")
+    scaled = number * WEIGHT_SCALE
+    if not number.is_finite() or scaled != scaled.to_integral_value():
+        raise ValueError(f"Invalid {what}: {value!r}; use at most two decimal places.")
+    if number < 0:
+        raise ValueError(f"A {what} cannot be negative.")
+    return int(scaled)
+
+
+def _ratio(scaled):
+    return scaled // WEIGHT_SCALE if scaled % WEIGHT_SCALE == 0 else round(scaled / WEIGHT_SCALE)
+
+
+def _money(value):
+    return value if isinstance(value, Money) else Money.parse(value)
+
+
+def plan_equal(amount, member_ids, values, items):
+    member_ids = _member_ids(member_ids)
+    count = len(member_ids)
+    return SplitPlan(member_ids, (1,) * count, amount.paise, None, (0,) * count)
+
+
+def plan_percentage(amount, member_ids, values, items):
+    member_ids = _member_ids(member_ids)
+    if not values:
+        raise ValueError("Percentages must be provided for a percentage split.")
+    _one_per_member(values, member_ids, "percentage")
+    weights = tuple(_scaled(value, "percentage") for value in values)
+    if sum(weights) != 100 * WEIGHT_SCALE:
+        raise ValueError(f"The sum of the percentages must equal 100. Current sum: {Decimal(sum(weights)) / WEIGHT_SCALE}")
+    return SplitPlan(member_ids, weights, amount.paise, None, tuple(_ratio(weight) for weight in weights))
+
+
+def plan_shares(amount, member_ids, values, items):
+    member_ids = _member_ids(member_ids)
+    if not values:
+        raise ValueError("Shares must be provided for a split by shares.")
+    _one_per_member(values, member_ids, "share")
+    weights = tuple(_scaled(value, "share") for value in values)
+    if not sum(weights):
+        raise ValueError("At least one member needs more than zero shares.")
+    return SplitPlan(member_ids, weights, amount.paise, None, tuple(_ratio(weight) for weight in weights))
+
+
+def plan_exact(amount, member_ids, values, items):
+    member_ids = _member_ids(member_ids)
+    _one_per_member(values, member_ids, "exact amount")
+    shares = [_money(value) for value in values]
+    if any(share < Money(0) for share in shares):
+        raise ValueError("An exact amount cannot be negative.")
+    if sum(shares) != amount:
+        raise ValueError(f"The sum of the exact amounts must equal {amount}. Current sum: {sum(shares)}")
+    count = len(member_ids)
+    return SplitPlan(member_ids, (1,) * count, 0, tuple(share.paise for share in shares), (0,) * count)
+
+
+def plan_adjustment(amount, member_ids, values, items):
+    """Split what is left after everyone's adjustment equally, then add each adjustment back on."""
+    member_ids = _member_ids(member_ids)
+    _one_per_member(values, member_ids, "adjustment")
+    adjustments = [_money(value).paise for value in values]
+    remaining = amount.paise - sum(adjustments)
+    if remaining < 0:
+        raise ValueError("The adjustments add up to more than the amount.")
+    # Equal parts are floor(remaining / n), plus one paisa for the first remaining % n members
+    base, leftover = divmod(remaining, len(member_ids))
+    if any(base + (index < leftover) + adjustment < 0 for index, adjustment in enumerate(adjustments)):
+        raise ValueError("An adjustment cannot make a member's share negative.")
+    count = len(member_ids)
+    return SplitPlan(member_ids, (1,) * count, remaining, tuple(adjustments), (0,) * count)
+
+
+def plan_itemized(amount, member_ids, values, items):
+    """
+    Receipt lines: every item is split equally among the members who had it
+    (everyone in `member_ids` when it names nobody). Whatever the items do not
+    cover, such as tax, tip or a service charge, is shared in proportion to
+    each member's item total.
+    """
+    if not items:
+        raise ValueError("Add at least one item for an itemized split.")
+    everyone = [int(member_id) for member_id in member_ids]
+    subtotals = defaultdict(int)
+    for item in items:
+        item_amount, item_member_ids = _money(item[0]), item[1]
+        if item_amount <= Money(0):
+            raise ValueError("Every item needs an amount greater than zero.")
+        item_member_ids = _member_ids(item_member_ids or everyone)
+        for member_id, part in zip(item_member_ids, item_amount.split_evenly(len(item_member_ids))):
+            subtotals[member_id] += part.paise
+
+    remaining = amount.paise - sum(subtotals.values())
+    if remaining < 0:
+        raise ValueError(f"The items add up to more than the amount of {amount}.")
+    member_ids = tuple(subtotals)
+    offsets = tuple(subtotals.values())
+    return SplitPlan(member_ids, offsets, remaining, offsets, (0,) * len(member_ids))
+
+
+STRATEGIES = {
+    "equal": plan_equal,
+    "percentage": plan_percentage,
+    "shares": plan_shares,
+    "exact": plan_exact,
+    "itemized": plan_itemized,
+    "adjustment": plan_adjustment,
+}
+
+
+def normalize_split_type(split_type):
+    split_type = (split_type or "equal").strip().lower()
+    split_type = SPLIT_TYPE_ALIASES.get(split_type, split_type)
+    if split_type not in STRATEGIES:
+        raise ValueError(f"Unknown split type {split_type!r}.")
+    return split_type
+
+
+def plan_split(amount, split_type, member_ids, values=(), items=()):
+    """
+    Validate one expense's split and return its SplitPlan.
+
+    `values` are per-member percentages, shares, exact amounts or
+    adjustments, in `member_ids` order; `items` are (amount, member_ids)
+    receipt lines. Raises ValueError when they do not fit the split type.
+    """
+    return STRATEGIES[normalize_split_type(split_type)](amount, member_ids, list(values), list(items))
+
+
+def _allocate_batch(amounts, weights):
+    """
+    allocate_paise for many amounts over the same weights at once.
+
+    Rows are floored in one vectorized step; each row's leftover paise go to
+    its largest remainders, ties to the earlier member, exactly as
+    allocate_paise does.
+    """
+    amounts = np.asarray(amounts, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.int64)
+    signs = np.where(amounts < 0, -1, 1)
+    amounts = np.abs(amounts)
+
+    parts, remainders = np.divmod(amounts[:, None] * weights[None, :], weights.sum())
+    leftover = amounts - parts.sum(axis=1)
+    order = np.argsort(-remainders, axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(len(weights)), order.shape), axis=1)
+    parts += ranks < leftover[:, None]
+    return parts * signs[:, None]
+
+
+def allocate_splits(plans):
+    """
+    Turn plans into (user_id, share, ratio) lists, in order.
+
+    Plans with the same weights (every equal split among n people, every
+    50/50 percentage split...) are allocated together in one NumPy pass, so a
+    batch of thousands of expenses costs a handful of array operations
+    rather than one Money.allocate call each.
+    """
+    parts = [None] * len(plans)
+    by_weights = defaultdict(list)
+    for index, plan in enumerate(plans):
+        if plan.allocated == 0:
+            parts[index] = [0] * len(plan.weights)
+        elif abs(plan.allocated) * max(plan.weights) >= MAX_BATCH_PRODUCT:
+            parts[index] = allocate_paise(plan.allocated, plan.weights)
+        else:
+            by_weights[plan.weights].append(index)
+
+    for weights, indexes in by_weights.items():
+        if len(indexes) == 1:
+            parts[indexes[0]] = allocate_paise(plans[indexes[0]].allocated, weights)
+            continue
+        rows = _allocate_batch([plans[index].allocated for index in indexes], weights)
+        for index, row in zip(indexes, rows.tolist()):
+            parts[index] = row
+
+    splits = []
+    for plan, plan_parts in zip(plans, parts):
+        if plan.offsets:
+            plan_parts = map(int.__add__, plan_parts, plan.offsets)
+        splits.append(list(zip(plan.member_ids, map(Money, plan_parts), plan.ratios)))
+    return splits
+
+
+def split_expense(amount, split_type, member_ids, values=(), items=()):
+    """Work out each member's share of `amount` as (user_id, share, ratio) tuples; see `plan_split`."""
+    return allocate_splits([plan_split(amount, split_type, member_ids, values, items)])[0]
+
+
+def split_expenses(specs):
+    """Split many expenses in one call; `specs` are `plan_split` argument tuples. Raises on the first invalid one."""
+    return allocate_splits([plan_split(*spec) for spec in specs])
@@ -0,0 +1,166 @@
+import os
+import time
+from collections import namedtuple
+from threading import RLock
+import numpy as np
+from balances import fetch_columns
+from coordination import coordinator
+from services import each_shard, group_session
+
+SUGGESTION_LIMIT = 10
+MUTUAL_FRIEND_WEIGHT = 3
+SHARED_GROUP_WEIGHT = 1
+# Sharing a huge group (a whole event or office) says little about knowing someone, and would dominate the work
+MAX_GROUP_SIZE = int(os.environ.get("OWE_NO_SUGGESTION_MAX_GROUP", 200))
+# A full rebuild this often, in case a coordination message was ever missed
+REFRESH_SECONDS = int(os.environ.get("OWE_NO_SUGGESTION_REFRESH", 300))
+
+FRIENDS_SQL = "SELECT user_id, friend_id FROM tbl_friends"
+MEMBERS_SQL = "SELECT group_id, user_id FROM tbl_group_member"
+GROUP_MEMBERS_SQL = "SELECT user_id FROM tbl_group_member WHERE group_id = :group_id"
+
+EMPTY = np.empty(0, dtype=np.int64)
+
+Suggestion = namedtuple("Suggestion", ["user_id", "score", "mutual_friends", "shared_groups"])
+
+
+def _adjacency(pairs):
+    """Turn (key, value) rows into {key: sorted unique int64 array of values}."""
+    if not len(pairs):
+        return {}
+    pairs = np.unique(pairs, axis=0)  # Sorted by key, then value
+    keys, starts = np.unique(pairs[:, 0], return_index=True)
+    return dict(zip(keys.tolist(), np.split(pairs[:, 1], starts[1:])))
+
+
+class FriendGraph:
+    """
+    A per-worker adjacency index of friendships and group memberships.
+
+    Every user's friends, every user's groups and every group's members are
+    kept as sorted int64 arrays, so the two-hop walk behind a suggestion is a
+    concatenation and a bincount instead of a Python loop. The index is built
+    from the database on first use, kept current by the routes that change
+    friendships or memberships, and rebuilt every REFRESH_SECONDS as a
+    backstop. Changes are announced on the "friend-graph" channel so every
+    worker's index follows them: new friendships are applied as they arrive,
+    changed groups are re-read on the next `ensure_fresh`.
+    """
+
+    CHANNEL = "friend-graph"
+
+    def __init__(self):
+        self._friends = {}  # user_id -> friend ids
+        self._groups = {}   # user_id -> group ids
+        self._members = {}  # group_id -> member ids
+        self._dirty_groups = set()
+        self._lock = RLock()
+        self.built_at = None
+        coordinator.subscribe(self.CHANNEL, self._on_message)
+        coordinator.on_invalidate(self.CHANNEL, lambda keys: self.reset())
+
+    def load(self, db):
+        friendships = fetch_columns(db, FRIENDS_SQL, {}, 2)
+        memberships = np.concatenate([fetch_columns(shard_db, MEMBERS_SQL, {}, 2) for shard_db in each_shard(db)])
+        friends = _adjacency(friendships)
+        members = _adjacency(memberships)
+        groups = _adjacency(memberships[:, ::-1])
+        with self._lock:
+            self._friends, self._groups, self._members = friends, groups, members
+            self._dirty_groups.clear()
+            self.built_at = time.monotonic()
+
+    def reset(self):
+        """Forget the index; the next `ensure_fresh` rebuilds it."""
+        with self._lock:
+            self.built_at = None
+
+    def ensure_fresh(self, db):
+        if self.built_at is None or time.monotonic() - self.built_at > REFRESH_SECONDS:
+            self.load(db)
+            return
+        with self._lock:
+            dirty, self._dirty_groups = self._dirty_groups, set()
+        for group_id in dirty:
+            self.refresh_group(db, group_id)
+
+    def friendships_added(self, user_id, friend_ids):
+        """Announce committed friendships to every worker's index, this one included."""
+        coordinator.publish(self.CHANNEL, {"friendships": [int(user_id), [int(friend_id) for friend_id in friend_ids]]})
+
+    def group_changed(self, group_id):
+        """Announce that a group's members changed; every worker re-reads it before its next suggestion."""
+        coordinator.publish(self.CHANNEL, {"group": int(group_id)})
+
+    def _on_message(self, message):
+        if "friendships" in message:
+            self.add_friendships(*message["friendships"])
+        elif "group" in message and self.built_at is not None:
+            with self._lock:
+                self._dirty_groups.add(message["group"])
+
+    def add_friendships(self, user_id, friend_ids):
+        friend_ids = np.asarray(list(friend_ids), dtype=np.int64)
+        if self.built_at is None or not len(friend_ids):
+            return  # Nothing cached yet; the first load reads them anyway
+        with self._lock:
+            self._friends[user_id] = np.union1d(self._friends.get(user_id, EMPTY), friend_ids)
+            for friend_id in friend_ids.tolist():
+                self._friends[friend_id] = np.union1d(self._friends.get(friend_id, EMPTY), [user_id])
+
+    def refresh_group(self, db, group_id):
+        """Re-read one group's members after it changed."""
+        if self.built_at is None:
+            return
+        with group_session(group_id, db) as group_db:
+            member_ids = np.unique(fetch_columns(group_db, GROUP_MEMBERS_SQL, {"group_id": group_id}, 1)[:, 0])
+        with self._lock:
+            previous = self._members.pop(group_id, EMPTY)
+            for user_id in np.setdiff1d(previous, member_ids).tolist():
+                self._groups[user_id] = np.setdiff1d(self._groups.get(user_id, EMPTY), [group_id])
+            for user_id in np.setdiff1d(member_ids, previous).tolist():
+                self._groups[user_id] = np.union1d(self._groups.get(user_id, EMPTY), [group_id])
+            if len(member_ids):
+                self._members[group_id] = member_ids
+
+    def suggest(self, user_id, limit=SUGGESTION_LIMIT, exclude=()):
+        """
+        Rank people `user_id` may know by mutual friends and shared groups.
+
+        Every 2-hop neighbour is a candidate, so they are gathered into one
+        array; np.unique then counts each id that occurs, making the work
+        follow the size of that neighbourhood rather than the largest user
+        id. argpartition picks the best `limit` in linear time (a top-K
+        heap without the per-item Python), so only the returned candidates
+        are ever sorted or turned into Python objects.
+        """
+        with self._lock:
+            friends = self._friends.get(user_id, EMPTY)
+            friend_hops = [self._friends.get(friend_id, EMPTY) for friend_id in friends.tolist()]
+            group_hops = [
+                members
+                for members in (self._members.get(group_id, EMPTY) for group_id in self._groups.get(user_id, EMPTY).tolist())
+                if len(members) <= MAX_GROUP_SIZE
+            ]
+
+        friends_of_friends = np.concatenate([EMPTY, *friend_hops])
+        candidates, occurrences = np.unique(np.concatenate([friends_of_friends, *group_hops]), return_inverse=True)
+        mutual = np.bincount(occurrences[:len(friends_of_friends)], minlength=len(candidates))
+        shared = np.bincount(occurrences[len(friends_of_friends):], minlength=len(candidates))
+        score = mutual * MUTUAL_FRIEND_WEIGHT + shared * SHARED_GROUP_WEIGHT
+
+        skip = np.concatenate([friends, np.fromiter(exclude, dtype=np.int64), [user_id]])
+        score[np.isin(candidates, skip)] = 0
+
+        best = np.flatnonzero(score)
+        if len(best) > limit:
+            best = best[np.argpartition(-score[best], limit - 1)[:limit]]
+        best = best[np.lexsort((candidates[best], -score[best]))]
+
+        return [
+            Suggestion(int(candidates[index]), int(score[index]), int(mutual[index]), int(shared[index]))
+            for index in best.tolist()
+        ]
+
+
+friend_graph = FriendGraph()
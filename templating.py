@@ -0,0 +1,95 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from starlette.templating import Jinja2Templates
+from coordination import coordinator
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+# Compiled templates are kept on disk so a freshly started worker loads bytecode instead of compiling
+BYTECODE_CACHE_DIR = os.environ.get("OWE_NO_TEMPLATE_CACHE", os.path.join(dir_path, ".jinja_cache"))
+# Checking template files for changes on every render is only worth it while developing
+AUTO_RELOAD = os.environ.get("OWE_NO_TEMPLATE_RELOAD", "0") == "1"
+FRAGMENT_CACHE_SIZE = int(os.environ.get("OWE_NO_FRAGMENT_CACHE_SIZE", 4096))
+
+
+class FragmentCache:
+    """A per-worker LRU of rendered HTML fragments."""
+
+    def __init__(self, max_size=FRAGMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self._fragments = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment):
+        with self._lock:
+            self._fragments[key] = fragment
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.max_size:
+                self._fragments.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+
+fragment_cache = FragmentCache()
+# Fragments are keyed by version, so this is only needed after changing data behind the app's back
+coordinator.on_invalidate("fragments", lambda keys: fragment_cache.clear())
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds `{% cache "name", key, ... %}...{% endcache %}`.
+
+    The block renders once per distinct key and its HTML is reused after
+    that. Keys must capture everything the block depends on; for group pages
+    that means the group's version, which every write bumps, so stale
+    entries are never hit again and simply age out of the LRU.
+    """
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render_cached", [nodes.List(key_parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render_cached(self, key_parts, caller):
+        key = tuple(key_parts)
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            fragment = Markup(caller())
+            fragment_cache.set(key, fragment)
+        return fragment
+
+
+os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+
+templates = Jinja2Templates(
+    directory=f"{dir_path}/templates",
+    bytecode_cache=FileSystemBytecodeCache(BYTECODE_CACHE_DIR),
+    auto_reload=AUTO_RELOAD,
+    extensions=[FragmentCacheExtension],
+)
+
+
+def precompile_templates():
+    """Compile every template up front (from the bytecode cache when possible) so no request pays for it."""
+    for name in templates.env.list_templates(extensions=["html"]):
+        templates.get_template(name)
@@ -0,0 +1,15 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from migrations import run_migrations
+from models import Base
+
+
+@pytest.fixture
+def Session(tmp_path):
+    """Session factory on a fresh, fully migrated database."""
+    engine = create_engine(f"sqlite:///{tmp_path}/owe_no.db")
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
@@ -0,0 +1,40 @@
+import admission
+from admission import RateLimiter, login_retry_after, metrics_allowed
+
+
+def _fresh_limiters(monkeypatch):
+    monkeypatch.setattr(admission, "login_limiter", RateLimiter(rate=5 / 60, capacity=5))
+    monkeypatch.setattr(admission, "login_ip_limiter", RateLimiter(rate=1, capacity=100))
+
+
+def test_one_address_can_log_in_many_accounts(monkeypatch):
+    _fresh_limiters(monkeypatch)
+    assert all(login_retry_after(f"user{i}@example.com", "10.0.0.1") == 0 for i in range(50))
+
+
+def test_account_is_limited_whatever_the_case_or_spacing(monkeypatch):
+    _fresh_limiters(monkeypatch)
+    spellings = ["asha@example.com", "Asha@Example.com", " ASHA@example.com ", "asha@example.com ", "aSha@example.com"]
+    assert [login_retry_after(email, f"10.0.0.{i}") for i, email in enumerate(spellings)] == [0] * 5
+    assert login_retry_after("ASHA@EXAMPLE.COM", "10.0.0.9") > 0
+    assert login_retry_after("ravi@example.com", "10.0.0.9") == 0
+
+
+def test_address_limit_does_not_spend_account_tokens(monkeypatch):
+    _fresh_limiters(monkeypatch)
+    monkeypatch.setattr(admission, "login_ip_limiter", RateLimiter(rate=1 / 60, capacity=2))
+    assert login_retry_after("asha@example.com", "10.0.0.1") == 0
+    assert login_retry_after("asha@example.com", "10.0.0.1") == 0
+    for _ in range(10):
+        assert login_retry_after("asha@example.com", "10.0.0.1") > 0
+    # Only the two admitted attempts came out of the account's five
+    assert int(admission.login_limiter._buckets["account:asha@example.com"].tokens) == 3
+
+
+def test_metrics_need_the_configured_token(monkeypatch):
+    monkeypatch.setattr(admission, "METRICS_TOKEN", "")
+    assert not metrics_allowed("Bearer ")
+    monkeypatch.setattr(admission, "METRICS_TOKEN", "s3cret")
+    assert metrics_allowed("Bearer s3cret")
+    assert not metrics_allowed(None)
+    assert not metrics_allowed("Bearer wrong")
@@ -0,0 +1,129 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from balances import load_group_balances, user_net_balances, user_totals
+from compaction import compact_group
+from models import Group, GroupMember, Settlement, User
+from money import Money
+from services import delete_expenses, insert_expenses
+
+
+def _expense(group_id, paid_by, splits, day):
+    return {
+        "group_id": group_id, "description": "Expense", "amount": Money(sum(splits.values())), "paid_by": paid_by, "created_by": paid_by,
+        "split_type": "exact", "created_at": datetime(2026, 1, day), "splits": [(user_id, Money(share), 1) for user_id, share in splits.items()],
+    }
+
+
+@pytest.fixture
+def group(Session):
+    """
+    Group 1 of users 1-4, worked out by hand (in paise):
+
+    1 paid 300 split 100 each among 1, 2, 3; 2 paid 90 for 1 (30) and 3 (60);
+    3 paid 1 back 50; an expense of 1000 by 4 was deleted; 4 did nothing else.
+    So 2 owes 1 70, 3 owes 1 50 and 3 owes 2 60: nets are 1 +120, 2 -10, 3 -110, 4 0.
+    """
+    with Session() as db:
+        db.add_all([User(id=user_id, first_name=f"U{user_id}", last_name="", password="") for user_id in (1, 2, 3, 4)])
+        db.add(Group(id=1, name="Trip"))
+        db.add_all([GroupMember(group_id=1, user_id=user_id) for user_id in (1, 2, 3, 4)])
+        db.flush()
+        deleted = insert_expenses(db, [
+            _expense(1, 1, {1: 100, 2: 100, 3: 100}, day=1),
+            _expense(1, 2, {1: 30, 3: 60}, day=2),
+            _expense(1, 4, {1: 500, 2: 500}, day=3),
+        ])[-1]
+        db.add(Settlement(group_id=1, payer_id=3, payee_id=1, amount=Money(50), settled_at=datetime(2026, 1, 4)))
+        delete_expenses(db, 1, [deleted])
+        db.commit()
+    return Session
+
+
+def _check(balances):
+    assert balances.member_ids.tolist() == [1, 2, 3, 4]
+    assert balances.net.tolist() == [120, -10, -110, 0]
+    assert [balances.paid_by(user_id) for user_id in (1, 2, 3, 4)] == [Money(300), Money(90), Money(0), Money(0)]
+    assert [balances.owed_by(user_id) for user_id in (1, 2, 3, 4)] == [Money(130), Money(100), Money(160), Money(0)]
+    assert np.array_equal(balances.pairwise, [
+        [0, 70, 50, 0],
+        [-70, 0, 60, 0],
+        [-50, -60, 0, 0],
+        [0, 0, 0, 0],
+    ])
+    assert balances.owes(2, 1) == Money(70)
+    assert balances.owes(1, 2) == Money(0)
+    assert balances.owes(3, 2) == Money(60)
+    assert balances.settle_up() == [(3, 1, Money(110)), (2, 1, Money(10))]
+
+
+def test_pairwise_and_settle_up_match_the_hand_worked_group(group):
+    with group() as db:
+        _check(load_group_balances(db, 1, member_ids=[4]))
+
+
+def test_checkpoint_snapshot_gives_the_same_balances(group):
+    with group() as db:
+        assert compact_group(db, 1, datetime(2026, 1, 3)) is not None
+        _check(load_group_balances(db, 1, member_ids=[4]))
+        compact_group(db, 1, datetime(2026, 2, 1))
+        _check(load_group_balances(db, 1, member_ids=[4]))
+
+
+def test_settle_up_clears_every_position(group):
+    with group() as db:
+        balances = load_group_balances(db, 1)
+        for debtor_id, creditor_id, amount in balances.settle_up():
+            db.add(Settlement(group_id=1, payer_id=debtor_id, payee_id=creditor_id, amount=amount))
+        db.commit()
+        settled = load_group_balances(db, 1)
+        assert not settled.net.any()
+        assert settled.settle_up() == []
+        # Settling nets debts against each other rather than pair by pair
+        assert settled.pairwise[0].tolist() == [0, 60, -60] and settled.pairwise[1, 2] == 60
+
+
+def test_unknown_users_owe_nothing(group):
+    with group() as db:
+        balances = load_group_balances(db, 1)
+        assert balances.net_of(99) == Money(0)
+        assert balances.owes(99, 1) == Money(0)
+        assert load_group_balances(db, 2).settle_up() == []
+
+
+@pytest.fixture
+def two_groups(group):
+    """The hand-worked group plus group 2, where 2 paid 100 for 1."""
+    with group() as db:
+        db.add(Group(id=2, name="Flat"))
+        db.add_all([GroupMember(group_id=2, user_id=user_id) for user_id in (1, 2)])
+        db.flush()
+        insert_expenses(db, [_expense(2, 2, {1: 100}, day=5)])
+        db.commit()
+    return group
+
+
+def _check_user_positions(db):
+    # Nets add up across groups: 1 is owed 70 by 2 in group 1 but owes 2 100 in group 2
+    assert user_net_balances(db, 1) == {2: Money(-30), 3: Money(50)}
+    assert user_net_balances(db, 2) == {1: Money(30), 3: Money(60)}
+    assert user_net_balances(db, 3) == {1: Money(-50), 2: Money(-60)}
+    assert user_net_balances(db, 4) == {}
+    # Totals net per group and person first, as each group's report does
+    assert user_totals(db, 1) == (Money(120), Money(100))
+    assert user_totals(db, 2) == (Money(160), Money(70))
+    assert user_totals(db, 4) == (Money(0), Money(0))
+
+
+def test_per_friend_nets_across_groups(two_groups):
+    with two_groups() as db:
+        _check_user_positions(db)
+
+
+def test_per_friend_nets_include_checkpoints(two_groups):
+    with two_groups() as db:
+        compact_group(db, 1, datetime(2026, 1, 3))
+        _check_user_positions(db)
+        compact_group(db, 2, datetime(2026, 2, 1))
+        compact_group(db, 1, datetime(2026, 2, 1))
+        _check_user_positions(db)
@@ -0,0 +1,134 @@
+import os
+import time
+import fakeredis
+import pytest
+from sqlalchemy import create_engine
+from coordination import Coordinator, MemoryCoordinator, RedisCoordinator, SqliteCoordinator, current_worker_id
+from models import CoordinationEvent, Lease
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/coordination.db")
+    CoordinationEvent.metadata.create_all(engine, tables=[CoordinationEvent.__table__, Lease.__table__])
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def sqlite_pair(sqlite_engine):
+    return SqliteCoordinator(sqlite_engine, "worker-a"), SqliteCoordinator(sqlite_engine, "worker-b")
+
+
+@pytest.fixture
+def redis_pair():
+    server = fakeredis.FakeServer()
+    return (
+        RedisCoordinator(fakeredis.FakeRedis(server=server), "worker-a"),
+        RedisCoordinator(fakeredis.FakeRedis(server=server), "worker-b"),
+    )
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def lease_coordinator(request):
+    if request.param == "memory":
+        return MemoryCoordinator()
+    if request.param == "sqlite":
+        return request.getfixturevalue("sqlite_pair")[0]
+    return request.getfixturevalue("redis_pair")[0]
+
+
+def test_backends_must_implement_leases():
+    class NoLeases(Coordinator):
+        pass
+
+    with pytest.raises(TypeError):
+        NoLeases()
+
+
+def test_memory_delivers_invalidations_in_process():
+    coordinator = MemoryCoordinator()
+    received = []
+    coordinator.on_invalidate("membership", received.append)
+    coordinator.invalidate("membership", 1, 2)
+    coordinator.invalidate("membership")
+    assert received == [[1, 2], []]
+
+
+@pytest.mark.parametrize("pair", ["sqlite_pair", "redis_pair"])
+def test_invalidation_reaches_other_workers_only(request, pair):
+    publisher, listener = request.getfixturevalue(pair)
+    from_publisher, from_listener = [], []
+    listener.on_invalidate("membership", from_publisher.append)
+    publisher.on_invalidate("membership", from_listener.append)
+    publisher.start()
+    listener.start()
+    try:
+        # The SQLite listener only picks up events published after its first poll
+        time.sleep(0.6)
+        publisher.invalidate("membership", 7)
+        assert wait_for(lambda: from_publisher == [[7]])
+        # The publisher heard itself once, straight away, and not again through the backend
+        time.sleep(0.6)
+        assert from_listener == [[7]]
+    finally:
+        publisher.stop()
+        listener.stop()
+
+
+def test_lease_is_exclusive_until_it_expires(lease_coordinator):
+    assert lease_coordinator.acquire_lease("purge", "a", 0.3)
+    assert lease_coordinator.acquire_lease("purge", "a", 0.3)  # The holder renews
+    assert not lease_coordinator.acquire_lease("purge", "b", 0.3)
+    time.sleep(0.4)
+    assert lease_coordinator.acquire_lease("purge", "b", 0.3)
+    assert not lease_coordinator.acquire_lease("purge", "a", 0.3)
+
+
+def test_sqlite_leases_are_shared_between_workers(sqlite_pair):
+    first, second = sqlite_pair
+    assert first.acquire_lease("scheduler", first.worker_id, 30)
+    assert not second.acquire_lease("scheduler", second.worker_id, 30)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_workers_get_their_own_id_and_hear_each_other(sqlite_engine):
+    # As under gunicorn with preload_app: the coordinator is created before the fork
+    coordinator = SqliteCoordinator(sqlite_engine)
+    parent_id = current_worker_id()
+    ready_read, ready_write = os.pipe()
+    result_read, result_write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            coordinator.after_fork()
+            os.read(ready_read, 1)
+            child_id = coordinator.worker_id
+            coordinator.invalidate("membership", 1)
+            os.write(result_write, b"1" if child_id != parent_id else b"0")
+        finally:
+            os._exit(0)
+
+    received = []
+    coordinator.on_invalidate("membership", received.append)
+    coordinator.start()
+    try:
+        assert wait_for(lambda: coordinator._last_event_id is not None)
+        os.write(ready_write, b"1")
+        assert os.read(result_read, 1) == b"1", "the forked worker kept the parent's id"
+        assert wait_for(lambda: received == [[1]])
+        # Leases tell the two processes apart as well
+        assert coordinator.acquire_lease("scheduler", coordinator.worker_id, 30)
+    finally:
+        coordinator.stop()
+        os.waitpid(pid, 0)
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import pytest
+from sqlalchemy import event
+import group_commit
+from group_commit import GroupCommitWriter, commit_write
+from models import User
+
+
+@pytest.fixture
+def commits(Session):
+    """One entry per COMMIT that reaches the database."""
+    engine = Session.kw["bind"]
+    seen = []
+
+    @event.listens_for(engine, "commit")
+    def on_commit(conn):
+        seen.append(None)
+
+    yield seen
+    event.remove(engine, "commit", on_commit)
+
+
+def add_user(user_id):
+    def write(db):
+        db.add(User(id=user_id, first_name=f"User{user_id}", last_name="", password=""))
+        db.flush()
+        return user_id
+    return write
+
+
+def user_ids(Session):
+    with Session() as db:
+        return sorted(user_id for (user_id,) in db.query(User.id))
+
+
+def test_queued_writes_share_one_commit(Session, commits):
+    writer = GroupCommitWriter(Session, window=0.05)
+    blocker = threading.Event()
+    # The first write holds the writer so the others queue up behind it, then all commit together
+    first = writer.submit(lambda db: blocker.wait(5))
+    futures = [writer.submit(add_user(user_id)) for user_id in range(1, 6)]
+    blocker.set()
+    assert [future.result(5) for future in futures] == [1, 2, 3, 4, 5]
+    assert first.result(5) is True
+    writer.stop()
+    assert user_ids(Session) == [1, 2, 3, 4, 5]
+    assert writer.writes == 6 and writer.batches == len(commits) <= 2
+
+
+def test_failing_write_rolls_back_alone(Session):
+    writer = GroupCommitWriter(Session, window=0.05)
+
+    def half_written(db):
+        db.add(User(id=99, first_name="Half", last_name="", password=""))
+        db.flush()
+        raise ValueError("bad write")
+
+    blocker = threading.Event()
+    writer.submit(lambda db: blocker.wait(5))
+    futures = [writer.submit(add_user(1)), writer.submit(half_written), writer.submit(add_user(2))]
+    blocker.set()
+    assert futures[0].result(5) == 1 and futures[2].result(5) == 2
+    with pytest.raises(ValueError, match="bad write"):
+        futures[1].result(5)
+    writer.stop()
+    assert user_ids(Session) == [1, 2]
+
+
+def test_futures_resolve_only_after_commit(Session, monkeypatch):
+    writer = GroupCommitWriter(Session, window=0)
+    committing, finish_commit = threading.Event(), threading.Event()
+    original_commit = writer._commit
+
+    def slow_commit(batch):
+        committing.set()
+        finish_commit.wait(5)
+        original_commit(batch)
+
+    monkeypatch.setattr(writer, "_commit", slow_commit)
+    future = writer.submit(add_user(1))
+    assert committing.wait(5)
+    assert not future.done()
+    finish_commit.set()
+    assert future.result(5) == 1
+    # Whoever is told the write succeeded can read it from a new session
+    assert user_ids(Session) == [1]
+    writer.stop()
+
+
+def test_stop_commits_queued_writes(Session):
+    writer = GroupCommitWriter(Session, window=0.05)
+    blocker = threading.Event()
+    writer.submit(lambda db: blocker.wait(5))
+    futures = [writer.submit(add_user(user_id)) for user_id in range(1, 4)]
+    stopper = threading.Thread(target=writer.stop)
+    stopper.start()
+    blocker.set()
+    stopper.join(5)
+    assert all(future.done() for future in futures)
+    assert user_ids(Session) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("enabled", [False, True])
+def test_commit_write(Session, monkeypatch, enabled):
+    monkeypatch.setattr(group_commit, "GROUP_COMMIT", enabled)
+    writer = GroupCommitWriter(Session, window=0)
+    monkeypatch.setattr(group_commit, "shard_writer", lambda shard: writer)
+    db = Session()
+    assert asyncio.run(commit_write(db, 0, add_user(7))) == 7
+    # Off: committed on the request's own session. On: by the writer, which alone has committed anything.
+    assert writer.writes == (1 if enabled else 0)
+    db.close()
+    writer.stop()
+    assert user_ids(Session) == [7]
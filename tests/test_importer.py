@@ -0,0 +1,207 @@
+import io
+import json
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+import pytest
+import importer
+from coordination import MemoryCoordinator
+from importer import ImportRowError, iter_json_records, run_import
+from models import Expense, Group, GroupMember, ImportJob, User
+
+
+def records(text):
+    return list(iter_json_records(io.BytesIO(text.encode())))
+
+
+def test_malformed_json_line_fails_only_that_row():
+    lines = [json.dumps({"amount": i}) for i in range(3)] + ['{"amount": 10,, "x": 1}'] + [json.dumps({"amount": i}) for i in range(3, 6)]
+    result = records("\n".join(lines))
+    assert len(result) == 7
+    assert isinstance(result[3], ImportRowError)
+    assert [record["amount"] for record in result if isinstance(record, dict)] == list(range(6))
+
+
+def test_malformed_record_in_pretty_array_is_skipped_whole():
+    text = '[\n  {"amount": 1, "description": "a } \\" ]"},\n  {"amount": 2,\n   "items": [{"amount": 1}, oops]},\n  {"amount": 3}\n]'
+    result = records(text)
+    assert result[0] == {"amount": 1, "description": 'a } " ]'}
+    assert isinstance(result[1], ImportRowError)
+    assert result[2] == {"amount": 3}
+    assert len(result) == 3
+
+
+def test_oversized_record_is_a_row_error(monkeypatch):
+    monkeypatch.setattr(importer, "MAX_RECORD_CHARS", 1000)
+    monkeypatch.setattr(importer, "READ_SIZE", 256)
+    lines = [json.dumps({"amount": 1}), json.dumps({"amount": 2, "description": "x" * 5000}), json.dumps({"amount": 3})]
+    result = records("\n".join(lines))
+    assert result[0] == {"amount": 1}
+    assert isinstance(result[1], ImportRowError)
+    assert result[2] == {"amount": 3}
+
+
+def test_memory_stays_bounded_after_a_malformed_record():
+    lines = [json.dumps({"amount": 10, "description": "Dinner"})] * 10 + ['{"amount": 10,, "x": 1}']
+    lines += [json.dumps({"amount": 10, "description": "Dinner"})] * 100_000
+    source = io.BytesIO("\n".join(lines).encode())
+
+    tracemalloc.start()
+    count = errors = 0
+    for record in iter_json_records(source):
+        count += 1
+        errors += isinstance(record, ImportRowError)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert (count, errors) == (100_011, 1)
+    assert peak < 2 * 1024 * 1024
+
+
+@pytest.fixture
+def import_db(Session):
+    with Session() as db:
+        db.add_all([User(id=1, first_name="Asha", last_name="Rao", password=""), User(id=2, first_name="Ravi", last_name="Kumar", password="")])
+        db.add(Group(id=1, name="Trip"))
+        db.add_all([GroupMember(group_id=1, user_id=1), GroupMember(group_id=1, user_id=2)])
+        db.commit()
+    with Session() as db:
+        yield db
+
+
+def _run(db, text, file_format):
+    job = ImportJob(group_id=1, created_by=1, source_path="-", file_format=file_format)
+    db.add(job)
+    db.commit()
+    return run_import(db, job, io.BytesIO(text.encode()))
+
+
+def test_bad_field_values_fail_only_their_row(import_db):
+    job = _run(import_db, "description,amount,paid_by\na,10,Asha\nb,1e30,Asha\nc,20,Asha\n", "csv")
+    assert (job.status, job.rows_done, job.rows_imported, job.rows_failed) == ("done", 3, 2, 1)
+    assert json.loads(job.errors)[0]["row"] == 2
+
+
+def test_non_string_json_fields_fail_only_their_row(import_db):
+    lines = [
+        {"description": 123, "amount": 10, "paid_by": "Asha"},
+        {"description": "b", "amount": {"rupees": 10}, "paid_by": "Asha"},
+        {"description": "c", "amount": 10, "paid_by": "Ravi", "split_among": [1, 2], "split_values": [{"x": 1}], "split_type": "exact"},
+        {"description": "d", "amount": 10, "paid_by": "Ravi", "items": [{"amount": []}], "split_type": "itemized"},
+        {"description": "e", "amount": 20, "paid_by": "Ravi"},
+    ]
+    job = _run(import_db, "\n".join(map(json.dumps, lines)) + '\n{"amount": 1,,}\n', "json")
+    assert (job.status, job.rows_done, job.rows_imported, job.rows_failed) == ("done", 6, 2, 4)
+    assert sorted(description for (description,) in import_db.query(Expense.description)) == ["123", "e"]
+
+
+def test_stopped_import_resumes_from_its_checkpoint(import_db):
+    text = "description,amount,paid_by\n" + "".join(f"row {i},10,Asha\n" for i in range(5))
+    job = ImportJob(group_id=1, created_by=1, source_path="-", file_format="csv")
+    import_db.add(job)
+    import_db.commit()
+    run_import(import_db, job, io.BytesIO(text.encode()), chunk_size=2, should_stop=lambda: True)
+    assert (job.status, job.rows_done) == ("running", 2)
+    run_import(import_db, job, io.BytesIO(text.encode()), chunk_size=2)
+    assert (job.status, job.rows_done, job.rows_imported) == ("done", 5, 5)
+    assert import_db.query(Expense).count() == 5
+
+
+def test_submitted_jobs_run_off_the_caller_and_stop_at_a_chunk(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    stops = []
+
+    def run_import_job(group_id, job_id, should_stop):
+        started.set()
+        release.wait(5)
+        stops.append(should_stop())
+
+    monkeypatch.setattr(importer, "run_import_job", run_import_job)
+    future = importer.submit_import_job(1, 1)
+    assert started.wait(5) and not future.done()
+    stopper = threading.Thread(target=importer.stop_import_jobs)
+    stopper.start()
+    assert importer._stopping.wait(5)
+    release.set()
+    stopper.join(5)
+    assert future.done() and stops == [True]
+
+
+@pytest.fixture
+def stored_upload(import_db, tmp_path, monkeypatch):
+    """An uploaded CSV saved under IMPORT_DIR with a pending job, run through the import_db session."""
+    monkeypatch.setattr(importer, "IMPORT_DIR", str(tmp_path / "imports"))
+    monkeypatch.setattr(importer, "group_session", contextmanager(lambda group_id: (yield import_db)))
+    monkeypatch.setattr(importer, "coordinator", MemoryCoordinator())
+    os.makedirs(importer.IMPORT_DIR)
+    source_path = os.path.join(importer.IMPORT_DIR, "upload.csv")
+    with open(source_path, "w") as source:
+        source.write("description,amount,paid_by\na,10,Asha\nb,20,Ravi\n")
+    return importer.start_import(import_db, 1, 1, source_path, "csv")
+
+
+def test_finished_upload_is_deleted(stored_upload):
+    assert importer.run_import_job(1, stored_upload.job_id)["status"] == "done"
+    assert not os.path.exists(stored_upload.source_path)
+
+
+def test_failed_upload_is_deleted(stored_upload, monkeypatch):
+    def broken_insert(db, expenses):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(importer, "insert_expenses", broken_insert)
+    with pytest.raises(RuntimeError):
+        importer.run_import_job(1, stored_upload.job_id)
+    assert stored_upload.status == "failed"
+    assert not os.path.exists(stored_upload.source_path)
+
+
+def test_files_outside_the_upload_directory_are_kept(import_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(importer, "IMPORT_DIR", str(tmp_path / "imports"))
+    monkeypatch.setattr(importer, "group_session", contextmanager(lambda group_id: (yield import_db)))
+    source_path = tmp_path / "history.csv"
+    source_path.write_text("description,amount,paid_by\na,10,Asha\n")
+    job = importer.start_import(import_db, 1, 1, str(source_path), "csv")
+    assert importer.run_import_job(1, job.job_id)["status"] == "done"
+    assert source_path.exists()
+
+
+def test_job_leased_elsewhere_is_left_alone(stored_upload):
+    assert importer.coordinator.acquire_lease(f"import-job:1:{stored_upload.job_id}", "another-worker", 60)
+    assert importer.run_import_job(1, stored_upload.job_id)["status"] == "pending"
+    assert os.path.exists(stored_upload.source_path)
+
+
+def test_unfinished_uploads_are_resumed(stored_upload, Session, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(importer, "ShardSessions", [Session])
+    monkeypatch.setattr(importer, "submit_import_job", lambda group_id, job_id: submitted.append((group_id, job_id)) or True)
+    with Session() as db:
+        db.add(ImportJob(group_id=1, created_by=1, source_path=stored_upload.source_path, file_format="csv", status="done"))
+        db.add(ImportJob(group_id=1, created_by=1, source_path="/somewhere/else.csv", file_format="csv", status="running"))
+        db.commit()
+    assert importer.resume_import_jobs() == 1
+    assert submitted == [(1, stored_upload.job_id)]
+
+
+def test_oversized_uploads_are_refused_before_they_are_read():
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+    from starlette.testclient import TestClient
+    from admission import UploadLimitMiddleware
+
+    async def upload(request):
+        return PlainTextResponse(str(len(await request.body())))
+
+    app = Starlette(routes=[Route("/import-expenses/1", upload, methods=["POST"])])
+    app.add_middleware(UploadLimitMiddleware, limits=[("POST", "/import-expenses/", 100)])
+    client = TestClient(app)
+    assert client.post("/import-expenses/1", content=b"x" * 100).text == "100"
+    assert client.post("/import-expenses/1", content=b"x" * 101).status_code == 413
+
+    def chunked():
+        yield b"x"
+
+    assert client.post("/import-expenses/1", content=chunked()).status_code == 411
@@ -0,0 +1,68 @@
+import pytest
+from membership import MembershipCache, GroupMembership, invalidate_membership, load_membership, membership_cache
+from models import Group, GroupMember, User
+from services import bump_group_versions
+
+
+@pytest.fixture
+def Session(Session):
+    membership_cache.clear()
+    with Session() as db:
+        db.add_all([User(id=user_id, first_name=f"U{user_id}", last_name="", password="") for user_id in (1, 2, 3)])
+        db.add_all([Group(id=1, name="Flat"), Group(id=2, name="Trip")])
+        db.add_all([GroupMember(group_id=1, user_id=1), GroupMember(group_id=1, user_id=2), GroupMember(group_id=2, user_id=3)])
+        db.commit()
+    yield Session
+    membership_cache.clear()
+
+
+def _member_ids(db, group_id):
+    return sorted(load_membership(db, group_id).member_ids)
+
+
+def test_version_bump_replaces_the_cached_membership(Session):
+    with Session() as db:
+        first = load_membership(db, 1)
+        assert sorted(first.member_ids) == [1, 2]
+        assert load_membership(db, 1) is first
+
+        # A write straight to the table is not seen while the version stays the same
+        db.add(GroupMember(group_id=1, user_id=3))
+        db.commit()
+        assert load_membership(db, 1) is first
+
+        bump_group_versions(db, [1])
+        db.commit()
+        assert _member_ids(db, 1) == [1, 2, 3]
+        assert load_membership(db, 1).version == first.version + 1
+        assert not load_membership(db, 1).is_member(4)
+
+
+def test_invalidation_drops_the_entry(Session):
+    with Session() as db:
+        first = load_membership(db, 1)
+        other = load_membership(db, 2)
+        db.query(GroupMember).filter(GroupMember.user_id == 2).delete()
+        db.commit()
+
+        invalidate_membership(1)
+        assert _member_ids(db, 1) == [1]
+        assert load_membership(db, 1) is not first
+        assert load_membership(db, 2) is other
+
+
+def test_missing_group_has_no_membership(Session):
+    with Session() as db:
+        assert load_membership(db, 99) is None
+
+
+def test_cache_evicts_the_least_recently_used_group():
+    cache = MembershipCache(max_size=2)
+    for group_id in (1, 2):
+        cache.set(GroupMembership(group_id, f"Group {group_id}", 0, ()))
+    assert cache.get(1, 0) is not None  # 1 is now the most recently used
+    cache.set(GroupMembership(3, "Group 3", 0, ()))
+
+    assert cache.get(2, 0) is None
+    assert cache.get(1, 0) is not None and cache.get(3, 0) is not None
+    assert cache.get(1, 1) is None  # A different version is a miss
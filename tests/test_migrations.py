@@ -0,0 +1,13 @@
+from models import SchemaVersion
+from migrations import MIGRATIONS, run_migrations
+
+
+def test_every_applied_migration_is_stamped(Session):
+    with Session() as db:
+        rows = db.query(SchemaVersion).order_by(SchemaVersion.version).all()
+        assert [row.version for row in rows] == [version for version, _ in MIGRATIONS]
+        assert all(row.applied_at is not None for row in rows)
+
+        # Running again is a no-op
+        run_migrations(Session.kw["bind"])
+        assert db.query(SchemaVersion).count() == len(MIGRATIONS)
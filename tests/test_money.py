@@ -0,0 +1,17 @@
+import pytest
+from money import MAX_PAISE, Money
+
+
+@pytest.mark.parametrize("text, paise", [("120", 12000), ("99.5", 9950), ("0.005", 1), ("-12.25", -1225), ("", 0), ("1e3", 100000)])
+def test_parse(text, paise):
+    assert Money.parse(text) == Money(paise)
+
+
+@pytest.mark.parametrize("text", ["abc", "nan", "inf", "1e30", "1e400", "-1e30", str(MAX_PAISE // 100 + 1)])
+def test_parse_rejects_invalid_and_out_of_range_amounts_with_value_error(text):
+    with pytest.raises(ValueError):
+        Money.parse(text)
+
+
+def test_parse_accepts_the_largest_amount():
+    assert Money.parse(str(MAX_PAISE // 100)).paise == MAX_PAISE
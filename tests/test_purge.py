@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+import pytest
+import purge
+import services
+from balances import load_group_balances
+from coordination import MemoryCoordinator
+from models import Expense, ExpenseSplit, Group, GroupMember, User
+from money import Money
+from purge import PurgeWorker
+from rollups import group_rollups, rebuild_rollups
+from services import delete_expenses, insert_expenses, purge_deleted_expenses, restore_expenses
+
+MEMBERS = [1, 2, 3]
+
+
+@pytest.fixture
+def expense_ids(Session):
+    with Session() as db:
+        db.add_all([User(id=user_id, first_name=f"U{user_id}", last_name="", password="") for user_id in MEMBERS])
+        db.add(Group(id=1, name="Trip"))
+        db.add_all([GroupMember(group_id=1, user_id=user_id) for user_id in MEMBERS])
+        db.flush()
+        expense_ids = insert_expenses(db, [
+            {
+                "group_id": 1, "description": f"Expense {index}", "amount": Money(amount), "paid_by": paid_by, "created_by": paid_by,
+                "split_type": "equal", "created_at": datetime(2026, month, 10),
+                "splits": [(user_id, share, 1) for user_id, share in zip(MEMBERS, Money(amount).allocate([1] * len(MEMBERS)))],
+            }
+            for index, (amount, paid_by, month) in enumerate([(900_00, 1, 1), (301_00, 2, 1), (1_000, 3, 2), (45_50, 1, 3)])
+        ])
+        db.commit()
+    return expense_ids
+
+
+def _state(db):
+    balances = load_group_balances(db, 1)
+    rollups = [
+        (row.user_id, row.month, row.paid, row.share)
+        for row in group_rollups(db, 1)
+        if row.paid or row.share
+    ]
+    return balances.net.tolist(), balances.pairwise.tolist(), sorted(rollups)
+
+
+def _rollups_match_rebuild(db):
+    rows = sorted((row.user_id, row.month, row.paid, row.share) for row in group_rollups(db, 1) if row.paid or row.share)
+    rebuild_rollups(db)
+    return rows == sorted((row.user_id, row.month, row.paid, row.share) for row in group_rollups(db, 1) if row.paid or row.share)
+
+
+def test_delete_then_restore_puts_balances_and_rollups_back(Session, expense_ids):
+    with Session() as db:
+        before = _state(db)
+        assert delete_expenses(db, 1, expense_ids[:2]) == 2
+        db.commit()
+        deleted = _state(db)
+        assert deleted != before
+        assert _rollups_match_rebuild(db)
+        db.rollback()
+
+        # Deleting twice changes nothing more
+        assert delete_expenses(db, 1, expense_ids[:2]) == 0
+        assert restore_expenses(db, 1, expense_ids[:2]) == 2
+        db.commit()
+        assert _state(db) == before
+        assert _rollups_match_rebuild(db)
+
+
+def test_restore_stops_once_the_undo_window_has_passed(Session, expense_ids):
+    with Session() as db:
+        delete_expenses(db, 1, expense_ids[:1])
+        db.query(Expense).filter(Expense.expense_id == expense_ids[0]).update({"deleted_at": datetime.now() - timedelta(seconds=services.UNDO_SECONDS + 1)})
+        db.commit()
+        assert restore_expenses(db, 1, expense_ids[:1]) == 0
+
+
+def test_purge_only_removes_expenses_deleted_before_the_cutoff(Session, expense_ids):
+    now = datetime.now()
+    with Session() as db:
+        delete_expenses(db, 1, expense_ids[:3])
+        for expense_id, deleted_at in zip(expense_ids, [now - timedelta(hours=3), now - timedelta(hours=2), now]):
+            db.query(Expense).filter(Expense.expense_id == expense_id).update({"deleted_at": deleted_at})
+        db.commit()
+        before = _state(db)
+
+        assert purge_deleted_expenses(db, now - timedelta(hours=1), batch_size=1) == 2
+
+        remaining = {expense_id for (expense_id,) in db.query(Expense.expense_id)}
+        assert remaining == set(expense_ids[2:])
+        assert {split.expense_id for split in db.query(ExpenseSplit)} == remaining
+        # Deleted expenses had already left the balances and rollups
+        assert _state(db) == before
+        # The one still inside the window can come back
+        assert restore_expenses(db, 1, expense_ids[2:3]) == 1
+
+
+def test_purge_stops_when_told_to(Session, expense_ids):
+    with Session() as db:
+        delete_expenses(db, 1, expense_ids)
+        db.commit()
+        calls = iter([True, False])
+        assert purge_deleted_expenses(db, datetime.now() + timedelta(seconds=1), batch_size=1, keep_going=lambda: next(calls)) == 1
+        assert db.query(Expense).count() == 3
+
+
+def test_worker_waits_for_a_quiet_worker_and_the_lease(Session, expense_ids, monkeypatch):
+    monkeypatch.setattr(purge, "coordinator", MemoryCoordinator())
+    monkeypatch.setattr(purge, "UNDO_SECONDS", 0)
+    with Session() as db:
+        delete_expenses(db, 1, expense_ids[:2])
+        db.commit()
+    worker = PurgeWorker([Session])
+
+    monkeypatch.setattr(purge, "is_quiet", lambda: False)
+    assert worker.run_once() == 0
+    monkeypatch.setattr(purge, "is_quiet", lambda: True)
+    purge.coordinator.acquire_lease(purge.LEASE_NAME, "another-worker", 60)
+    assert worker.run_once() == 0
+
+    purge.coordinator.acquire_lease(purge.LEASE_NAME, "another-worker", -1)
+    assert worker.run_once() == 2
@@ -0,0 +1,191 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine, event, func, text
+from sqlalchemy.orm import sessionmaker
+import rebalance
+from balances import load_group_balances
+from compaction import compact_group
+from migrations import run_migrations
+from models import (
+    Base, GROUP_SCOPED_TABLES, Expense, Group, GroupMember, GroupShard, ImportJob, RecurringExpense, SchemaVersion, Settlement, User,
+)
+from money import Money
+from rebalance import MOVED_TABLES, move_group, plan_rebalance
+from rollups import group_rollups
+from search import expense_conditions, search_keys
+from services import insert_expenses
+
+START = datetime(2026, 1, 1)
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    """Session factories for two shard databases laid out like database.py: shard 0 is also the global database."""
+    global_engine = create_engine(f"sqlite:///{tmp_path}/global.db")
+    Base.metadata.create_all(bind=global_engine)
+    run_migrations(global_engine)
+
+    shard_engine = create_engine(f"sqlite:///{tmp_path}/shard1.db")
+
+    @event.listens_for(shard_engine, "connect")
+    def attach_global(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS global", (global_engine.url.database,))
+
+    Base.metadata.create_all(bind=shard_engine, tables=[*GROUP_SCOPED_TABLES, SchemaVersion.__table__])
+    run_migrations(shard_engine)
+
+    sessions = [sessionmaker(bind=global_engine), sessionmaker(bind=shard_engine)]
+    monkeypatch.setattr(rebalance, "engine", global_engine)
+    monkeypatch.setattr(rebalance, "shard_engines", [global_engine, shard_engine])
+    monkeypatch.setattr(rebalance, "SessionLocal", sessions[0])
+    monkeypatch.setattr(rebalance, "SHARD_COUNT", 2)
+    yield sessions
+    global_engine.dispose()
+    shard_engine.dispose()
+
+
+def _expense(group_id, paid_by, paise, description, day, member_ids):
+    shares = Money(paise).allocate([1] * len(member_ids))
+    return {
+        "group_id": group_id, "description": description, "amount": Money(paise), "paid_by": paid_by, "created_by": paid_by,
+        "split_type": "equal", "created_at": START + timedelta(days=day), "splits": [(user_id, share, 1) for user_id, share in zip(member_ids, shares)],
+    }
+
+
+def _add_group(shards, shard, group_id, expense_count, seed):
+    rng = random.Random(seed)
+    member_ids = [1, 2, 3]
+    with shards[0]() as db:
+        db.add(GroupShard(group_id=group_id, name=f"Group {group_id}", shard=shard))
+        db.commit()
+    with shards[shard]() as db:
+        db.add(Group(id=group_id, name=f"Group {group_id}"))
+        db.add_all([GroupMember(group_id=group_id, user_id=user_id) for user_id in member_ids])
+        db.flush()
+        insert_expenses(db, [
+            _expense(group_id, rng.choice(member_ids), rng.randint(100, 100_000), rng.choice(["dinner", "taxi", "groceries"]), day, member_ids)
+            for day in range(expense_count)
+        ])
+        db.add_all([Settlement(group_id=group_id, payer_id=2, payee_id=1, amount=Money(500), settled_at=START + timedelta(days=day)) for day in (1, 20)])
+        db.add(RecurringExpense(group_id=group_id, description="Rent", amount=Money(1_000_00), paid_by=1, created_by=1, split_spec="{}", starts_at=START))
+        db.add(ImportJob(group_id=group_id, created_by=1, source_path="-", status="done"))
+        db.commit()
+        # Older history goes to a checkpoint and the archive tables
+        compact_group(db, group_id, START + timedelta(days=expense_count // 2))
+
+
+def _state(shards, shard, group_id):
+    with shards[shard]() as db:
+        balances = load_group_balances(db, group_id)
+        return {
+            "net": dict(zip(balances.member_ids.tolist(), balances.net.tolist())),
+            "pairwise": balances.pairwise.tolist(),
+            "rollups": [(row.user_id, row.month, row.paid, row.share) for row in group_rollups(db, group_id)],
+            "search": [key.created_at for key in search_keys(db, [group_id], expense_conditions("dinner"), limit=1000)],
+            "expenses": db.query(func.count()).select_from(Expense).filter(Expense.group_id == group_id).scalar(),
+        }
+
+
+def _group_rows(shards, shard, group_id):
+    with shards[shard]() as db:
+        counts = {
+            table: db.execute(text(f"SELECT COUNT(*) FROM main.{table} WHERE {condition.format(source='main')}"), {"group_id": group_id}).scalar()
+            for table, condition, _ in MOVED_TABLES
+        }
+        counts["fts"] = db.execute(text("SELECT COUNT(*) FROM tbl_expenses_fts WHERE group_id = :group_id"), {"group_id": group_id}).scalar()
+        return counts
+
+
+def _expense_ids(shards, shard, group_id):
+    with shards[shard]() as db:
+        return sorted(expense_id for (expense_id,) in db.query(Expense.expense_id).filter(Expense.group_id == group_id))
+
+
+@pytest.fixture
+def populated(shards):
+    with shards[0]() as db:
+        db.add_all([User(id=user_id, first_name=f"U{user_id}", last_name="", password="") for user_id in (1, 2, 3)])
+        db.commit()
+    _add_group(shards, 0, 1, 30, seed=1)
+    return shards
+
+
+def test_move_keeps_everything_and_empties_the_source(populated):
+    shards = populated
+    before = _state(shards, 0, 1)
+    rows_before = _group_rows(shards, 0, 1)
+    ids_before = _expense_ids(shards, 0, 1)
+    assert all(rows_before.values()), rows_before
+
+    assert move_group(1, 1) == 0
+
+    assert _state(shards, 1, 1) == before
+    assert _group_rows(shards, 1, 1) == rows_before
+    # Nothing was in the target, so no id had to move
+    assert _expense_ids(shards, 1, 1) == ids_before
+    assert not any(_group_rows(shards, 0, 1).values())
+    with shards[0]() as db:
+        assert db.query(GroupShard.shard).filter(GroupShard.group_id == 1).scalar() == 1
+        assert search_keys(db, [1], expense_conditions("dinner")) == []
+
+
+def test_colliding_ids_are_shifted_together(populated):
+    shards = populated
+    # Group 2 on shard 1 already uses the same expense, split and checkpoint ids as group 1
+    _add_group(shards, 1, 2, 40, seed=2)
+    before, other_before = _state(shards, 0, 1), _state(shards, 1, 2)
+    ids_before = _expense_ids(shards, 0, 1)
+    assert set(ids_before) & set(_expense_ids(shards, 1, 2))
+
+    move_group(1, 1)
+
+    # Ids shift by one amount past the target's, and splits, snapshots and the index follow them
+    ids_after = _expense_ids(shards, 1, 1)
+    shift = ids_after[0] - ids_before[0]
+    assert shift > 0 and ids_after == [expense_id + shift for expense_id in ids_before]
+    assert _state(shards, 1, 1) == before
+    assert _state(shards, 1, 2) == other_before
+
+    # And back again, past shard 0's ids this time
+    move_group(1, 0)
+    assert _state(shards, 0, 1) == before
+    assert not any(_group_rows(shards, 1, 1).values())
+
+
+def test_move_refuses_unknown_groups_and_shards(populated):
+    with pytest.raises(ValueError):
+        move_group(99, 1)
+    with pytest.raises(ValueError):
+        move_group(1, 5)
+    assert move_group(1, 0) == 0
+
+
+def test_plan_rebalance_converges():
+    rng = random.Random(3)
+    for _ in range(200):
+        loads = {shard: {} for shard in range(rng.randint(2, 5))}
+        for group_id in range(rng.randint(0, 40)):
+            loads[rng.randrange(len(loads))][group_id] = rng.randint(0, 500)
+
+        totals = {shard: sum(groups.values()) for shard, groups in loads.items()}
+        moves = plan_rebalance(loads, max_moves=1000)
+        for group_id, source, target in moves:
+            gap = max(totals.values()) - min(totals.values())
+            load = loads[source].pop(group_id)
+            loads[target][group_id] = load
+            totals[source] -= load
+            totals[target] += load
+            # Every move narrows the gap between the two shards it touches and never widens the overall spread
+            assert abs(totals[source] - totals[target]) < gap
+            assert max(totals.values()) - min(totals.values()) <= gap
+        # A converged plan has nothing left to move
+        assert plan_rebalance(loads, max_moves=1000) == []
+
+
+def test_plan_rebalance_respects_max_moves():
+    loads = {0: {group_id: 10 for group_id in range(20)}, 1: {}}
+    assert len(plan_rebalance(loads, max_moves=3)) == 3
+    moves = plan_rebalance(loads, max_moves=100)
+    assert len(moves) == 10
+    assert loads[0] and not loads[1]  # The caller's loads are left alone
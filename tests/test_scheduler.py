@@ -0,0 +1,116 @@
+import json
+from datetime import datetime, timedelta
+import scheduler
+from models import Expense, ExpenseSplit, Group, GroupMember, RecurringExpense, User
+from money import Money
+from scheduler import materialize_due
+
+
+def _due_schedule(Session, days_missed):
+    starts_at = datetime(2026, 1, 1)
+    with Session() as db:
+        db.add_all([User(id=1, first_name="A", last_name="A", password=""), User(id=2, first_name="B", last_name="B", password="")])
+        db.add(Group(id=1, name="Flat"))
+        db.add_all([GroupMember(group_id=1, user_id=1), GroupMember(group_id=1, user_id=2)])
+        db.add(RecurringExpense(
+            group_id=1, description="Rent", amount=Money(1_000_00), paid_by=1, created_by=1, split_type="equal",
+            split_spec="{}", interval_unit="day", interval_count=1, starts_at=starts_at,
+            occurrences=1, next_run_at=starts_at + timedelta(days=1),
+        ))
+        db.commit()
+    return starts_at + timedelta(days=days_missed)
+
+
+def test_catches_up_missed_occurrences(Session):
+    now = _due_schedule(Session, days_missed=3)
+    with Session() as db:
+        assert materialize_due(db, now) == 3
+        assert materialize_due(db, now) == 0
+        assert db.query(Expense).count() == 3
+        assert db.query(RecurringExpense.occurrences).scalar() == 4
+
+
+def test_overlapping_runs_do_not_duplicate_occurrences(Session, monkeypatch):
+    now = _due_schedule(Session, days_missed=3)
+    allocate_splits = scheduler.allocate_splits
+    other_worker = []
+
+    def other_worker_runs_first(plans):
+        # Another worker materializes the same schedules between this run's read and its claim
+        if not other_worker:
+            other_worker.append(None)
+            with Session() as other_db:
+                other_worker[0] = materialize_due(other_db, now)
+        return allocate_splits(plans)
+
+    monkeypatch.setattr(scheduler, "allocate_splits", other_worker_runs_first)
+    with Session() as db:
+        assert materialize_due(db, now) == 0
+        assert other_worker == [3]
+        assert db.query(Expense).count() == 3
+
+
+def test_catch_up_is_capped_per_run(Session):
+    now = _due_schedule(Session, days_missed=10)
+    with Session() as db:
+        assert materialize_due(db, now, max_catch_up=4) == 4
+        assert materialize_due(db, now, max_catch_up=4) == 4
+        assert materialize_due(db, now, max_catch_up=4) == 2
+        assert materialize_due(db, now, max_catch_up=4) == 0
+        assert db.query(RecurringExpense.occurrences).scalar() == 11
+
+
+def _set_spec(Session, spec):
+    with Session() as db:
+        db.query(RecurringExpense).update({"split_spec": json.dumps(spec)})
+        db.add(User(id=3, first_name="C", last_name="C", password=""))
+        db.add(GroupMember(group_id=1, user_id=3))
+        db.commit()
+
+
+def _leave(Session, user_id):
+    with Session() as db:
+        db.query(GroupMember).filter(GroupMember.user_id == user_id).delete()
+        db.commit()
+
+
+def test_members_who_left_drop_out_of_the_split(Session):
+    now = _due_schedule(Session, days_missed=2)
+    with Session() as db:
+        db.query(RecurringExpense).update({"split_type": "shares"})
+        db.commit()
+    _set_spec(Session, {"members": [1, 2, 3], "values": [1, 3, 4]})
+    with Session() as db:
+        assert materialize_due(db, now - timedelta(days=1)) == 1
+    _leave(Session, 3)
+    with Session() as db:
+        assert materialize_due(db, now) == 1
+        splits = db.query(ExpenseSplit.expense_id, ExpenseSplit.user_id, ExpenseSplit.share).order_by(ExpenseSplit.expense_id, ExpenseSplit.user_id).all()
+        assert [split[1:] for split in splits] == [
+            (1, Money(125_00)), (2, Money(375_00)), (3, Money(500_00)),
+            (1, Money(250_00)), (2, Money(750_00)),
+        ]
+
+
+def test_schedule_stops_when_the_payer_leaves(Session):
+    now = _due_schedule(Session, days_missed=2)
+    _leave(Session, 1)
+    with Session() as db:
+        assert materialize_due(db, now) == 0
+        schedule = db.query(RecurringExpense).one()
+        assert not schedule.active
+        assert "payer" in schedule.last_error
+        assert db.query(Expense).count() == 0
+
+
+def test_exact_split_that_no_longer_adds_up_stops_the_schedule(Session):
+    now = _due_schedule(Session, days_missed=1)
+    with Session() as db:
+        db.query(RecurringExpense).update({"split_type": "exact"})
+        db.commit()
+    _set_spec(Session, {"members": [1, 2, 3], "values": ["600.00", "200.00", "200.00"]})
+    _leave(Session, 3)
+    with Session() as db:
+        assert materialize_due(db, now) == 0
+        schedule = db.query(RecurringExpense).one()
+        assert not schedule.active and schedule.last_error
@@ -0,0 +1,81 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+import search
+from models import Expense, ExpenseSplit, Group
+from money import Money
+from search import SearchKey, expense_conditions, search_keys
+
+WORDS = ["dinner", "dinosaur", "coffee", "cab", "rent", "goa", "1", "12"]
+
+
+@pytest.fixture
+def expenses(Session):
+    """A few hundred expenses over 12 groups, many sharing a timestamp, as they are in the database."""
+    rng = random.Random(7)
+    start = datetime(2026, 1, 1)
+    rows = []
+    with Session() as db:
+        db.add_all([Group(id=group_id, name=f"Group {group_id}") for group_id in range(1, 13)])
+        for expense_id in range(1, 401):
+            expense = Expense(
+                expense_id=expense_id, group_id=rng.randint(1, 12), description=" ".join(rng.sample(WORDS, 2)),
+                amount=Money(rng.randint(1, 5_000)), paid_by=rng.randint(1, 4), created_at=start + timedelta(hours=rng.randint(0, 100)),
+            )
+            db.add(expense)
+            db.add_all([ExpenseSplit(expense_id=expense_id, user_id=user_id) for user_id in rng.sample(range(1, 5), 2)])
+            rows.append(expense)
+        db.commit()
+        stored = dict(db.query(Expense.expense_id, search.created_at_text))
+        rows = [(SearchKey(stored[row.expense_id], row.group_id, row.expense_id), row.description.split(), row.paid_by) for row in rows]
+        participants = {(split.expense_id, split.user_id) for split in db.query(ExpenseSplit)}
+    return rows, participants
+
+
+def _all_pages(db, group_ids, search_filter, page_size=7):
+    keys, cursor = [], None
+    while True:
+        page = search_keys(db, group_ids, search_filter, cursor, page_size)
+        keys += page
+        if len(page) < page_size:
+            return keys
+        cursor = page[-1]
+
+
+@pytest.mark.parametrize("scoped_groups", [64, 2])
+@pytest.mark.parametrize("filters, matches", [
+    ({}, lambda key, words, paid_by, shared_with: True),
+    ({"text": "din"}, lambda key, words, paid_by, shared_with: any(word.startswith("din") for word in words)),
+    ({"text": "dinner cof"}, lambda key, words, paid_by, shared_with: "dinner" in words and "coffee" in words),
+    ({"text": "1"}, lambda key, words, paid_by, shared_with: "1" in words or "12" in words),
+    ({"paid_by": 2}, lambda key, words, paid_by, shared_with: paid_by == 2),
+    ({"participant": 3}, lambda key, words, paid_by, shared_with: 3 in shared_with),
+])
+@pytest.mark.parametrize("group_ids", [[5], [1, 4, 9], list(range(1, 13))])
+def test_pages_match_filtering_everything(Session, expenses, monkeypatch, scoped_groups, filters, matches, group_ids):
+    monkeypatch.setattr(search, "MAX_SCOPED_TEXT_GROUPS", scoped_groups)
+    rows, participants = expenses
+    expected = sorted(
+        (key for key, words, paid_by in rows
+         if key.group_id in group_ids and matches(key, words, paid_by, {user for expense, user in participants if expense == key.expense_id})),
+        reverse=True,
+    )
+    with Session() as db:
+        assert _all_pages(db, group_ids, expense_conditions(**filters)) == expected
+
+
+def test_index_follows_edits_and_deletes(Session, expenses):
+    with Session() as db:
+        expense = db.get(Expense, 1)
+        group_id = expense.group_id
+        expense.description = "zanzibar trip"
+        db.commit()
+        assert [key.expense_id for key in search_keys(db, [group_id], expense_conditions("zanz"))] == [1]
+        # Moving it to another group moves it in the index too
+        expense.group_id = group_id % 12 + 1
+        db.commit()
+        assert search_keys(db, [group_id], expense_conditions("zanzibar")) == []
+        assert [key.expense_id for key in search_keys(db, [group_id % 12 + 1, 1], expense_conditions("zanzibar"))] == [1]
+        db.delete(expense)
+        db.commit()
+        assert search_keys(db, list(range(1, 13)), expense_conditions("zanzibar")) == []
@@ -0,0 +1,82 @@
+import pytest
+from models import FriendRequests, Friends, Group, GroupMember, User
+from services import accept_friend_requests, add_group_members, get_group_member_ids, get_group_version, reject_friend_requests, remove_group_members
+
+
+@pytest.fixture
+def Session(Session):
+    """Users 1-5; 1 is friends with 2 and 3, and 4 and 5 have sent 1 friend requests. Group 1 holds only 1."""
+    with Session() as db:
+        db.add_all([User(id=user_id, first_name=f"U{user_id}", last_name="", password="") for user_id in range(1, 6)])
+        db.add_all([Friends(friend_id=a, user_id=b) for a, b in [(1, 2), (2, 1), (1, 3), (3, 1)]])
+        db.add_all([FriendRequests(friend_request_id=sender, user_id=1) for sender in (4, 5)])
+        db.add(Group(id=1, name="Flat"))
+        db.add(GroupMember(group_id=1, user_id=1))
+        db.commit()
+    return Session
+
+
+def _friends(db, user_id):
+    return sorted(friend.user_id for friend in db.query(Friends).filter(Friends.friend_id == user_id))
+
+
+def test_adding_members_is_idempotent_and_friends_only(Session):
+    with Session() as db:
+        # 5 is not a friend of 1 yet, and 1 is already in the group
+        assert add_group_members(db, 1, ["2", 3, 3, 5, 1], added_by=1) == 2
+        db.commit()
+        version = get_group_version(db, 1)
+        assert sorted(get_group_member_ids(db, 1)) == [1, 2, 3]
+
+        assert add_group_members(db, 1, [2, 3], added_by=1) == 0
+        assert add_group_members(db, 1, [], added_by=1) == 0
+        db.commit()
+        # Nothing changed, so cached fragments of the group stay valid
+        assert get_group_version(db, 1) == version
+
+
+def test_removing_members_only_bumps_the_version_when_someone_left(Session):
+    with Session() as db:
+        add_group_members(db, 1, [2, 3], added_by=1)
+        db.commit()
+        version = get_group_version(db, 1)
+
+        assert remove_group_members(db, 1, [2, 4]) == 1
+        assert remove_group_members(db, 1, [2]) == 0
+        db.commit()
+        assert sorted(get_group_member_ids(db, 1)) == [1, 3]
+        assert get_group_version(db, 1) == version + 1
+
+
+def test_accepting_requests_twice_adds_each_friendship_once(Session):
+    with Session() as db:
+        # A friendship that already exists in one direction is not a conflict
+        db.add(Friends(friend_id=4, user_id=1))
+        db.commit()
+
+        assert sorted(accept_friend_requests(db, 1, [4, 5, 3, 9])) == [4, 5]
+        db.commit()
+        assert _friends(db, 1) == [2, 3, 4, 5]
+        assert _friends(db, 4) == [1] and _friends(db, 5) == [1]
+        assert db.query(FriendRequests).count() == 0
+
+        assert accept_friend_requests(db, 1, [4, 5]) == []
+        assert db.query(Friends).count() == 8
+
+
+def test_accepting_clears_a_crossed_request(Session):
+    with Session() as db:
+        db.add(FriendRequests(friend_request_id=1, user_id=4))
+        db.commit()
+        assert accept_friend_requests(db, 1, [4]) == [4]
+        db.commit()
+        assert [(request.friend_request_id, request.user_id) for request in db.query(FriendRequests)] == [(5, 1)]
+
+
+def test_rejecting_requests(Session):
+    with Session() as db:
+        assert sorted(reject_friend_requests(db, 1, [4, 5, 2])) == [4, 5]
+        assert reject_friend_requests(db, 1, [4]) == []
+        db.commit()
+        assert db.query(FriendRequests).count() == 0
+        assert _friends(db, 1) == [2, 3]
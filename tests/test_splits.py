@@ -0,0 +1,85 @@
+import random
+from fractions import Fraction
+import pytest
+from money import Money, allocate_paise
+from splits import STRATEGIES, _allocate_batch, allocate_splits, plan_split, split_expense
+
+SEED = 20240
+CASES_PER_TYPE = 300
+
+
+def _random_spec(rng, split_type):
+    amount = Money(rng.randint(1, 10_000_000))
+    member_ids = rng.sample(range(1, 51), rng.randint(1, 8))
+    values, items = [], []
+    if split_type == "percentage":
+        cuts = sorted(rng.randint(0, 10_000) for _ in member_ids[1:])
+        values = [f"{(end - start) / 100:.2f}" for start, end in zip([0, *cuts], [*cuts, 10_000])]
+    elif split_type == "shares":
+        values = [rng.choice(["0", "1", "1", "2", "3", "1.5", "0.25"]) for _ in member_ids]
+        values[0] = "1"
+    elif split_type == "exact":
+        values = amount.allocate([rng.randint(0, 9) for _ in member_ids[1:]] + [1])
+    elif split_type == "adjustment":
+        values = [Money(rng.randint(0, amount.paise) // (4 * len(member_ids))) for _ in member_ids]
+    elif split_type == "itemized":
+        for part in amount.allocate([rng.randint(1, 9) for _ in range(rng.randint(1, 4))] + [rng.randint(0, 3)])[:-1]:
+            if part > Money(0):
+                items.append((part, rng.sample(member_ids, rng.randint(0, len(member_ids)))))
+    return amount, split_type, member_ids, values, items
+
+
+def _random_specs(split_type):
+    rng = random.Random(f"{SEED}-{split_type}")
+    specs = [_random_spec(rng, split_type) for _ in range(CASES_PER_TYPE)]
+    # The same split again with a larger amount, so plans share weights and take the batched NumPy path
+    specs += [(spec[0] + Money(rng.randint(1, 10_000_000)), *spec[1:]) for spec in specs[:CASES_PER_TYPE // 2] if spec[1] != "exact"]
+    return specs
+
+
+@pytest.mark.parametrize("split_type", sorted(STRATEGIES))
+def test_shares_add_up_exactly_and_are_never_negative(split_type):
+    for spec in _random_specs(split_type):
+        splits = split_expense(*spec)
+        shares = [share for _, share, _ in splits]
+        assert sum(shares) == spec[0], spec
+        assert all(share >= Money(0) for share in shares), spec
+        assert len({user_id for user_id, _, _ in splits}) == len(splits), spec
+
+
+@pytest.mark.parametrize("split_type", sorted(STRATEGIES))
+def test_batch_allocation_matches_single_allocation(split_type):
+    specs = _random_specs(split_type)
+    plans = [plan_split(*spec) for spec in specs]
+    batched = allocate_splits(plans)
+    assert batched == [allocate_splits([plan])[0] for plan in plans]
+    # The order plans arrive in does not change anyone's share
+    order = list(range(len(plans)))
+    random.Random(SEED).shuffle(order)
+    shuffled = allocate_splits([plans[index] for index in order])
+    assert [batched[index] for index in order] == shuffled
+
+
+def _reference_allocation(paise, weights):
+    # Largest remainder with exact fractions; ties go to the earlier member
+    total = sum(weights)
+    exact = [Fraction(abs(paise) * weight, total) for weight in weights]
+    parts = [int(value) for value in exact]
+    ranked = sorted(range(len(weights)), key=lambda index: (-(exact[index] - parts[index]), index))
+    for index in ranked[:abs(paise) - sum(parts)]:
+        parts[index] += 1
+    return [part if paise >= 0 else -part for part in parts]
+
+
+def test_largest_remainder_ties_are_deterministic():
+    assert allocate_paise(100, [1, 1, 1]) == [34, 33, 33]
+    assert allocate_paise(-100, [1, 1, 1]) == [-34, -33, -33]
+    assert allocate_paise(5, [1, 2, 1, 2]) == [1, 2, 1, 1]
+    rng = random.Random(SEED)
+    for _ in range(2_000):
+        weights = [rng.choice([0, 1, 1, 2, 3, 5]) for _ in range(rng.randint(1, 8))]
+        weights[rng.randrange(len(weights))] += 1
+        amounts = [rng.randint(-10_000, 10_000) for _ in range(5)]
+        expected = [_reference_allocation(amount, weights) for amount in amounts]
+        assert [allocate_paise(amount, weights) for amount in amounts] == expected
+        assert _allocate_batch(amounts, weights).tolist() == expected
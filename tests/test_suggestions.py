@@ -0,0 +1,90 @@
+import pytest
+import suggestions
+from models import Friends, Group, GroupMember, User
+from suggestions import FriendGraph, Suggestion
+
+
+def _friends(db, *pairs):
+    for a, b in pairs:
+        db.add_all([Friends(user_id=a, friend_id=b), Friends(user_id=b, friend_id=a)])
+
+
+@pytest.fixture
+def graph(Session):
+    """
+    1 is friends with 2 and 3. 4 is a friend of both, 5 of 2 only.
+    1 shares group 10 with 6 and 4, and group 11 with 6. Group 12 does not include 1.
+    """
+    with Session() as db:
+        db.add_all([User(id=user_id, first_name=f"U{user_id}", last_name="", password="") for user_id in range(1, 9)])
+        _friends(db, (1, 2), (1, 3), (2, 4), (3, 4), (2, 5))
+        db.add_all([Group(id=group_id, name=f"G{group_id}") for group_id in (10, 11, 12)])
+        members = {10: [1, 4, 6], 11: [1, 6], 12: [7, 8]}
+        db.add_all([GroupMember(group_id=group_id, user_id=user_id) for group_id, user_ids in members.items() for user_id in user_ids])
+        db.commit()
+    graph = FriendGraph()
+    with Session() as db:
+        graph.load(db)
+    return graph
+
+
+def test_ranking(graph):
+    # 4: two mutual friends and one shared group; 6: two shared groups; 5: one mutual friend
+    assert graph.suggest(1) == [Suggestion(4, 7, 2, 1), Suggestion(5, 3, 1, 0), Suggestion(6, 2, 0, 2)]
+    assert graph.suggest(1, limit=2) == [Suggestion(4, 7, 2, 1), Suggestion(5, 3, 1, 0)]
+    assert graph.suggest(1, exclude=[4]) == [Suggestion(5, 3, 1, 0), Suggestion(6, 2, 0, 2)]
+    # Existing friends and the user are never suggested; nor is anyone only reachable through a group they are not in
+    assert {suggestion.user_id for suggestion in graph.suggest(4)} == {1, 5, 6}
+    assert graph.suggest(8) == [Suggestion(7, 1, 0, 1)]
+
+
+def test_ties_go_to_the_lower_id(graph):
+    graph.add_friendships(9, [2, 3])
+    graph.add_friendships(1, [2, 3])  # Already friends; nothing changes
+    top = graph.suggest(1)
+    assert [suggestion.user_id for suggestion in top[:2]] == [4, 9]
+
+
+def test_large_user_ids_cost_nothing_extra(graph):
+    huge = 10 ** 15
+    graph.add_friendships(huge, [2])
+    assert Suggestion(huge, 3, 1, 0) in graph.suggest(1)
+
+
+def test_oversized_groups_are_ignored(graph, monkeypatch):
+    monkeypatch.setattr(suggestions, "MAX_GROUP_SIZE", 2)
+    assert graph.suggest(1) == [Suggestion(4, 6, 2, 0), Suggestion(5, 3, 1, 0), Suggestion(6, 1, 0, 1)]
+
+
+def test_new_friendships_apply_at_once(graph):
+    graph._on_message({"friendships": [1, [5]]})
+    assert 5 not in {suggestion.user_id for suggestion in graph.suggest(1)}
+    # 5 now reaches 3 through 1, and still 4 through 2
+    assert graph.suggest(5) == [Suggestion(3, 3, 1, 0), Suggestion(4, 3, 1, 0)]
+
+
+def test_changed_group_is_reread_on_next_refresh(graph, Session):
+    with Session() as db:
+        db.query(GroupMember).filter(GroupMember.group_id == 11, GroupMember.user_id == 6).delete()
+        db.add(GroupMember(group_id=11, user_id=7))
+        db.commit()
+    assert Suggestion(6, 2, 0, 2) in graph.suggest(1)  # Stale until told
+
+    graph._on_message({"group": 11})
+    with Session() as db:
+        graph.ensure_fresh(db)
+    top = {suggestion.user_id: suggestion for suggestion in graph.suggest(1)}
+    assert top[6] == Suggestion(6, 1, 0, 1)
+    assert top[7] == Suggestion(7, 1, 0, 1)
+    assert {suggestion.user_id for suggestion in graph.suggest(8)} == {7}
+
+
+def test_stale_index_is_rebuilt(graph, Session, monkeypatch):
+    with Session() as db:
+        _friends(db, (2, 8))
+        db.commit()
+    assert 8 not in {suggestion.user_id for suggestion in graph.suggest(1)}
+    monkeypatch.setattr(suggestions, "REFRESH_SECONDS", -1)
+    with Session() as db:
+        graph.ensure_fresh(db)
+    assert Suggestion(8, 3, 1, 0) in graph.suggest(1)